@@ -1,21 +1,36 @@
 
 
-from flask import Flask, render_template, request, redirect, url_for, send_from_directory, flash
+from flask import Flask, render_template, request, redirect, url_for, send_from_directory, flash, jsonify, abort
+from flask import session, make_response, send_file, g
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func, desc 
+from sqlalchemy import func, desc, case, and_, or_, select, update, insert, delete, tuple_, bindparam
 from sqlalchemy.pool import NullPool 
+from sqlalchemy.orm import aliased
+from sqlalchemy.exc import IntegrityError
 import os 
+import io
+import glob
+import hashlib
+import json
+import re
+import time
 import uuid
-from datetime import datetime
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
 from flask_migrate import Migrate
 from functools import wraps # Basic認証用 
 from flask import Response # Basic認証用 
-import cloudinary
-import cloudinary.uploader
-import cloudinary.api
+from markupsafe import Markup
 import requests
-
-cloudinary.config(secure=True)
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import click
+
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from storage import create_storage, LocalStorage
+from cache import create_cache
+from imaging import image_meta, sniff_format, validate_image, check_image, ImageRejected, SNIFF_BYTES
 # app.py の先頭に追加して実行
 # print("RUNNING FILE:", os.path.abspath(__file__))
 
@@ -44,6 +59,22 @@ app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
 # 2. アップロードフォルダの設定
 app.config['UPLOAD_FOLDER'] = os.path.join(basedir, 'static', 'uploads')
+# 3. 投稿された画像を検証・ハッシュ・アップロードするときの作業用フォルダ（プロセスごと）
+#    web から worker への受け渡しは DB の spool_chunk で行う（Heroku の dyno はファイルシステムを共有しない）
+app.config['SPOOL_FOLDER'] = os.environ.get("SPOOL_FOLDER", os.path.join(basedir, 'spool'))
+# 4. 画像の保存先 cloudinary / local / memory（storage.py を参照）
+app.config['STORAGE_BACKEND'] = os.environ.get("STORAGE_BACKEND", "cloudinary")
+app.config['STORAGE_LOCAL_ROOT'] = os.environ.get("STORAGE_LOCAL_ROOT", app.config['UPLOAD_FOLDER'])
+app.config['STORAGE_LOCAL_URL'] = '/uploads'
+# 4-2. 完結したコミックの詳細ページを固めた HTML を置くフォルダ（dyno ごとのキャッシュ。Comic.version で照合する）
+app.config['SNAPSHOT_FOLDER'] = os.environ.get("SNAPSHOT_FOLDER", os.path.join(basedir, 'snapshots'))
+# 5. リクエスト本体の上限（超えたら本体を読む前・読んでいる途中で 413 を返す）
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get("MAX_UPLOAD_BYTES", 10 * 1024 * 1024))
+# 6. 描いたページ・カードのキャッシュ memory / redis / none（cache.py を参照）
+app.config['CACHE_BACKEND'] = os.environ.get("CACHE_BACKEND", "memory")
+app.config['CACHE_MAX_ENTRIES'] = int(os.environ.get("CACHE_MAX_ENTRIES", 1000))
+app.config['CACHE_STALE_SECONDS'] = int(os.environ.get("CACHE_STALE_SECONDS", 300))
+app.config['REDIS_URL'] = os.environ.get("REDIS_URL")
 # sqlite用であり、postgresには使えないエラーになる
 # app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
 #     "connect_args": {
@@ -56,6 +87,53 @@ app.config['DEBUG'] = False
 # 環境変数
 # 受け入れる画像の拡張子
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+# 一時保存とハッシュ計算で1回に読む大きさ
+SPOOL_CHUNK_SIZE = 64 * 1024
+# コマ上限に達したコミックへ投稿されたとき
+COMIC_FULL_MESSAGE = 'この漫画リレーはコマ上限に達しています。'
+DUPLICATE_KOMA_MESSAGE = '同じ画像がこの漫画リレーにすでに投稿されています。'
+# コマのアップロード状態
+KOMA_PENDING = 'pending'
+KOMA_READY = 'ready'
+KOMA_FAILED = 'failed'
+# 削除されてから GC_DELETED_GRACE_DAYS 日たち、画像を消したコマ（もう戻せない）
+KOMA_EXPIRED = 'expired'
+# worker のアップロードのリトライ回数と間隔（秒。失敗するたびに倍にする）
+INGEST_MAX_ATTEMPTS = int(os.environ.get("INGEST_MAX_ATTEMPTS", 6))
+INGEST_RETRY_BASE = int(os.environ.get("INGEST_RETRY_BASE", 10))
+INGEST_RETRY_MAX = int(os.environ.get("INGEST_RETRY_MAX", 600))
+# LINE 通知の送信状態
+NOTIFY_PENDING = 'pending'
+NOTIFY_SENT = 'sent'
+NOTIFY_DROPPED = 'dropped'
+# 同じコミックへの通知はこの秒数に1回にまとめる
+NOTIFY_WINDOW = int(os.environ.get("NOTIFY_WINDOW", 60))
+NOTIFY_MAX_ATTEMPTS = int(os.environ.get("NOTIFY_MAX_ATTEMPTS", 5))
+# 二重送信対策のキーを残しておく時間（worker が古いものを消す）
+IDEMPOTENCY_KEEP_HOURS = int(os.environ.get("IDEMPOTENCY_KEEP_HOURS", 24))
+# 分割アップロード（/upload-sessions）。UPLOAD_CHUNK_SIZE より大きい画像はブラウザが分けて送る
+# 1回分は MAX_CONTENT_LENGTH に収まる大きさにする
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", 2 * 1024 * 1024))
+MAX_CHUNKED_UPLOAD_BYTES = int(os.environ.get("MAX_CHUNKED_UPLOAD_BYTES", 50 * 1024 * 1024))
+# 途中で止まったセッションは、最後に受け取ってからこの時間で worker が消す
+UPLOAD_SESSION_TTL_HOURS = int(os.environ.get("UPLOAD_SESSION_TTL_HOURS", 24))
+UPLOAD_OPEN = 'open'
+UPLOAD_DONE = 'done'
+# ブラウザからストレージへの直接アップロード（/direct-uploads）。ストレージが対応していれば投稿フォームが使う
+DIRECT_UPLOADS = os.environ.get("DIRECT_UPLOADS", "1") != "0"
+# 直接アップロードの署名の有効期限（秒）。送り終えて finalize するまでをこの中に収める
+DIRECT_UPLOAD_TTL = int(os.environ.get("DIRECT_UPLOAD_TTL", 600))
+# 直接アップロードの画像を置くフォルダ（worker があとで LQIP・ハッシュを埋めて重複を片付ける）
+DIRECT_UPLOAD_FOLDER = 'manga_relay/direct'
+# ストレージの掃除（flask gc-storage / worker）
+# どのコマからも参照されていない画像は、アップロード途中のものを消さないよう GC_ORPHAN_GRACE_HOURS 時間待つ
+GC_ORPHAN_GRACE_HOURS = int(os.environ.get("GC_ORPHAN_GRACE_HOURS", 24))
+# 削除したコマの画像は、復元できるよう GC_DELETED_GRACE_DAYS 日残しておく
+GC_DELETED_GRACE_DAYS = int(os.environ.get("GC_DELETED_GRACE_DAYS", 30))
+# トップページ / 「もっと見る」1回あたりのカード数
+FEED_PAGE_SIZE = int(os.environ.get("FEED_PAGE_SIZE", 20))
+# 管理ページ1ページあたりのコミック数
+ADMIN_PAGE_SIZE = int(os.environ.get("ADMIN_PAGE_SIZE", 50))
 # basic認証で管理画面を開く--
 ADMIN_USER = os.environ.get("ADMIN_USER") 
 ADMIN_PASS = os.environ.get("ADMIN_PASS")
@@ -67,34 +145,105 @@ db = SQLAlchemy(app)
 # --- フォルダの作成 ---
 if not os.path.exists(app.config['UPLOAD_FOLDER']):
     os.makedirs(app.config['UPLOAD_FOLDER'])
+if not os.path.exists(app.config['SPOOL_FOLDER']):
+    os.makedirs(app.config['SPOOL_FOLDER'])
+if not os.path.exists(app.config['SNAPSHOT_FOLDER']):
+    os.makedirs(app.config['SNAPSHOT_FOLDER'])
 
 migrate = Migrate(app, db)
+storage = create_storage(app.config)
+page_cache = create_cache(app.config)
 
 # ====================================================================
 # --- データベースモデル ---
 # ====================================================================
 class Comic(db.Model):
     __tablename__ = 'comic'
+    __table_args__ = (
+        # トップページのキーセットページング用 (is_deleted, started_at, id)
+        db.Index('ix_comic_feed', 'is_deleted', 'started_at', 'id'),
+        # 管理ページの一覧（削除済みも含めて新しい順）
+        db.Index('ix_comic_started', 'started_at', 'id'),
+        # Postgres では未削除だけの部分インデックスも張る（行数が減るぶん小さく速い）
+        db.Index('ix_comic_feed_live', 'started_at', 'id',
+                 postgresql_where=db.text('is_deleted = 0')).ddl_if(dialect='postgresql'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), default='無題の漫画リレー')
     started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # 最後のコマ（max_koma 枚目）が入ったら True。allocate_frame_number が採番と同じ UPDATE で立てる
+    # 削除でコマが減ったら recount_comics が戻す
     is_completed = db.Column(db.Boolean, default=False)
     is_deleted = db.Column(db.Integer, default=0, nullable=False)
+    # コミックごと消したときの時刻。そのとき一緒に消えたコマは Koma.deleted_at が同じになる（restore_comics が使う）
+    deleted_at = db.Column(db.DateTime)
     max_koma = db.Column(db.Integer, default=20)
-    komas = db.relationship('Koma', backref='comic', lazy='dynamic') 
+    # 一覧表示用の非正規化カラム（投稿・削除時に同じトランザクションで更新する）
+    # ずれた場合は `flask reconcile-counters` で再計算できる
+    koma_count = db.Column(db.Integer, default=0, nullable=False, server_default='0')
+    latest_koma_id = db.Column(db.Integer)
+    last_posted_at = db.Column(db.DateTime)
+    is_full = db.Column(db.Boolean, default=False, nullable=False, server_default=db.false())
+    # 採番済みの最後のコマ番号（削除しても戻さない）。allocate_frame_number で +1 する
+    last_frame_number = db.Column(db.Integer, default=0, nullable=False, server_default='0')
+    # 表示が変わる更新（投稿・アップロード完了・削除・復元）のたびに +1 する。詳細ページの ETag / Last-Modified
+    version = db.Column(db.Integer, default=0, nullable=False, server_default='0')
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # コマ番号順。一覧で使うときは selectinload でまとめて読む（コミックごとにクエリを投げない）
+    komas = db.relationship('Koma', backref='comic', lazy='select', order_by='Koma.frame_number')
 
 
     def __repr__(self):
         return f'<Comic {self.id}: {self.title}>'
 
+KOMA_MISSING_META_WHERE = (
+    "status = 'ready' AND is_deleted = 0 AND storage_key IS NOT NULL AND (lqip IS NULL OR content_sha256 IS NULL)"
+)
+
+
 class Koma(db.Model):
     __tablename__ = 'koma'
+    __table_args__ = (
+        # comic_id 単体のインデックスは作らない（この制約と下の複合インデックスが先頭で兼ねる）
+        db.UniqueConstraint('comic_id', 'frame_number', name='uq_koma_comic_frame'),
+        # 詳細ページ・件数の再計算用 (comic_id, is_deleted, frame_number)
+        db.Index('ix_koma_comic_live', 'comic_id', 'is_deleted', 'frame_number'),
+        db.Index('ix_koma_comic_live_frame', 'comic_id', 'frame_number',
+                 postgresql_where=db.text('is_deleted = 0')).ddl_if(dialect='postgresql'),
+        # worker がアップロード待ちを拾う用
+        db.Index('ix_koma_status', 'status', 'id'),
+        # worker が LQIP・ハッシュの無い ready のコマ（直接アップロード）を拾う用
+        db.Index('ix_koma_missing_meta', 'id',
+                 postgresql_where=db.text(KOMA_MISSING_META_WHERE)).ddl_if(dialect='postgresql'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     comic_id = db.Column(db.Integer, db.ForeignKey('comic.id'), nullable=False)
     frame_number = db.Column(db.Integer, nullable=False)
-    image_filename = db.Column(db.String(120), unique=True, nullable=False)
+    # アップロード完了までは None（status が 'ready' になったら URL が入る）
+    # 同じ画像を使い回したコマどうしは同じ URL になるので一意にはしない
+    # ストレージの URL をそのまま入れる（storage_key 255 文字 + ホスト・パスが入る長さにしておく）
+    image_filename = db.Column(db.String(500), nullable=True)
+    # storage.py のキー（Cloudinary なら public_id）。削除や URL の組み立てに使う
+    storage_key = db.Column(db.String(255))
     posted_at = db.Column(db.DateTime, default=datetime.utcnow) 
     is_deleted = db.Column(db.Integer, default=0, nullable=False)
+    # ソフトデリートした日時（GC_DELETED_GRACE_DAYS 日たったら画像を消す）
+    deleted_at = db.Column(db.DateTime)
+    # アップロード状態 pending → ready（リトライし尽くしたら failed）
+    status = db.Column(db.String(20), default=KOMA_READY, nullable=False, server_default=KOMA_READY)
+    # アップロード待ちの画像の spool_chunk の name（アップロードが終わったら消す）
+    spool_path = db.Column(db.String(255))
+    attempts = db.Column(db.Integer, default=0, nullable=False, server_default='0')
+    next_attempt_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    # 画像のメタデータ（表示前に枠の大きさを決めるのと、読み込み中のぼかし表示に使う）
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    bytes = db.Column(db.Integer)
+    format = db.Column(db.String(10))
+    lqip = db.Column(db.Text)  # imaging.make_lqip の data URI
+    # 画像の SHA-256（16進）。同じ画像の投稿を弾いたり、アップロード済みの画像を使い回したりする
+    content_sha256 = db.Column(db.String(64), index=True)
 
     def __repr__(self):
         return f'<Koma {self.id} (Comic:{self.comic_id}, Seq:{self.frame_number})>'
@@ -117,6 +266,67 @@ class PublicComment(db.Model):
     admin_reply = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+# プロセスごとに持つキャッシュの世代。中身が変わったら version を上げ（bump_state_version）、
+# 各 gunicorn worker は version が変わっていたら読み直す
+class AppState(db.Model):
+    __tablename__ = "app_state"
+    key = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, default=0, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# LINE 通知の送信待ち（コマと同じトランザクションで書き、worker が送る）
+class NotificationOutbox(db.Model):
+    __tablename__ = "notification_outbox"
+    __table_args__ = (
+        db.Index('ix_notification_outbox_status_comic', 'status', 'comic_id'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    comic_id = db.Column(db.Integer, db.ForeignKey('comic.id'), nullable=False)
+    koma_id = db.Column(db.Integer, db.ForeignKey('koma.id'))
+    link = db.Column(db.String(255), nullable=False)
+    status = db.Column(db.String(20), default=NOTIFY_PENDING, nullable=False)  # pending / sent / dropped
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    next_attempt_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+
+# 投稿フォームの二重送信対策。フォームが送ってくるキーと、成功した投稿の結果（戻り先）を残す
+# キーの行は投稿と同じトランザクションで書くので、同じキーの2回目は1回目が終わるまで待ち、
+# 1回目がコミットされていればその結果をそのまま返す
+class PostIdempotency(db.Model):
+    __tablename__ = "post_idempotency"
+    key = db.Column(db.String(64), primary_key=True)
+    comic_id = db.Column(db.Integer)
+    koma_id = db.Column(db.Integer)
+    location = db.Column(db.String(255))  # 成功時のリダイレクト先
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+# 分割アップロードのセッション。受け取ったバイト列は spool_chunk の <id>.part に塊ごとに書いていく
+# 投稿先などのフォームの項目は作るときに預かり、finalize でコマにする
+class UploadSession(db.Model):
+    __tablename__ = "upload_session"
+    id = db.Column(db.String(32), primary_key=True)
+    comic_id = db.Column(db.Integer)  # None なら新規リレー
+    title = db.Column(db.String(100))
+    max_koma = db.Column(db.Integer)
+    total_bytes = db.Column(db.Integer, nullable=False)
+    received_bytes = db.Column(db.Integer, default=0, nullable=False)
+    status = db.Column(db.String(20), default=UPLOAD_OPEN, nullable=False)  # open / done
+    koma_id = db.Column(db.Integer)
+    location = db.Column(db.String(255))  # finalize の結果（もう一度呼ばれたらこれを返す）
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+# worker がアップロードするまでの画像のバイト列。name（Koma.spool_path か <id>.part）ごとに offset 順の塊で持つ
+# web と worker は別の dyno なので、ファイルではなく DB で受け渡す。アップロードが済んだら消す
+class SpoolChunk(db.Model):
+    __tablename__ = "spool_chunk"
+    name = db.Column(db.String(64), primary_key=True)
+    offset = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
 # herokuでは不要
 # with app.app_context():
 #     # 接続を取得して PRAGMA を実行
@@ -130,16 +340,43 @@ LINE_TOKEN = os.environ.get("LINE_CHANNEL_ACCESS_TOKEN")
 LINE_USER_ID = os.environ.get("LINE_USER_ID")
 
 LINE_GROUP_ID = os.environ.get("LINE_GROUP_ID")
+# ローカルの代替サーバーに向けるときは差し替える
+LINE_PUSH_URL = os.environ.get("LINE_PUSH_URL", "https://api.line.me/v2/bot/message/push")
+LINE_TIMEOUT = (3, 10)  # (接続, 読み込み) 秒
+
+_line_session = None
+
+
+# 接続を使い回すセッション（5xx / 429 は urllib3 側で少しだけ再試行する）
+def line_session():
+    global _line_session
+    if _line_session is None:
+        retry = Retry(
+            total=2,
+            backoff_factor=0.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=None,
+        )
+        session = requests.Session()
+        session.mount("https://", HTTPAdapter(max_retries=retry, pool_maxsize=4))
+        session.mount("http://", HTTPAdapter(max_retries=retry, pool_maxsize=4))
+        session.headers.update({
+            "Authorization": f"Bearer {LINE_TOKEN}",
+            "Content-Type": "application/json"
+        })
+        _line_session = session
+    return _line_session
+
 
+def line_notify_enabled():
+    return bool(LINE_TOKEN and LINE_GROUP_ID)
+
+
+# 送れなければ例外を投げる（リトライは呼び出し側の outbox で行う）
 def send_line_notify(message):
-    if not LINE_TOKEN or not LINE_GROUP_ID:
+    if not line_notify_enabled():
         return
 
-    url = "https://api.line.me/v2/bot/message/push"
-    headers = {
-        "Authorization": f"Bearer {LINE_TOKEN}",
-        "Content-Type": "application/json"
-    }
     payload = {
         "to": LINE_GROUP_ID,
         "messages": [
@@ -147,7 +384,19 @@ def send_line_notify(message):
         ]
     }
 
-    requests.post(url, headers=headers, json=payload)
+    response = line_session().post(LINE_PUSH_URL, json=payload, timeout=LINE_TIMEOUT)
+    response.raise_for_status()
+
+
+# 投稿と同じトランザクションで通知を積む（送信は worker.py）
+def enqueue_line_notify(comic_id, koma_id):
+    if not line_notify_enabled():
+        return
+    db.session.add(NotificationOutbox(
+        comic_id=comic_id,
+        koma_id=koma_id,
+        link=f"{request.url_root}comic/{comic_id}",
+    ))
 
 
 @app.route("/line/webhook", methods=["POST"])
@@ -188,19 +437,973 @@ def allowed_file(filename):
     filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS 
 
 
+# 投稿ファイルを SPOOL_FOLDER（作業用）に保存して、そのファイル名を返す
+# 書き込みながら SHA-256 も計算する。(ファイル名, ハッシュ) を返す
+# 拡張子は中身から判定した形式に合わせる（.jpg という名前の PNG なども来る）
+EXTENSION_FOR_FORMAT = {'png': 'png', 'jpeg': 'jpg'}
+
+
+def spool_upload(file, fmt):
+    filename = str(uuid.uuid4()) + '.' + EXTENSION_FOR_FORMAT[fmt]
+    digest = hashlib.sha256()
+    with open(os.path.join(app.config['SPOOL_FOLDER'], filename), 'wb') as out:
+        for chunk in iter(lambda: file.stream.read(SPOOL_CHUNK_SIZE), b''):
+            digest.update(chunk)
+            out.write(chunk)
+    return filename, digest.hexdigest()
+
+
+# --- web から worker への画像の受け渡し（spool_chunk） ---
+# 作業用のファイルは書いたプロセスでしか見えないので、worker に渡す画像はコマと同じトランザクションで
+# spool_chunk に書く（コマだけ・画像だけが残ることもない）。worker はそこから作業用のファイルに戻して使う
+class SpoolMissing(LookupError):
+    pass
+
+
+def spool_file_path(filename):
+    return os.path.join(app.config['SPOOL_FOLDER'], filename)
+
+
+def remove_spool_file(filename):
+    try:
+        os.remove(spool_file_path(filename))
+    except FileNotFoundError:
+        pass
+
+
+# 作業用のファイルを UPLOAD_CHUNK_SIZE ずつ spool_chunk に書く（コミットは呼び出し側）
+def stage_spool(name):
+    with open(spool_file_path(name), 'rb') as f:
+        offset = 0
+        for data in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+            db.session.execute(insert(SpoolChunk).values(name=name, offset=offset, data=data))
+            offset += len(data)
+
+
+# spool_chunk の塊をつなげて作業用のファイルに書き、そのパスを返す（使い終わったら呼び出し側が消す）
+# 同じ name を別のプロセスが同時に読んでもぶつからないよう、ファイル名は毎回変える
+def load_spool(name):
+    path = spool_file_path(f"{uuid.uuid4().hex}-{name}")
+    chunks = db.session.scalars(
+        select(SpoolChunk.data)
+        .where(SpoolChunk.name == name)
+        .order_by(SpoolChunk.offset)
+        .execution_options(yield_per=1)
+    )
+    found = False
+    with open(path, 'wb') as out:
+        for data in chunks:
+            out.write(data)
+            found = True
+    if not found:
+        os.remove(path)
+        raise SpoolMissing(f"spool {name} がありません")
+    return path
+
+
+# 塊はそのままで name だけ付け替える（分割アップロードの .part をコマに渡す。コミットは呼び出し側）
+def rename_spool(old_name, new_name):
+    return bulk_update(SpoolChunk, [SpoolChunk.name == old_name], name=new_name)
+
+
+# コミットしたあとに呼ぶ（要らなくなった画像を消す）
+def discard_spool(name):
+    db.session.execute(delete(SpoolChunk).where(SpoolChunk.name == name))
+    db.session.commit()
+
+
+# --- 二重送信対策 ---
+IDEMPOTENCY_KEY_RE = re.compile(r'^[A-Za-z0-9-]{16,64}$')
+
+
+# キーの行を先に書く。同じキーの投稿が済んでいれば PostIdempotency を返す（この投稿は何もしない）
+# 形式がおかしいキーは無視して普通に投稿させる
+def claim_idempotency_key(key):
+    if not key or not IDEMPOTENCY_KEY_RE.match(key):
+        return None, None
+    record = PostIdempotency(key=key)
+    db.session.add(record)
+    try:
+        db.session.flush()
+    except IntegrityError:
+        db.session.rollback()
+        return None, db.session.get(PostIdempotency, key)
+    return record, None
+
+
+# --- 同じ画像の重複チェック ---
+# 同じコミックに同じ画像はもう投稿されているか（失敗したコマ・削除したコマは数えない）
+def duplicate_in_comic(comic_id, content_sha256):
+    return db.session.query(
+        Koma.query.filter(
+            Koma.comic_id == comic_id,
+            Koma.content_sha256 == content_sha256,
+            Koma.is_deleted == 0,
+            Koma.status != KOMA_FAILED,
+        ).exists()
+    ).scalar()
+
+
+# 同じ画像がアップロード済みなら、そのコマ（の画像）を使い回す
+# 削除済みのコマは使わない（gc_deleted_komas が画像を消す途中かもしれないし、管理者が消した画像を戻さない）
+def find_uploaded_copy(content_sha256):
+    return (
+        Koma.query
+        .filter(
+            Koma.content_sha256 == content_sha256,
+            Koma.status == KOMA_READY,
+            Koma.is_deleted == 0,
+            Koma.storage_key.isnot(None),
+        )
+        .order_by(Koma.id)
+        .first()
+    )
+
+
+# 画像の参照先とメタデータを別のコマからコピーする
+REUSED_COLUMNS = ('storage_key', 'image_filename', 'width', 'height', 'bytes', 'format', 'lqip')
+
+
+def reuse_upload(koma, source):
+    for name in REUSED_COLUMNS:
+        setattr(koma, name, getattr(source, name))
+    koma.status = KOMA_READY
+    koma.spool_path = None
+
+
+# --- コマ画像の配信 ---
+# 表示する場所ごとの幅の候補と表示サイズ
+#   widths : srcset に並べる幅（px）
+#   default: src に使う幅（DPR のヒントがあれば掛ける）
+#   aspect : 枠の縦横比（幅, 高さ）。None なら元画像の比率のまま縮小する
+IMAGE_PRESETS = {
+    # index.html のカード（h-40 の枠に object-cover）
+    'card': {'widths': (320, 480, 640, 960), 'default': 480, 'aspect': (21, 8),
+             'sizes': '(min-width: 768px) 420px, calc(100vw - 2rem)'},
+    # admin_list.html のヘッダのサムネイル（80px 角）
+    'thumb': {'widths': (80, 160, 240), 'default': 80, 'aspect': (1, 1),
+              'sizes': '80px'},
+    # admin_list.html のコマ一覧（高さ 120px）
+    'grid': {'widths': (160, 320), 'default': 160, 'aspect': (4, 3),
+             'sizes': '160px'},
+    # comic_detail.html の本文（max-w-3xl いっぱい）
+    'detail': {'widths': (480, 768, 1080, 1536), 'default': 768, 'aspect': None,
+               'sizes': '(min-width: 768px) 736px, calc(100vw - 2rem)'},
+}
+
+
+def client_dpr():
+    value = request.headers.get('Sec-CH-DPR') or request.headers.get('DPR')
+    try:
+        return min(max(float(value), 1.0), 3.0)
+    except (TypeError, ValueError):
+        return 1.0
+
+
+def wants_save_data():
+    return request.headers.get('Save-Data', '').lower() == 'on'
+
+
+# <img> タグを組み立てる
+# Cloudinary なら幅ごとの f_auto,q_auto の URL を srcset に並べる。Save-Data のときは
+# 小さい幅と q_auto:eco だけにする。ほかのバックエンドは元画像 1 枚
+@app.template_global()
+def koma_img(koma, preset, **attrs):
+    conf = IMAGE_PRESETS[preset]
+    widths = conf['widths']
+    quality = 'auto'
+    dpr = client_dpr()
+    if wants_save_data():
+        widths = widths[:max(1, len(widths) // 2)]
+        quality = 'auto:eco'
+        dpr = 1.0
+
+    # 枠の比率が決まっていなければ元画像の比率で高さを出す
+    aspect = conf['aspect'] or ((koma.width, koma.height) if koma.width and koma.height else None)
+
+    def height_for(width):
+        return round(width * aspect[1] / aspect[0]) if aspect else None
+
+    crop = 'fill' if conf['aspect'] else 'limit'
+    tag = {
+        'loading': 'lazy',
+        'decoding': 'async',
+        'alt': '',
+        'width': conf['default'],
+        'height': height_for(conf['default']),
+    }
+    if koma.lqip:
+        # 本体が届くまでぼかし画像を背景に出しておく
+        tag['style'] = f"background: center / cover no-repeat url({koma.lqip})"
+
+    key = koma.storage_key
+    mirrored = g.get('mirrored_images')
+    if mirrored and koma.id in mirrored:
+        # flask export-static --mirror-images: 書き出し先にコピーした元画像を1枚だけ指す
+        tag['src'] = mirrored[koma.id]
+    elif key and storage.supports_transforms:
+        src_width = min(round(conf['default'] * dpr), widths[-1])
+        tag['src'] = storage.variant_url(key, src_width, height_for(src_width), crop, quality)
+        tag['srcset'] = ', '.join(
+            f"{storage.variant_url(key, w, height_for(w), crop, quality)} {w}w"
+            for w in widths
+        )
+        tag['sizes'] = conf['sizes']
+    else:
+        tag['src'] = koma.image_filename
+
+    tag.update(attrs)
+    return Markup('<img {}>').format(Markup(' ').join(
+        Markup('{}="{}"').format(name, value)
+        for name, value in tag.items()
+        if value is not None
+    ))
+
+
+# DPR のヒントを送ってもらう（画像 URL が変わるので Vary も付ける）
+@app.after_request
+def add_client_hint_headers(response):
+    if response.mimetype == 'text/html':
+        response.headers['Accept-CH'] = 'Sec-CH-DPR, DPR'
+        response.vary.update(('Sec-CH-DPR', 'DPR', 'Save-Data'))
+    return response
+
+
+# --- Comic の非正規化カラム ---
+# koma テーブルから koma_count / latest_koma_id / last_posted_at / is_full を
+# 再計算する相関サブクエリ。UPDATE comic ... SET にそのまま渡せる
+def comic_counter_values():
+    live = and_(Koma.comic_id == Comic.id, Koma.is_deleted == 0)
+    koma_count = select(func.count(Koma.id)).where(live).scalar_subquery()
+    latest_koma_id = (
+        select(Koma.id).where(live)
+        .order_by(Koma.frame_number.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+    last_posted_at = select(func.max(Koma.posted_at)).where(live).scalar_subquery()
+    # 採番カウンタは削除済みも含めた最大値より小さくならないようにだけ直す
+    max_frame = (
+        select(func.coalesce(func.max(Koma.frame_number), 0))
+        .where(Koma.comic_id == Comic.id)
+        .scalar_subquery()
+    )
+    is_full = case(
+        (and_(Comic.max_koma.isnot(None), koma_count >= Comic.max_koma), True),
+        else_=False
+    )
+    return {
+        'koma_count': koma_count,
+        'latest_koma_id': latest_koma_id,
+        'last_posted_at': last_posted_at,
+        'is_full': is_full,
+        'is_completed': is_full,
+        'last_frame_number': case(
+            (max_frame > Comic.last_frame_number, max_frame),
+            else_=Comic.last_frame_number
+        ),
+    }
+
+
+# 条件に合う Comic の非正規化カラムをまとめて再計算する（コミットは呼び出し側）
+# 削除・復元・アップロード失敗のあとに呼ばれるので、表示の version もここで上げる
+def recount_comics(*criteria):
+    stmt = (
+        update(Comic)
+        .where(*criteria)
+        .values(**comic_counter_values(), **comic_version_values())
+        .execution_options(synchronize_session=False)
+    )
+    return db.session.execute(stmt).rowcount
+
+
+# --- 表示の version（条件付き GET 用） ---
+# コミックの表示が変わったら Comic.version を変更と同じトランザクションで上げる
+# トップページの app_state の feed は、コミットしてから invalidate_comics で上げる
+# （投稿のトランザクションで feed の1行を握ると、サイト全体の投稿がその行のロックで1本に並ぶ）
+FEED_STATE = 'feed'
+
+
+def comic_version_values():
+    return {'version': Comic.version + 1, 'updated_at': datetime.utcnow()}
+
+
+# 中身は変えずに version だけ上げる（worker のアップロード完了など）
+def touch_comics(comic_ids):
+    bulk_update(Comic, [Comic.id.in_(comic_ids)], **comic_version_values())
+
+
+# コマ番号の採番
+# comic 行を1回の UPDATE で +1 して RETURNING で受け取る。UPDATE の行ロックで
+# 同じコミックへの同時投稿は直列化され、満タン判定も同じ WHERE で行うので上限を超えない
+# 満タン（または削除済み）のときは None を返す
+def allocate_frame_number(comic_id):
+    reaches_max_koma = case(
+        (and_(Comic.max_koma.isnot(None), Comic.koma_count + 1 >= Comic.max_koma), True),
+        else_=False
+    )
+    stmt = (
+        update(Comic)
+        .where(
+            Comic.id == comic_id,
+            Comic.is_deleted == 0,
+            or_(Comic.max_koma.is_(None), Comic.koma_count < Comic.max_koma),
+        )
+        .values(
+            last_frame_number=Comic.last_frame_number + 1,
+            koma_count=Comic.koma_count + 1,
+            is_full=reaches_max_koma,
+            # 最後のコマならここで完結にする（同時に来た投稿は上の WHERE で弾かれる）
+            is_completed=reaches_max_koma,
+            **comic_version_values(),
+        )
+        .returning(Comic.last_frame_number)
+        .execution_options(synchronize_session=False)
+    )
+    return db.session.execute(stmt).scalar()
+
+
+# 新しいコマを最新コマとして記録する（allocate_frame_number と同じトランザクションで呼ぶ）
+def mark_latest_koma(comic_id, koma):
+    stmt = (
+        update(Comic)
+        .where(Comic.id == comic_id)
+        .values(latest_koma_id=koma.id, last_posted_at=koma.posted_at)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.execute(stmt)
+
+
+# アップロード待ちで、リトライ時刻が来ているコマ（worker が古い順に拾う）
+def pending_komas_query(now):
+    return (
+        Koma.query
+        .filter(
+            Koma.status == KOMA_PENDING,
+            or_(Koma.next_attempt_at.is_(None), Koma.next_attempt_at <= now),
+        )
+        .order_by(Koma.id)
+    )
+
+
+# 手作業の修正（直接SQLを叩いた後など）のあとに非正規化カラムを一括で直す
+@app.cli.command('reconcile-counters')
+@click.option('--comic-id', 'comic_ids', type=int, multiple=True, help='対象のコミックID（省略時は全件）')
+@click.option('--chunk-size', default=1000, show_default=True, help='1トランザクションで処理するID範囲')
+def reconcile_counters_command(comic_ids, chunk_size):
+    values = comic_counter_values()
+    drifted = or_(
+        Comic.koma_count != values['koma_count'],
+        Comic.latest_koma_id.is_distinct_from(values['latest_koma_id']),
+        Comic.last_posted_at.is_distinct_from(values['last_posted_at']),
+        Comic.is_full != values['is_full'],
+        Comic.last_frame_number != values['last_frame_number'],
+    )
+
+    if comic_ids:
+        ranges = [Comic.id.in_(comic_ids)]
+    else:
+        max_id = db.session.query(func.max(Comic.id)).scalar() or 0
+        ranges = [
+            and_(Comic.id > start, Comic.id <= start + chunk_size)
+            for start in range(0, max_id, chunk_size)
+        ]
+
+    repaired = 0
+    for criteria in ranges:
+        repaired += recount_comics(criteria, drifted)
+        db.session.commit()
+    if repaired:
+        bump_feed_version()
+
+    click.echo(f'[reconcile] repaired {repaired} comic(s)')
+
+
+# 画像メタデータ（縦横・バイト数・形式・LQIP・SHA-256）が無い既存のコマを後から埋める
+# 画像の取得と LQIP の生成はスレッドで並列に行い、DB の更新はまとめて行う
+@app.cli.command('backfill-image-meta')
+@click.option('--workers', default=8, show_default=True, help='並列に取得する数')
+@click.option('--batch-size', default=200, show_default=True, help='1回のコミットで更新する件数')
+def backfill_image_meta_command(workers, batch_size):
+    http = requests.Session()
+
+    def fetch_meta(koma_id, storage_key, url):
+        try:
+            if storage_key:
+                data = storage.read(storage_key)
+            else:
+                response = http.get(url, timeout=(3, 30))
+                response.raise_for_status()
+                data = response.content
+            meta = image_meta(io.BytesIO(data))
+            meta['content_sha256'] = hashlib.sha256(data).hexdigest()
+            meta['koma_id'] = koma_id
+            return meta
+        except Exception as e:
+            click.echo(f'[backfill] koma {koma_id}: {e}', err=True)
+            return None
+
+    stmt = (
+        update(Koma)
+        .where(Koma.id == bindparam('koma_id'))
+        .values(
+            width=bindparam('width'),
+            height=bindparam('height'),
+            bytes=bindparam('bytes'),
+            format=bindparam('format'),
+            lqip=bindparam('lqip'),
+            content_sha256=bindparam('content_sha256'),
+        )
+    )
+
+    last_id, updated, failed = 0, 0, 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            rows = (
+                db.session.query(Koma.id, Koma.storage_key, Koma.image_filename)
+                .filter(
+                    Koma.id > last_id,
+                    Koma.status == KOMA_READY,
+                    or_(Koma.lqip.is_(None), Koma.content_sha256.is_(None)),
+                    Koma.image_filename.isnot(None),
+                )
+                .order_by(Koma.id)
+                .limit(batch_size)
+                .all()
+            )
+            if not rows:
+                break
+            last_id = rows[-1].id
+
+            metas = [m for m in pool.map(lambda r: fetch_meta(*r), rows) if m]
+            failed += len(rows) - len(metas)
+            if metas:
+                db.session.connection().execute(stmt, metas)
+                db.session.commit()
+                updated += len(metas)
+            click.echo(f'[backfill] {updated} updated, {failed} failed (up to koma {last_id})')
+
+    click.echo(f'[backfill] done: {updated} updated, {failed} failed')
+
+
+# --- 一括モデレーション ---
+# スパムの波などをまとめて消す・戻す。どれも ID の塊ごとに1本の UPDATE / DELETE で処理し、
+# 塊ごとにコミットする（何万件でもロックを長く持たない）
+MODERATION_CHUNK_SIZE = int(os.environ.get("MODERATION_CHUNK_SIZE", 500))
+
+
+def chunked(ids, size=MODERATION_CHUNK_SIZE):
+    ids = sorted(set(ids))
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+
+# "1, 2 3\n4" のような入力（フォームのテキストエリア・複数指定）を ID のリストにする
+def parse_ids(values):
+    ids = []
+    for value in values:
+        for part in re.split(r'[\s,]+', value or ''):
+            if part:
+                ids.append(int(part))
+    return ids
+
+
+def bulk_update(model, criteria, **values):
+    stmt = update(model).where(*criteria).values(**values).execution_options(synchronize_session=False)
+    return db.session.execute(stmt).rowcount
+
+
+# コミックを消すとコマもまとめて消える（コミックとコマに同じ削除時刻を入れる）
+def soft_delete_comics(comic_ids, chunk_size=MODERATION_CHUNK_SIZE):
+    count = 0
+    for chunk in chunked(comic_ids, chunk_size):
+        now = datetime.utcnow()
+        count += bulk_update(Comic, [Comic.id.in_(chunk), Comic.is_deleted == 0], is_deleted=1, deleted_at=now)
+        bulk_update(Koma, [Koma.comic_id.in_(chunk), Koma.is_deleted == 0], is_deleted=1, deleted_at=now)
+        recount_comics(Comic.id.in_(chunk))
+        db.session.commit()
+    return count
+
+
+# アップロードに失敗したコマと、画像を掃除済みのコマは戻せない
+KOMA_RESTORABLE = Koma.status.notin_([KOMA_FAILED, KOMA_EXPIRED])
+
+
+# 条件に合う削除済みのコマを、コミックの空き（max_koma - koma_count）の分だけコマ番号順に戻す
+# 空きを超える分は削除済みのまま残す（上限は投稿と同じくサーバー側で守る）。戻した数を返す
+def restore_koma_rows(*criteria):
+    ranked = (
+        select(
+            Koma.id,
+            func.row_number().over(partition_by=Koma.comic_id, order_by=Koma.frame_number).label('rank'),
+            (Comic.max_koma - Comic.koma_count).label('free'),
+        )
+        .join(Comic, Comic.id == Koma.comic_id)
+        .where(Koma.is_deleted == 1, KOMA_RESTORABLE, *criteria)
+        .subquery()
+    )
+    allowed = select(ranked.c.id).where(or_(ranked.c.free.is_(None), ranked.c.rank <= ranked.c.free))
+    return bulk_update(Koma, [Koma.id.in_(allowed)], is_deleted=0, deleted_at=None)
+
+
+# コミックを戻すときは、コミックごと消したときに一緒に消えたコマだけを戻す
+# （その前に1コマずつ消されていたコマは削除時刻が違うので戻さない）
+def restore_comics(comic_ids, chunk_size=MODERATION_CHUNK_SIZE):
+    count = 0
+    for chunk in chunked(comic_ids, chunk_size):
+        db.session.execute(select(Comic.id).where(Comic.id.in_(chunk)).with_for_update())
+        restore_koma_rows(Koma.comic_id.in_(chunk), Comic.is_deleted == 1, Koma.deleted_at == Comic.deleted_at)
+        count += bulk_update(Comic, [Comic.id.in_(chunk), Comic.is_deleted == 1], is_deleted=0, deleted_at=None)
+        recount_comics(Comic.id.in_(chunk))
+        db.session.commit()
+    return count
+
+
+def soft_delete_komas(koma_ids, chunk_size=MODERATION_CHUNK_SIZE):
+    count = 0
+    for chunk in chunked(koma_ids, chunk_size):
+        count += bulk_update(Koma, [Koma.id.in_(chunk), Koma.is_deleted == 0], is_deleted=1, deleted_at=datetime.utcnow())
+        recount_comics(Comic.id.in_(select(Koma.comic_id).where(Koma.id.in_(chunk))))
+        db.session.commit()
+    return count
+
+
+# 削除済みのコミックのコマは戻さない（先にコミックを戻す）。満タンのコミックには戻さない
+def restore_komas(koma_ids, chunk_size=MODERATION_CHUNK_SIZE):
+    count = 0
+    for chunk in chunked(koma_ids, chunk_size):
+        # 空きの計算と戻す UPDATE の間に投稿が入らないよう、コミックの行をロックしておく
+        db.session.execute(
+            select(Comic.id).where(Comic.id.in_(select(Koma.comic_id).where(Koma.id.in_(chunk)))).with_for_update()
+        )
+        count += restore_koma_rows(Koma.id.in_(chunk), Comic.is_deleted == 0)
+        recount_comics(Comic.id.in_(select(Koma.comic_id).where(Koma.id.in_(chunk))))
+        db.session.commit()
+    return count
+
+
+# 行を消したあとにストレージの画像と spool_chunk のアップロード待ちの画像を消す
+# （コミット前に消すと、ロールバックしたときに画像だけ無くなるので必ずコミット後）
+# 画像は STORAGE_DELETE_BATCH 件ずつ。失敗しても行はもう無いので、ログに残して続ける
+STORAGE_DELETE_BATCH = 100
+
+
+# まだどこかのコマが指している画像は消さない（同じ画像を使い回しているコマがある）
+def unreferenced_keys(keys):
+    keys = sorted(set(keys))
+    used = set()
+    for i in range(0, len(keys), MODERATION_CHUNK_SIZE):
+        used.update(db.session.scalars(
+            select(Koma.storage_key).where(Koma.storage_key.in_(keys[i:i + MODERATION_CHUNK_SIZE]))
+        ))
+    return [key for key in keys if key not in used]
+
+
+def delete_storage_keys(keys):
+    keys = unreferenced_keys(keys)
+    deleted = 0
+    for i in range(0, len(keys), STORAGE_DELETE_BATCH):
+        batch = keys[i:i + STORAGE_DELETE_BATCH]
+        try:
+            deleted += storage.delete_many(batch)
+        except Exception:
+            app.logger.exception('storage delete failed: %s', batch)
+    return deleted
+
+
+def discard_koma_files(files):
+    deleted = delete_storage_keys([key for key, _ in files if key])
+    for _, spool_path in files:
+        if spool_path:
+            discard_spool(spool_path)
+    return deleted
+
+
+# コミックと、そのコマ・通知を消す（コミットは呼び出し側）。(件数, 画像) を返す
+def delete_comic_rows(comic_ids):
+    files = db.session.execute(
+        select(Koma.storage_key, Koma.spool_path).where(Koma.comic_id.in_(comic_ids))
+    ).all()
+    db.session.execute(delete(NotificationOutbox).where(NotificationOutbox.comic_id.in_(comic_ids)))
+    db.session.execute(delete(Koma).where(Koma.comic_id.in_(comic_ids)))
+    count = db.session.execute(delete(Comic).where(Comic.id.in_(comic_ids))).rowcount
+    return count, [(row.storage_key, row.spool_path) for row in files]
+
+
+# コマと、その通知を消す（コミットと再計算は呼び出し側）。(件数, コミックID, 画像) を返す
+def delete_koma_rows(koma_ids):
+    rows = db.session.execute(
+        select(Koma.comic_id, Koma.storage_key, Koma.spool_path).where(Koma.id.in_(koma_ids))
+    ).all()
+    db.session.execute(delete(NotificationOutbox).where(NotificationOutbox.koma_id.in_(koma_ids)))
+    count = db.session.execute(delete(Koma).where(Koma.id.in_(koma_ids))).rowcount
+    comic_ids = sorted({row.comic_id for row in rows})
+    return count, comic_ids, [(row.storage_key, row.spool_path) for row in rows]
+
+
+def hard_delete_comics(comic_ids, chunk_size=MODERATION_CHUNK_SIZE):
+    count, files = 0, []
+    for chunk in chunked(comic_ids, chunk_size):
+        deleted, chunk_files = delete_comic_rows(chunk)
+        db.session.commit()
+        count += deleted
+        files.extend(chunk_files)
+    return count, discard_koma_files(files)
+
+
+def hard_delete_komas(koma_ids, chunk_size=MODERATION_CHUNK_SIZE):
+    count, files = 0, []
+    for chunk in chunked(koma_ids, chunk_size):
+        deleted, comic_ids, chunk_files = delete_koma_rows(chunk)
+        recount_comics(Comic.id.in_(comic_ids))
+        db.session.commit()
+        count += deleted
+        files.extend(chunk_files)
+    return count, discard_koma_files(files)
+
+
+# (action, 対象) ごとの処理。hard-delete は (件数, 消した画像数) を返す
+MODERATION_ACTIONS = {
+    ('delete', 'comic'): soft_delete_comics,
+    ('delete', 'koma'): soft_delete_komas,
+    ('restore', 'comic'): restore_comics,
+    ('restore', 'koma'): restore_komas,
+    ('hard-delete', 'comic'): hard_delete_comics,
+    ('hard-delete', 'koma'): hard_delete_komas,
+}
+
+
+def run_moderation(action, comic_ids=(), koma_ids=(), chunk_size=MODERATION_CHUNK_SIZE):
+    touched = set(comic_ids) | komas_comic_ids(koma_ids)
+    result = {}
+    for target, ids in (('comic', comic_ids), ('koma', koma_ids)):
+        if not ids:
+            continue
+        done = MODERATION_ACTIONS[(action, target)](ids, chunk_size)
+        if action == 'hard-delete':
+            done, images = done
+            result['images_deleted'] = result.get('images_deleted', 0) + images
+        result[f'{target}s'] = done
+    # 消したものは古いページとしても出さない（戻したときは描き直すまで古いものを出してよい）
+    invalidate_comics(touched, keep_stale=(action == 'restore'))
+    rebuild_snapshots(touched)
+    return result
+
+
+def komas_comic_ids(koma_ids):
+    comic_ids = set()
+    for chunk in chunked(koma_ids):
+        comic_ids.update(db.session.scalars(select(Koma.comic_id).where(Koma.id.in_(chunk))))
+    return comic_ids
+
+
+@app.cli.group('moderate')
+def moderate_cli():
+    """コミック・コマの一括削除・復元"""
+
+
+def moderation_command(action, help_text):
+    @moderate_cli.command(action, help=help_text)
+    @click.option('--comic', 'comic_ids', type=int, multiple=True, help='コミックID（複数指定可）')
+    @click.option('--koma', 'koma_ids', type=int, multiple=True, help='コマID（複数指定可）')
+    @click.option('--ids-from', type=click.File('r'), help='ID を1行ずつ書いたファイル（--comic / --koma と同じ扱い）')
+    @click.option('--target', type=click.Choice(['comic', 'koma']), default='comic', show_default=True,
+                  help='--ids-from の ID の種類')
+    @click.option('--chunk-size', default=MODERATION_CHUNK_SIZE, show_default=True, help='1トランザクションで処理するID数')
+    @click.option('--yes', is_flag=True, help='hard-delete の確認を省略する')
+    def command(comic_ids, koma_ids, ids_from, target, chunk_size, yes):
+        comic_ids, koma_ids = list(comic_ids), list(koma_ids)
+        if ids_from:
+            (comic_ids if target == 'comic' else koma_ids).extend(parse_ids(ids_from))
+        if not comic_ids and not koma_ids:
+            raise click.UsageError('--comic / --koma / --ids-from のどれかを指定してください')
+        if action == 'hard-delete' and not yes:
+            click.confirm(f'{len(comic_ids)} コミック / {len(koma_ids)} コマを完全に削除します。よろしいですか？', abort=True)
+        result = run_moderation(action, comic_ids, koma_ids, chunk_size)
+        click.echo(f'[moderate] {action}: {result}')
+    return command
+
+
+moderation_command('delete', 'ソフトデリート（is_deleted=1）')
+moderation_command('restore', 'ソフトデリートを戻す')
+moderation_command('hard-delete', '行と画像を完全に削除する（元に戻せない）')
+
+
+# 同じ画像の重複状況。使い回しで節約できた容量と、まだ別々に保存されている重複を出す
+# （古いコマのハッシュは `flask backfill-image-meta` で埋める）
+@app.cli.command('dedup-report')
+@click.option('--top', default=10, show_default=True, help='重複の多い画像を何件表示するか')
+def dedup_report_command(top):
+    groups = (
+        db.session.query(
+            Koma.content_sha256,
+            func.count(Koma.id).label('komas'),
+            func.count(func.distinct(Koma.storage_key)).label('assets'),
+            func.max(Koma.bytes).label('bytes'),
+        )
+        .filter(Koma.content_sha256.isnot(None), Koma.storage_key.isnot(None))
+        .group_by(Koma.content_sha256)
+        .having(func.count(Koma.id) > 1)
+        .all()
+    )
+    saved = sum((group.komas - group.assets) * (group.bytes or 0) for group in groups)
+    redundant = sum((group.assets - 1) * (group.bytes or 0) for group in groups)
+    unhashed = Koma.query.filter(Koma.content_sha256.is_(None), Koma.storage_key.isnot(None)).count()
+
+    mb = lambda n: f'{n / 1024 / 1024:.1f} MB'
+    click.echo(f'[dedup] {len(groups)} image(s) used by more than one koma')
+    click.echo(f'[dedup] saved by reuse: {mb(saved)} ({sum(group.komas - group.assets for group in groups)} upload(s) skipped)')
+    click.echo(f'[dedup] duplicate copies still stored: {mb(redundant)} ({sum(group.assets - 1 for group in groups)} asset(s))')
+    if unhashed:
+        click.echo(f'[dedup] {unhashed} koma(s) have no hash yet; run `flask backfill-image-meta`')
+    for group in sorted(groups, key=lambda group: group.komas, reverse=True)[:top]:
+        click.echo(f'        {group.content_sha256[:12]}  {group.komas} koma(s) / {group.assets} asset(s)')
+
+
+# --- 完全削除（旧 scripts/admin_delete.py） ---
+# 指定したコミック・コマを1トランザクションで消し、残ったコマの番号を 1 から振り直す。
+# 画像の削除とDBのメンテナンス（VACUUM）は最後に1回だけ行う。
+#   flask purge --koma 23 --koma 24 --dry-run
+#   flask purge --comic 10 --yes
+def renumber_frames(comic_ids):
+    if not comic_ids:
+        return 0
+    target = Koma.comic_id.in_(comic_ids)
+    # 一意制約 (comic_id, frame_number) に途中でぶつからないよう、いったん負の番号に逃がしてから
+    # ウィンドウ関数で振り直す（負にしたので降順が元の並び順）
+    bulk_update(Koma, [target], frame_number=-Koma.frame_number)
+    ranked = (
+        select(
+            Koma.id,
+            func.row_number().over(
+                partition_by=Koma.comic_id, order_by=Koma.frame_number.desc()
+            ).label('new_number'),
+        )
+        .where(target)
+        .subquery()
+    )
+    count = db.session.execute(
+        update(Koma)
+        .where(Koma.id == ranked.c.id)
+        .values(frame_number=ranked.c.new_number)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    # 採番カウンタも振り直した最大値に合わせる（recount_comics は下げないのでここで直す）
+    max_frame = (
+        select(func.coalesce(func.max(Koma.frame_number), 0))
+        .where(Koma.comic_id == Comic.id)
+        .scalar_subquery()
+    )
+    bulk_update(Comic, [Comic.id.in_(comic_ids)], last_frame_number=max_frame, **comic_version_values())
+    return count
+
+
+# トランザクションの外で回す（VACUUM はトランザクション内では実行できない）
+def run_maintenance():
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        if conn.dialect.name == 'postgresql':
+            for table in ('comic', 'koma', 'notification_outbox'):
+                conn.exec_driver_sql(f'VACUUM ANALYZE {table}')
+        elif conn.dialect.name == 'sqlite':
+            conn.exec_driver_sql('VACUUM')
+
+
+@app.cli.command('purge')
+@click.option('--comic', 'comic_ids', type=int, multiple=True, help='コミックID（複数指定可。コマもまとめて消す）')
+@click.option('--koma', 'koma_ids', type=int, multiple=True, help='コマID（複数指定可）')
+@click.option('--renumber/--no-renumber', default=True, show_default=True, help='残ったコマの番号を振り直す')
+@click.option('--maintenance/--no-maintenance', default=True, show_default=True, help='最後に VACUUM する')
+@click.option('--dry-run', is_flag=True, help='消える件数を表示するだけでロールバックする')
+@click.option('--yes', is_flag=True, help='確認を省略する')
+def purge_command(comic_ids, koma_ids, renumber, maintenance, dry_run, yes):
+    comic_ids, koma_ids = sorted(set(comic_ids)), sorted(set(koma_ids))
+    if not comic_ids and not koma_ids:
+        raise click.UsageError('--comic か --koma を指定してください')
+    if not dry_run and not yes:
+        click.confirm(f'{len(comic_ids)} コミック / {len(koma_ids)} コマを完全に削除します。よろしいですか？', abort=True)
+
+    touched = komas_comic_ids(koma_ids)
+    # 番号を振り直すコミックを先にロックしておく（同時投稿の採番と食い違わないように）
+    renumber_ids = sorted(touched - set(comic_ids))
+    for chunk in chunked(renumber_ids):
+        db.session.query(Comic.id).filter(Comic.id.in_(chunk)).with_for_update().all()
+
+    try:
+        comics, komas, files = 0, 0, []
+        for chunk in chunked(comic_ids):
+            deleted, chunk_files = delete_comic_rows(chunk)
+            comics += deleted
+            files.extend(chunk_files)
+        for chunk in chunked(koma_ids):
+            deleted, _, chunk_files = delete_koma_rows(chunk)
+            komas += deleted
+            files.extend(chunk_files)
+
+        renumbered = renumber_frames(renumber_ids) if renumber else 0
+        for chunk in chunked(renumber_ids):
+            recount_comics(Comic.id.in_(chunk))
+
+        keys = [key for key, _ in files if key]
+        click.echo(f'[purge] comics={comics} komas={komas} renumbered={renumbered} images={len(keys)}')
+        if dry_run:
+            for key in keys[:20]:
+                click.echo(f'[purge]   {key}')
+            if len(keys) > 20:
+                click.echo(f'[purge]   ... and {len(keys) - 20} more')
+            db.session.rollback()
+            click.echo('[purge] dry run: rolled back')
+            return
+        db.session.commit()
+        invalidate_comics(touched | set(comic_ids), keep_stale=False)
+        rebuild_snapshots(touched | set(comic_ids))
+    except Exception:
+        db.session.rollback()
+        raise
+
+    click.echo(f'[purge] deleted {discard_koma_files(files)} image(s) from storage')
+    if maintenance:
+        run_maintenance()
+        click.echo('[purge] maintenance done')
+
+
+# --- ストレージの掃除 ---
+# 1) どのコマからも参照されていない画像（DB のコミットに失敗した、コミックごと消した など）
+#    manga_relay/ 以下をページングしながら読み、ページごとに DB と突き合わせて
+#    GC_ORPHAN_GRACE_HOURS より古いものを消す
+# 2) 削除して GC_DELETED_GRACE_DAYS 日たったコマの画像
+#    コマは番号の穴として残し、status を expired にして storage_key を外す
+# どちらも STORAGE_DELETE_BATCH 件ずつ消し、消した件数とバイト数を返す
+GC_PAGE_SIZE = 500
+
+
+def gc_orphan_assets(prefix, cutoff, dry_run=False):
+    stats = {'scanned': 0, 'orphans': 0, 'orphan_bytes': 0}
+    page = []
+
+    def flush_page():
+        keys = [asset['key'] for asset in page]
+        referenced = set(db.session.scalars(select(Koma.storage_key).where(Koma.storage_key.in_(keys))))
+        orphans = [asset for asset in page if asset['key'] not in referenced and asset['created_at'] < cutoff]
+        if orphans and not dry_run:
+            delete_storage_keys([asset['key'] for asset in orphans])
+        stats['orphans'] += len(orphans)
+        stats['orphan_bytes'] += sum(asset['bytes'] or 0 for asset in orphans)
+        page.clear()
+
+    for asset in storage.list(prefix):
+        stats['scanned'] += 1
+        page.append(asset)
+        if len(page) >= GC_PAGE_SIZE:
+            flush_page()
+    if page:
+        flush_page()
+    return stats
+
+
+def gc_deleted_komas(cutoff, comic_id=None, dry_run=False):
+    stats = {'expired': 0, 'expired_bytes': 0}
+    query = (
+        db.session.query(Koma.id, Koma.storage_key, Koma.bytes)
+        .filter(
+            Koma.is_deleted == 1,
+            Koma.deleted_at < cutoff,
+            Koma.storage_key.isnot(None),
+            Koma.status != KOMA_EXPIRED,
+        )
+        .order_by(Koma.id)
+    )
+    if comic_id:
+        query = query.filter(Koma.comic_id == comic_id)
+
+    # id 順に GC_PAGE_SIZE 件ずつ（1ページごとにコミットしてから画像を消す）
+    last_id = 0
+    while True:
+        rows = query.filter(Koma.id > last_id).limit(GC_PAGE_SIZE).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        stats['expired'] += len(rows)
+        stats['expired_bytes'] += sum(row.bytes or 0 for row in rows)
+        if dry_run:
+            continue
+        bulk_update(
+            Koma, [Koma.id.in_([row.id for row in rows])],
+            status=KOMA_EXPIRED, storage_key=None, image_filename=None,
+        )
+        db.session.commit()
+        delete_storage_keys([row.storage_key for row in rows])
+    return stats
+
+
+def gc_storage(comic_id=None, orphan_grace_hours=GC_ORPHAN_GRACE_HOURS,
+               deleted_grace_days=GC_DELETED_GRACE_DAYS, dry_run=False):
+    now = datetime.utcnow()
+    prefix = f'manga_relay/{comic_id}/' if comic_id else 'manga_relay/'
+    stats = gc_deleted_komas(now - timedelta(days=deleted_grace_days), comic_id, dry_run)
+    # 2) を先に回す（expired にした画像は 2) で消えるので 1) で二重に数えない）
+    stats.update(gc_orphan_assets(prefix, now - timedelta(hours=orphan_grace_hours), dry_run))
+    stats['reclaimed_bytes'] = stats['orphan_bytes'] + stats['expired_bytes']
+    return stats
+
+
+@app.cli.command('gc-storage')
+@click.option('--comic-id', type=int, help='対象のコミックID（省略時は manga_relay/ 以下すべて）')
+@click.option('--orphan-grace-hours', default=GC_ORPHAN_GRACE_HOURS, show_default=True,
+              help='参照されていない画像をこの時間より古ければ消す')
+@click.option('--deleted-grace-days', default=GC_DELETED_GRACE_DAYS, show_default=True,
+              help='削除したコマの画像をこの日数たったら消す')
+@click.option('--dry-run', is_flag=True, help='消す対象を数えるだけで何も消さない')
+def gc_storage_command(comic_id, orphan_grace_hours, deleted_grace_days, dry_run):
+    stats = gc_storage(comic_id, orphan_grace_hours, deleted_grace_days, dry_run)
+    mb = stats['reclaimed_bytes'] / 1024 / 1024
+    click.echo(
+        f"[gc] {'would reclaim' if dry_run else 'reclaimed'} {mb:.1f} MB: "
+        f"{stats['orphans']} orphan(s) of {stats['scanned']} asset(s), "
+        f"{stats['expired']} deleted koma image(s)"
+    )
+
+
 # 管理ページ
 @app.route('/admin/list')
 @basic_auth_required(ADMIN_USER, ADMIN_PASS) # basic認証 これでURLを知っていてもユーザー名とパスが必要
 def admin_list():
-    comics = Comic.query.order_by(Comic.started_at.desc()).all()
-    return render_template("admin_list.html", comics=comics, Koma=Koma)
+    cursor = decode_feed_cursor(request.args.get('cursor'))
+    rows = admin_comics_query(cursor).all()
+    next_cursor = None
+    if len(rows) > ADMIN_PAGE_SIZE:
+        rows = rows[:ADMIN_PAGE_SIZE]
+        next_cursor = encode_feed_cursor(rows[-1].Comic)
+    return render_template("admin_list.html", rows=rows, next_cursor=next_cursor)
+
+
+# 削除済みも含めて新しい順。コマ一覧は開いたときに admin_comic_komas で取る
+def admin_comics_query(cursor=None, limit=ADMIN_PAGE_SIZE):
+    latest_koma = aliased(Koma, name='latest_koma')
+    query = (
+        db.session.query(Comic, latest_koma)
+        .outerjoin(latest_koma, latest_koma.id == Comic.latest_koma_id)
+    )
+    if cursor:
+        query = query.filter(tuple_(Comic.started_at, Comic.id) < tuple_(*cursor))
+    return query.order_by(Comic.started_at.desc(), Comic.id.desc()).limit(limit + 1)
+
 
+# 管理ページでコミックを開いたときのコマ一覧（削除済みも含む）
+@app.route('/admin/comic/<int:comic_id>/komas')
+@basic_auth_required(ADMIN_USER, ADMIN_PASS)
+def admin_comic_komas(comic_id):
+    comic = Comic.query.get_or_404(comic_id)
+    komas = Koma.query.filter(Koma.comic_id == comic.id).order_by(Koma.frame_number).all()
+    html = render_template('_admin_koma_grid.html', komas=komas)
+    return jsonify(html=html, count=len(komas))
 
-# for_url()で画像表示しているため不要となった-------
-# @app.route('/uploads/<path:filename>')
-# def uploaded_file(filename):
-#   return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
-# ---------------------------------------------
+
+# STORAGE_BACKEND=local のときの画像配信（cloudinary のときは使わない）
+@app.route('/uploads/<path:filename>')
+def uploaded_file(filename):
+    if app.config['STORAGE_BACKEND'] != 'local':
+        abort(404)
+    return send_from_directory(app.config['STORAGE_LOCAL_ROOT'], filename)
 
 @app.route('/admin/comic/<int:comic_id>')
 @basic_auth_required(ADMIN_USER, ADMIN_PASS)
@@ -216,23 +1419,51 @@ def admin_comic_detail(comic_id):
 @basic_auth_required(ADMIN_USER, ADMIN_PASS)
 def delete_comic(comic_id):
     comic = Comic.query.get_or_404(comic_id)
-    # コミックの is_deleted を ON にする
-    comic.is_deleted = 1
-    # 関連するコマも全部削除
-    for koma in comic.komas:
-        koma.is_deleted = 1
-    db.session.commit()
+    # コミックと関連するコマをまとめて is_deleted=1 にする
+    soft_delete_comics([comic.id])
+    invalidate_comics([comic.id], keep_stale=False)
+    rebuild_snapshots([comic.id])
     # flash(f'コミック "{comic.title}" をソフトデリートしました。', 'success')
-    return redirect(url_for('admin_list'))
+    return redirect(request.referrer or url_for('admin_list'))
 
 @app.route('/admin/delete/koma/<int:koma_id>', methods=['POST'])
 @basic_auth_required(ADMIN_USER, ADMIN_PASS)
 def delete_koma(koma_id):
     koma = Koma.query.get_or_404(koma_id)
-    koma.is_deleted = 1
-    db.session.commit()
+    soft_delete_komas([koma.id])
+    invalidate_comics([koma.comic_id], keep_stale=False)
+    rebuild_snapshots([koma.comic_id])
     # flash(f'コマ {koma.frame_number} を削除（ソフトデリート）しました。', 'success')
-    return redirect(url_for('admin_list'))
+    return redirect(request.referrer or url_for('admin_list'))
+
+# 一括モデレーション（管理ページのフォーム、または JSON で叩く）
+# comic_ids / koma_ids は複数指定か、カンマ・空白・改行区切りの文字列
+@app.route('/admin/bulk', methods=['POST'])
+@basic_auth_required(ADMIN_USER, ADMIN_PASS)
+def admin_bulk():
+    data = request.get_json(silent=True) if request.is_json else None
+    if data is not None:
+        action = data.get('action')
+        comic_values, koma_values = (
+            [str(v) for v in value] if isinstance(value, list) else [str(value or '')]
+            for value in (data.get('comic_ids'), data.get('koma_ids'))
+        )
+    else:
+        action = request.form.get('action')
+        comic_values, koma_values = request.form.getlist('comic_ids'), request.form.getlist('koma_ids')
+
+    if action not in ('delete', 'restore', 'hard-delete'):
+        abort(400)
+    try:
+        comic_ids, koma_ids = parse_ids(comic_values), parse_ids(koma_values)
+    except ValueError:
+        abort(400)
+
+    result = run_moderation(action, comic_ids, koma_ids)
+    if data is not None:
+        return jsonify(action=action, **result)
+    return redirect(request.referrer or url_for('admin_list'))
+
 
 # ----------
 
@@ -261,19 +1492,302 @@ def admin_dm():
     return render_template("admin_dm.html", hide_dm_link=True)
 
 
+# 一覧用のサマリー
+# Comic の非正規化カラムと最新コマを1クエリで返す（koma テーブルの集計はしない）
+# 行は row.Comic / row.latest_koma / row.koma_count / row.is_full で参照できる
+# 並びは (started_at, id) の降順で、cursor より後ろを limit 件だけ返すキーセットページング
+def feed_query(cursor=None, limit=FEED_PAGE_SIZE):
+    latest_koma = aliased(Koma, name='latest_koma')
+    query = (
+        db.session.query(
+            Comic,
+            latest_koma,
+            Comic.koma_count.label('koma_count'),
+            Comic.is_full.label('is_full'),
+        )
+        .outerjoin(latest_koma, latest_koma.id == Comic.latest_koma_id)
+        .filter(Comic.is_deleted == 0)
+    )
+    if cursor:
+        query = query.filter(tuple_(Comic.started_at, Comic.id) < tuple_(*cursor))
+    # 1件多めに取って次のページがあるかを判定する
+    return query.order_by(Comic.started_at.desc(), Comic.id.desc()).limit(limit + 1)
+
+
+def comic_summaries(cursor=None, limit=FEED_PAGE_SIZE):
+    rows = feed_query(cursor, limit).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_feed_cursor(rows[-1].Comic)
+    return rows, next_cursor
+
+
+# カーソルは「started_at の ISO 文字列 + '_' + id」
+def encode_feed_cursor(comic):
+    return f"{comic.started_at.isoformat()}_{comic.id}"
+
+
+def decode_feed_cursor(value):
+    if not value:
+        return None
+    try:
+        started_at, comic_id = value.rsplit('_', 1)
+        return datetime.fromisoformat(started_at), int(comic_id)
+    except ValueError:
+        abort(400)
+
+
+# --- 条件付き GET（ETag / Last-Modified） ---
+# トップページと詳細ページは version だけを1回読み、変わっていなければ描かずに 304 を返す
+# ETag には version のほか、描き分けに効くもの（デプロイ・DPR・Save-Data）も入れる
+# Heroku の dyno metadata があればリリース番号、なければテンプレートと app.py の更新時刻
+def release_tag():
+    release = os.environ.get("HEROKU_RELEASE_VERSION")
+    if release:
+        return release
+    paths = [__file__] + [entry.path for entry in os.scandir(os.path.join(basedir, 'templates'))]
+    return str(int(max(os.path.getmtime(path) for path in paths)))
+
+
+ETAG_RELEASE = release_tag()
+PageVersion = namedtuple('PageVersion', 'version updated_at')
+
+
+def state_versions(*keys):
+    rows = db.session.execute(
+        select(AppState.key, AppState.version, AppState.updated_at).where(AppState.key.in_(keys))
+    ).all()
+    found = {row.key: PageVersion(row.version, row.updated_at) for row in rows}
+    return {key: found.get(key, PageVersion(0, None)) for key in keys}
+
+
+def latest(*values):
+    values = [value for value in values if value]
+    return max(values) if values else None
+
+
+def conditional_page(etag, last_modified, footer_version, render, tags):
+    # flash は一度出したら消えるので、残っている間は毎回描く（検証子もつけず、キャッシュも使わない）
+    if '_flashes' in session:
+        return render()
+    etag = f"{etag}-{ETAG_RELEASE}-d{client_dpr():g}-s{int(wants_save_data())}"
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(etag)
+    else:
+        since = request.if_modified_since
+        fresh = bool(since and last_modified
+                     and last_modified.replace(microsecond=0, tzinfo=timezone.utc) <= since)
+    if fresh:
+        response = app.response_class(status=304)
+    else:
+        def render_page():
+            # フッターのキャッシュが ETag の version より古ければ読み直してから描く
+            if _footer_cache[0] != footer_version:
+                invalidate_footer_cache()
+            return render()
+
+        entry = cached_page(etag, last_modified, tags, render_page)
+        response = make_response(entry['body'])
+        # 古いものを返すときは、その時点の検証子をつける（次のリクエストでまた確かめる）
+        etag = entry['etag']
+        last_modified = datetime.fromisoformat(entry['last_modified']) if entry['last_modified'] else None
+    response.set_etag(etag, weak=True)
+    if last_modified:
+        response.last_modified = last_modified
+    # ブラウザには毎回確かめてもらう（変わっていなければ 304 で本体は送らない）
+    response.cache_control.no_cache = True
+    return response
+
+
+# --- ページ・カードのキャッシュ（cache.py） ---
+# 描いたページは ETag と一緒に持ち、ETag が今の version と同じときだけそのまま返す
+# （invalidate が届かなかった古いものを返さないように）
+# version が変わったときは、描き直すリクエストを1つに絞り（lock）、ほかは古いものがあればそれを返す。
+# 無ければ CACHE_WAIT_SECONDS まで描き終わるのを待つ
+# 投稿ではコミックのタグを stale にし、削除では古いものも残さず消す（invalidate_comics）
+CACHE_TTL = int(os.environ.get("CACHE_TTL", 3600))
+CACHE_LOCK_SECONDS = 10
+CACHE_WAIT_SECONDS = float(os.environ.get("CACHE_WAIT_SECONDS", 2))
+CACHE_WAIT_STEP = 0.05
+FEED_TAG = 'feed'
+
+
+def comic_tag(comic_id):
+    return f"comic:{comic_id}"
+
+
+# コミックのページ・カードと、トップページを捨てる（コミットしてから呼ぶ）
+# トップページの version もここで上げる
+def invalidate_comics(comic_ids, keep_stale=True):
+    bump_feed_version()
+    try:
+        page_cache.invalidate([comic_tag(comic_id) for comic_id in comic_ids] + [FEED_TAG], keep_stale)
+    except Exception:
+        # キャッシュが落ちていても投稿・削除は済んでいる（ETag の確認で古いものは返らない）
+        app.logger.exception('cache invalidate failed: %s', comic_ids)
+
+
+def page_entry(etag, last_modified, body):
+    return {'etag': etag, 'last_modified': last_modified.isoformat() if last_modified else None, 'body': body}
+
+
+def cached_page(etag, last_modified, tags, render):
+    key = f"page:{request.full_path}:d{client_dpr():g}:s{int(wants_save_data())}"
+    hit = page_cache.get(key)
+    if hit and not hit[1] and hit[0]['etag'] == etag:
+        return hit[0]
+    if not page_cache.lock(key, CACHE_LOCK_SECONDS):
+        if hit:
+            return hit[0]
+        deadline = time.monotonic() + CACHE_WAIT_SECONDS
+        while time.monotonic() < deadline:
+            time.sleep(CACHE_WAIT_STEP)
+            hit = page_cache.get(key)
+            if hit and hit[0]['etag'] == etag:
+                return hit[0]
+        # 待っても描き終わらなければ自分で描く（キャッシュには入れない）
+        return page_entry(etag, last_modified, render())
+    try:
+        entry = page_entry(etag, last_modified, render())
+        page_cache.set(key, entry, tags, CACHE_TTL)
+        return entry
+    finally:
+        page_cache.unlock(key)
+
+
+# index.html と「もっと見る」のカード。Comic.version ごとに持つ
+@app.template_global()
+def comic_card(row):
+    comic = row.Comic
+    # 静的サイトへの書き出しでは画像の URL が変わるのでキャッシュを使わない
+    if g.get('static_export'):
+        return Markup(render_template('_comic_card.html', row=row))
+    key = f"card:{comic.id}:{comic.version}:{ETAG_RELEASE}:d{client_dpr():g}:s{int(wants_save_data())}"
+    hit = page_cache.get(key)
+    if hit and not hit[1]:
+        return Markup(hit[0])
+    html = render_template('_comic_card.html', row=row)
+    page_cache.set(key, html, [comic_tag(comic.id)], CACHE_TTL)
+    return Markup(html)
+
+
 # --- index ルート (一覧表示と投稿フォーム) ---
 @app.route('/')
 def index():
-    comics = Comic.query.filter_by(is_deleted=0).order_by(Comic.started_at.desc()).all()
-    
-    for comic in comics:
-        comic.koma_count = Koma.query.filter_by(
-            comic_id=comic.id,
-            is_deleted=0
-        ).count()
-    
-    return render_template('index.html', comics=comics, db=db, Koma=Koma)
+    versions = state_versions(FEED_STATE, FOOTER_STATE)
+
+    def render():
+        cursor = decode_feed_cursor(request.args.get('cursor'))
+        comics, next_cursor = comic_summaries(cursor)
+        return render_template('index.html', comics=comics, next_cursor=next_cursor)
+
+    feed, footer = versions[FEED_STATE], versions[FOOTER_STATE]
+    return conditional_page(
+        f"feed-{feed.version}-f{footer.version}",
+        latest(feed.updated_at, footer.updated_at),
+        footer.version,
+        render,
+        [FEED_TAG],
+    )
+
+
+# 「もっと見る」用: 次のページのカード HTML とカーソルを返す
+@app.route('/api/comics')
+def api_comics():
+    cursor = decode_feed_cursor(request.args.get('cursor'))
+    comics, next_cursor = comic_summaries(cursor)
+    html = ''.join(comic_card(row) for row in comics)
+    return jsonify(html=html, next_cursor=next_cursor)
 # 
+# --- コマの投稿（post_frame と分割アップロードで共通） ---
+# 投稿先のコミックを用意する（新規なら作って flush する）。(comic, 新規か, エラー) を返す
+def open_comic(comic_id_str, title, max_koma):
+    if comic_id_str == 'new' or not comic_id_str:
+        comic = Comic(title=title or '無題の漫画リレー', max_koma=max_koma or 20)
+        db.session.add(comic)
+        db.session.flush()
+        return comic, True, None
+    comic, error = find_open_comic(comic_id_str)
+    return comic, False, error
+
+
+# 投稿できる既存のコミックを探す。(comic, エラー) を返す
+def find_open_comic(comic_id_str):
+    comic = db.session.get(Comic, int(comic_id_str)) if comic_id_str.isdigit() else None
+    if not comic or comic.is_deleted:
+        return None, ("存在しない漫画IDです。", 404)
+    # 満タンなら一時保存する前に断る（最終的な判定は採番の UPDATE で行う）
+    if comic.is_full:
+        return comic, (COMIC_FULL_MESSAGE, 409)
+    return comic, None
+
+
+# SPOOL_FOLDER に置いた画像からコマを作る（コミットは呼び出し側）。(koma, エラー) を返す
+# staged なら画像はもう spool_chunk の spool_path にある（分割アップロード）
+def add_frame(comic, is_new_comic, spool_path, content_sha256, staged=False):
+    # 同じ画像の連投・二重送信は断る
+    if not is_new_comic and duplicate_in_comic(comic.id, content_sha256):
+        app.logger.info(f"[dedup] rejected duplicate in comic {comic.id}: {content_sha256}")
+        return None, (DUPLICATE_KOMA_MESSAGE, 409)
+    # 縦横はヘッダを読むだけなのでここで取っておく（アップロード待ちの枠に使う）
+    # 大きすぎる画像・展開爆弾・壊れたファイルはここで断り、worker やストレージに回さない
+    spool_file = spool_file_path(spool_path)
+    try:
+        meta = validate_image(spool_file)
+    except ImageRejected as e:
+        return None, (str(e), 400)
+    meta['bytes'] = os.path.getsize(spool_file)
+    # アップロード済みの画像と同じなら、もう一度アップロードせずにそれを指す
+    copy = find_uploaded_copy(content_sha256)
+
+    # DB 追加（画像は worker がストレージに上げて ready にする）
+    new_koma = Koma(
+        status=KOMA_PENDING,
+        spool_path=spool_path,
+        content_sha256=content_sha256,
+        **meta
+    )
+    if copy:
+        reuse_upload(new_koma, copy)
+        app.logger.info(f"[dedup] reused koma {copy.id} for comic {comic.id}")
+    elif not staged:
+        # worker は別の dyno なので画像は DB に置く（採番で行ロックを取る前に書き終えておく）
+        stage_spool(spool_path)
+    if not insert_koma(comic.id, new_koma):
+        return None, (COMIC_FULL_MESSAGE, 409)
+    return new_koma, None
+
+
+# コマ番号を振ってコマを足す。満タンなら False（最新コマと LINE 通知もここで積む）
+def insert_koma(comic_id, koma):
+    # 採番と満タン判定は1回の UPDATE でまとめて行う
+    new_frame_number = allocate_frame_number(comic_id)
+    if new_frame_number is None:
+        return False
+    koma.comic_id = comic_id
+    koma.frame_number = new_frame_number
+    db.session.add(koma)
+    db.session.flush()
+    mark_latest_koma(comic_id, koma)
+    enqueue_line_notify(comic_id, koma.id)
+    return True
+
+
+# ★★ 投稿元に戻る ★★
+def frame_location(comic_id):
+    ref = request.referrer or ""
+    if f"/comic/{comic_id}" in ref:
+        return url_for('comic_detail', comic_id=comic_id)
+    return url_for('index')
+
+
+# MAX_CONTENT_LENGTH を超えた投稿
+@app.errorhandler(413)
+def request_entity_too_large(e):
+    limit_mb = app.config['MAX_CONTENT_LENGTH'] // 1024 // 1024
+    return f'ファイルが大きすぎます（{limit_mb}MB まで）', 413
+
 # --- post ルート (コマの投稿処理) ---
 @app.route('/post', methods=['POST'])
 def post_frame():
@@ -286,6 +1800,7 @@ def post_frame():
 
     file = request.files.get('file')
     comic_id_str = request.form.get('comic_id')
+    spool_path = None
 
     try: 
         if not file or file.filename == '':
@@ -293,67 +1808,356 @@ def post_frame():
 
         if not allowed_file(file.filename):
             return '許可されていないファイル形式です', 400
-        
-        comic_id = None
-        new_frame_number = 1
-        
-        # 新規リレー
-        if comic_id_str == 'new' or not comic_id_str:
-            comic = Comic(title=title, max_koma=max_koma)
-            db.session.add(comic)
-            db.session.flush()
-            comic_id = comic.id
-        else:
-            comic_id = int(comic_id_str)
-            comic = db.session.get(Comic, comic_id)
-            if not comic:
-                return "存在しない漫画IDです。", 404
-
-            max_frame = db.session.query(func.max(Koma.frame_number)).filter(
-                Koma.comic_id == comic_id
-            ).scalar()
-            new_frame_number = (max_frame or 0) + 1
-
-        # ファイル保存
-        # ext = file.filename.rsplit('.', 1)[1].lower()
-        # filename = str(uuid.uuid4()) + '.' + ext
-        # file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-        # 保存パスもUUIDも不要になる
-        # result = cloudinary.uploader.upload(file)
-        # cloudinaryのフォルダ構成を見やすく整理して保存
-        send_line_notify(
-            f"🖊 新しいコマが投稿されたよ！\n"
-            f"{request.url_root}comic/{comic_id}"
-        )
+        # 拡張子だけでなく先頭のバイト列でも画像か確かめる
+        fmt = sniff_format(file.stream.read(SNIFF_BYTES))
+        file.stream.seek(0)
+        if fmt is None:
+            return '許可されていないファイル形式です', 400
+
+        # 同じキーでもう投稿が済んでいれば、そのときの戻り先をもう一度返す（アップロードも通知もしない）
+        idempotency, replay = claim_idempotency_key(request.form.get('idempotency_key'))
+        if replay:
+            return redirect(replay.location or url_for('index'))
+
+        comic, is_new_comic, error = open_comic(comic_id_str, title, max_koma)
+        if error:
+            return error
+        comic_id = comic.id
+
+        # いったん手元に保存して確かめてから DB に置き、アップロードは worker にまかせる
+        spool_path, content_sha256 = spool_upload(file, fmt)
+        new_koma, error = add_frame(comic, is_new_comic, spool_path, content_sha256)
+        if error:
+            db.session.rollback()
+            return error
+
+        location = frame_location(comic_id)
+        if idempotency:
+            idempotency.comic_id = comic_id
+            idempotency.koma_id = new_koma.id
+            idempotency.location = location
+        db.session.commit()
+        invalidate_comics([comic_id])
+
+        return redirect(location)
+
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"Error: {e}")
+        return "サーバーエラー", 500
+
+    finally:
+        # 作業用のファイルは消す（worker には spool_chunk で渡っている）
+        if spool_path:
+            remove_spool_file(spool_path)
+        db.session.remove()
+
+# --- 分割アップロード（大きなコマ画像） ---
+# POST /upload-sessions                : セッションを作る（size, filename と投稿フォームの項目）
+# PUT  /upload-sessions/<id>           : Content-Range: bytes <start>-<end>/<total> で続きを送る
+# GET  /upload-sessions/<id>           : どこまで受け取ったか。中断したあとはここから送り直す
+# POST /upload-sessions/<id>/finalize  : 受け取り終えた画像からコマを作る（何度呼んでも同じ結果）
+# エラーは {"error": ...}（offset がずれているときは {"error", "offset"}）で返す
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+# 投稿フォームの data-chunk-size に入れる
+app.jinja_env.globals['UPLOAD_CHUNK_SIZE'] = UPLOAD_CHUNK_SIZE
 
 
-        result = cloudinary.uploader.upload(file, folder=f"manga_relay/{comic_id}")
-        image_url = result["secure_url"]
+def upload_part_name(upload_id):
+    return f"{upload_id}.part"
 
-        # DB 追加
-        new_koma = Koma(
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(SPOOL_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# 受け付けられない画像のセッションは、受け取った分ごと消す（やり直しても結果は同じ）
+def drop_upload_session(upload_id):
+    UploadSession.query.filter_by(id=upload_id).delete(synchronize_session=False)
+    db.session.commit()
+    discard_spool(upload_part_name(upload_id))
+
+
+# 分割・直接アップロードを始める前のチェック（filename, size, comic_id）。(comic_id, エラー) を返す
+# 新規リレーなら comic_id は None（コミックは画像が届いてから作る）
+def check_upload_request():
+    size = request.form.get('size', type=int)
+    if not allowed_file(request.form.get('filename', '')):
+        return None, ('許可されていないファイル形式です', 400)
+    if not size or size <= 0:
+        return None, ('ファイルが空です', 400)
+    if size > MAX_CHUNKED_UPLOAD_BYTES:
+        limit_mb = round(MAX_CHUNKED_UPLOAD_BYTES / 1024 / 1024, 1)
+        return None, (f'ファイルが大きすぎます（{limit_mb:g}MB まで）', 413)
+
+    comic_id_str = request.form.get('comic_id')
+    if not comic_id_str or comic_id_str == 'new':
+        return None, None
+    comic, error = find_open_comic(comic_id_str)
+    return (comic.id if comic else None), error
+
+
+def upload_session_state(upload):
+    response = jsonify(
+        id=upload.id,
+        url=url_for('upload_session', upload_id=upload.id),
+        chunk_size=UPLOAD_CHUNK_SIZE,
+        offset=upload.received_bytes,
+        total=upload.total_bytes,
+        status=upload.status,
+    )
+    response.headers['Upload-Offset'] = str(upload.received_bytes)
+    return response
+
+
+@app.route('/upload-sessions', methods=['POST'])
+def create_upload_session():
+    try:
+        comic_id, error = check_upload_request()
+        if error:
+            return jsonify(error=error[0]), error[1]
+
+        upload = UploadSession(
+            id=uuid.uuid4().hex,
             comic_id=comic_id,
-            frame_number=new_frame_number,
-            image_filename=image_url
+            title=request.form.get('title'),
+            max_koma=request.form.get('max_koma', type=int),
+            total_bytes=request.form.get('size', type=int),
         )
-        db.session.add(new_koma)
+        db.session.add(upload)
         db.session.commit()
+        response = upload_session_state(upload)
+        response.status_code = 201
+        return response
+    finally:
+        db.session.remove()
 
-        # ★★ 投稿元に戻る ★★
-        ref = request.referrer or ""
-        if f"/comic/{comic_id}" in ref:
-            return redirect(url_for('comic_detail', comic_id=comic_id))
 
-        return redirect(url_for('index'))
+@app.route('/upload-sessions/<upload_id>', methods=['GET'])
+def upload_session(upload_id):
+    upload = db.get_or_404(UploadSession, upload_id)
+    return upload_session_state(upload)
+
+
+@app.route('/upload-sessions/<upload_id>', methods=['PUT'])
+def put_upload_chunk(upload_id):
+    match = CONTENT_RANGE_RE.match(request.headers.get('Content-Range', ''))
+    if not match:
+        return jsonify(error='Content-Range がありません'), 400
+    start, end, total = map(int, match.groups())
+    # 1回分は MAX_CONTENT_LENGTH までなので、ロックを取る前に読み切っておく
+    chunk = request.get_data(cache=False)
+    if len(chunk) != end - start + 1 or end >= total:
+        return jsonify(error='Content-Range と本体の大きさが合いません'), 400
+
+    try:
+        # 同じセッションへの PUT が重なっても、書く位置がずれないよう行ロックを取る
+        upload = UploadSession.query.filter_by(id=upload_id).with_for_update().first()
+        if not upload:
+            return jsonify(error='アップロードが見つかりません'), 404
+        if total != upload.total_bytes:
+            return jsonify(error='Content-Range と本体の大きさが合いません'), 400
+        if upload.status != UPLOAD_OPEN or start > upload.received_bytes:
+            return jsonify(error='送る位置がずれています', offset=upload.received_bytes), 409
+
+        # 再送で受け取り済みの部分と重なったら、その分は捨てて続きだけ書く
+        # （塊と received_bytes は同じトランザクションなので、書きかけは残らない）
+        skip = upload.received_bytes - start
+        if skip < len(chunk):
+            db.session.execute(insert(SpoolChunk).values(
+                name=upload_part_name(upload.id), offset=upload.received_bytes, data=chunk[skip:]
+            ))
+            upload.received_bytes = end + 1
+        upload.updated_at = datetime.utcnow()
+        db.session.commit()
+        return jsonify(offset=upload.received_bytes)
+    finally:
+        db.session.remove()
+
+
+@app.route('/upload-sessions/<upload_id>/finalize', methods=['POST'])
+def finalize_upload_session(upload_id):
+    spool_path = part = None
+    try:
+        upload = UploadSession.query.filter_by(id=upload_id).with_for_update().first()
+        if not upload:
+            return jsonify(error='アップロードが見つかりません'), 404
+        # 応答を受け取れなかったブラウザが呼び直したときは、前の結果をそのまま返す
+        if upload.status == UPLOAD_DONE:
+            return jsonify(koma_id=upload.koma_id, location=upload.location)
+        if upload.received_bytes != upload.total_bytes:
+            return jsonify(error='まだ全部届いていません', offset=upload.received_bytes), 409
+
+        # 受け取った塊をつなげて、形式・中身・ハッシュを手元で確かめる
+        part = load_spool(upload_part_name(upload.id))
+        with open(part, 'rb') as f:
+            fmt = sniff_format(f.read(SNIFF_BYTES))
+        if fmt is None:
+            drop_upload_session(upload_id)
+            return jsonify(error='許可されていないファイル形式です'), 400
+
+        spool_path = upload.id + '.' + EXTENSION_FOR_FORMAT[fmt]
+        os.replace(part, spool_file_path(spool_path))
+        content_sha256 = file_sha256(spool_file_path(spool_path))
+        # 塊は写さずに worker に渡す名前に付け替える（失敗したらロールバックで .part に戻る）
+        rename_spool(upload_part_name(upload.id), spool_path)
+
+        comic_id_str = str(upload.comic_id) if upload.comic_id else 'new'
+        comic, is_new_comic, error = open_comic(comic_id_str, upload.title, upload.max_koma)
+        if not error:
+            new_koma, error = add_frame(comic, is_new_comic, spool_path, content_sha256, staged=True)
+        if error:
+            db.session.rollback()
+            drop_upload_session(upload_id)
+            return jsonify(error=error[0]), error[1]
+
+        upload.status = UPLOAD_DONE
+        upload.koma_id = new_koma.id
+        upload.location = frame_location(comic.id)
+        upload.updated_at = datetime.utcnow()
+        db.session.commit()
+        invalidate_comics([comic.id])
+        # 使い回したときは worker に渡さないので、塊はここで消す
+        if new_koma.status != KOMA_PENDING:
+            discard_spool(spool_path)
+        return jsonify(koma_id=upload.koma_id, location=upload.location)
 
     except Exception as e:
         db.session.rollback()
-        app.logger.error(f"Error: {e}")
-        return "サーバーエラー", 500
+        app.logger.error(f"[upload] {upload_id}: {e}")
+        return jsonify(error='サーバーエラー'), 500
+
+    finally:
+        if part and os.path.exists(part):
+            os.remove(part)
+        if spool_path:
+            remove_spool_file(spool_path)
+        db.session.remove()
+
 
+# --- ストレージへの直接アップロード ---
+# web のプロセスに画像を通さず、ブラウザから Cloudinary（local なら PUT /uploads/direct/<token>）へ送らせる
+# POST /direct-uploads           : 送り先と署名を返す（filename, size と投稿フォームの項目）
+#                                  {"upload": storage.direct_upload の結果, "token", "finalize_url"}
+# POST /direct-uploads/finalize  : token の画像がストレージにあるか・受け付けられる画像かを確かめてコマを作る
+#                                  （token と、ストレージの応答をそのまま JSON にした upload。何度呼んでも同じ結果）
+# 送られたまま finalize されなかった画像は、どのコマからも参照されないので gc-storage が消す
+# token には投稿先などのフォームの項目も署名して入れておく（DB には何も書かない）
+direct_upload_signer = URLSafeTimedSerializer(app.secret_key, salt='direct-upload')
+app.jinja_env.globals['DIRECT_UPLOADS'] = DIRECT_UPLOADS and storage.supports_direct_upload
+
+
+@app.route('/direct-uploads', methods=['POST'])
+def create_direct_upload():
+    if not (DIRECT_UPLOADS and storage.supports_direct_upload):
+        abort(404)
+    try:
+        comic_id, error = check_upload_request()
+        if error:
+            return jsonify(error=error[0]), error[1]
     finally:
         db.session.remove()
 
+    ext = request.form['filename'].rsplit('.', 1)[1].lower()
+    upload = storage.direct_upload(DIRECT_UPLOAD_FOLDER, 'jpg' if ext == 'jpeg' else ext, DIRECT_UPLOAD_TTL)
+    token = direct_upload_signer.dumps({
+        'id': uuid.uuid4().hex,
+        'key': upload.pop('key'),
+        'comic_id': comic_id,
+        'title': request.form.get('title'),
+        'max_koma': request.form.get('max_koma', type=int),
+    })
+    return jsonify(upload=upload, token=token, finalize_url=url_for('finalize_direct_upload')), 201
+
+
+# local の直接アップロードの受け口（Cloudinary の代わり。オフラインの確認用）
+@app.route('/uploads/direct/<token>', methods=['PUT'])
+def put_direct_upload(token):
+    if not isinstance(storage, LocalStorage) or not storage.supports_direct_upload:
+        abort(404)
+    # 投稿フォームの MAX_CONTENT_LENGTH ではなく、分割アップロードと同じ上限にする
+    request.max_content_length = MAX_CHUNKED_UPLOAD_BYTES
+    try:
+        storage.accept_direct_upload(token, request.stream, DIRECT_UPLOAD_TTL, MAX_CHUNKED_UPLOAD_BYTES)
+    except BadSignature:
+        return jsonify(error='アップロードの期限が切れました'), 403
+    except FileExistsError:
+        return jsonify(error='アップロード済みです'), 409
+    except ValueError:
+        return jsonify(error='ファイルが大きすぎます'), 413
+    return '', 204
+
+
+@app.route('/direct-uploads/finalize', methods=['POST'])
+def finalize_direct_upload():
+    try:
+        payload = direct_upload_signer.loads(request.form.get('token', ''), max_age=DIRECT_UPLOAD_TTL)
+    except BadSignature:
+        return jsonify(error='アップロードの期限が切れました'), 403
+    key = payload['key']
+
+    try:
+        # 同じ token の finalize が重なっても、コマは1つだけ作って同じ結果を返す
+        idempotency, replay = claim_idempotency_key(payload['id'])
+        if replay:
+            return jsonify(koma_id=replay.koma_id, location=replay.location)
+
+        try:
+            result = json.loads(request.form.get('upload') or '{}')
+        except ValueError:
+            result = None
+        meta = storage.confirm_direct_upload(key, result if isinstance(result, dict) else {})
+        if meta is None:
+            return jsonify(error='画像が届いていません'), 400
+        # 画像のバイト列は読まない。形式・縦横はストレージの応答で確かめる（worker が画像を読んで確かめ直す）
+        try:
+            check_image(meta)
+            if (meta['bytes'] or 0) > MAX_CHUNKED_UPLOAD_BYTES:
+                raise ImageRejected('ファイルが大きすぎます')
+            comic_id_str = str(payload['comic_id']) if payload['comic_id'] else 'new'
+            comic, is_new_comic, error = open_comic(comic_id_str, payload['title'], payload['max_koma'])
+            # ストレージから受け取った時点で ready（アップロードの worker は通らない）
+            # LQIP と content_sha256 は worker があとで画像を読んで埋める（worker.complete_image_meta）
+            new_koma = Koma(
+                status=KOMA_READY,
+                storage_key=key,
+                image_filename=meta['url'],
+                width=meta['width'],
+                height=meta['height'],
+                bytes=meta['bytes'],
+                format=meta['format'],
+            )
+            if not error and not insert_koma(comic.id, new_koma):
+                error = (COMIC_FULL_MESSAGE, 409)
+        except ImageRejected as e:
+            error = (str(e), 400)
+        if error:
+            db.session.rollback()
+            # まだどのコマも指していない画像なので消してよい
+            delete_storage_keys([key])
+            return jsonify(error=error[0]), error[1]
+
+        location = frame_location(comic.id)
+        idempotency.comic_id = comic.id
+        idempotency.koma_id = new_koma.id
+        idempotency.location = location
+        db.session.commit()
+        invalidate_comics([comic.id])
+        return jsonify(koma_id=new_koma.id, location=location)
+
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"[direct-upload] {key}: {e}")
+        return jsonify(error='サーバーエラー'), 500
+
+    finally:
+        db.session.remove()
+
+
 # フッターに配置する公開用コメント
 @app.route("/footer-comment", methods=["POST"])
 def footer_comment():
@@ -369,41 +2173,271 @@ def footer_comment():
         is_public=is_public
     )
     db.session.add(comment)
+    if is_public:
+        bump_state_version(FOOTER_STATE)
     db.session.commit()
+    invalidate_footer_cache()
 
     flash("送信しました。ありがとう！", "success")
     return redirect(request.referrer or url_for("index"))
-# すべてのテンプレートのbase.html用に一括できる
-@app.context_processor
-def inject_public_comments():
+# 公開コメントに管理者の一言返信をつける（空なら返信を消す）
+@app.route('/admin/comments')
+@basic_auth_required(ADMIN_USER, ADMIN_PASS)
+def admin_comments():
     comments = (
         PublicComment.query
-        .filter_by(is_public=True)
         .order_by(PublicComment.created_at.desc())
-        .limit(5)
+        .limit(ADMIN_PAGE_SIZE)
         .all()
     )
-    return dict(public_comments=comments)
+    return render_template("admin_comments.html", comments=comments)
+
+
+@app.route('/admin/comment/<int:comment_id>/reply', methods=['POST'])
+@basic_auth_required(ADMIN_USER, ADMIN_PASS)
+def reply_comment(comment_id):
+    comment = PublicComment.query.get_or_404(comment_id)
+    comment.admin_reply = (request.form.get("reply") or "").strip() or None
+    if comment.is_public:
+        bump_state_version(FOOTER_STATE)
+    db.session.commit()
+    invalidate_footer_cache()
+    flash("返信を保存しました", "success")
+    return redirect(request.referrer or url_for("admin_comments"))
+
+
+# --- フッターの公開コメント ---
+# 最新の公開コメントはプロセスごとに持っておき、base.html がフッターを描くときだけ読む
+# （hide_dm_link のページなど、フッターを出さないページでは読まない）
+# app_state の version は FOOTER_CHECK_INTERVAL 秒に1回だけ確かめ、変わっていたら読み直す
+FOOTER_STATE = 'footer_comments'
+FOOTER_COMMENT_LIMIT = 5
+FOOTER_CHECK_INTERVAL = float(os.environ.get("FOOTER_CHECK_INTERVAL", 10))
+# セッションが閉じても読めるように、テンプレートで使う列だけをコピーして持つ
+FooterComment = namedtuple('FooterComment', 'message admin_reply created_at')
+# (version, コメント, 最後に version を確かめた時刻)。まるごと差し替えるのでロックはいらない
+_footer_cache = (None, (), 0.0)
+
+
+# 中身を変えたトランザクションの中で呼ぶ（一緒にコミットされる）
+def bump_state_version(key):
+    result = db.session.execute(
+        update(AppState)
+        .where(AppState.key == key)
+        .values(version=AppState.version + 1, updated_at=datetime.utcnow())
+    )
+    if result.rowcount == 0:
+        db.session.add(AppState(key=key, version=1))
+        db.session.flush()
+
+
+# 変更をコミットしてから、それだけの短いトランザクションで feed の version を上げる
+# （上げる前に読んだ人は新しい中身を古い version で持つだけなので、次に上がったときに描き直される）
+def bump_feed_version():
+    with db.engine.begin() as conn:
+        result = conn.execute(
+            update(AppState)
+            .where(AppState.key == FEED_STATE)
+            .values(version=AppState.version + 1, updated_at=datetime.utcnow())
+        )
+        if result.rowcount == 0:
+            conn.execute(insert(AppState).values(key=FEED_STATE, version=1, updated_at=datetime.utcnow()))
+
+
+def state_version(key):
+    return db.session.execute(select(AppState.version).where(AppState.key == key)).scalar() or 0
+
+
+# 自分のプロセスでは次の表示ですぐ読み直す（ほかのプロセスは version で気づく）
+def invalidate_footer_cache():
+    global _footer_cache
+    _footer_cache = (None, (), 0.0)
+
+
+@app.template_global()
+def public_comments():
+    global _footer_cache
+    version, comments, checked_at = _footer_cache
+    now = time.monotonic()
+    if version is not None and now - checked_at < FOOTER_CHECK_INTERVAL:
+        return comments
+    # version を先に読む（読み直している間に増えたコメントは、次の確認でもう一度読む）
+    latest = state_version(FOOTER_STATE)
+    if latest != version:
+        comments = tuple(
+            FooterComment(c.message, c.admin_reply, c.created_at)
+            for c in PublicComment.query
+            .filter_by(is_public=True)
+            .order_by(PublicComment.created_at.desc())
+            .limit(FOOTER_COMMENT_LIMIT)
+        )
+    _footer_cache = (latest, comments, now)
+    return comments
 
 
 
+# 未削除のコマをコマ番号順に（詳細ページ）
+def live_komas_query(comic_id):
+    return (
+        Koma.query
+        .filter(Koma.comic_id == comic_id, Koma.is_deleted == 0)
+        .order_by(Koma.frame_number.asc())
+    )
+
+
 # コミックのコマのページ
 @app.route('/comic/<int:comic_id>')
 def comic_detail(comic_id):
-    comic = Comic.query.get_or_404(comic_id)
+    # version だけ先に1回で読む（変わっていなければコマは読まない）
+    footer = select(AppState.version, AppState.updated_at).where(AppState.key == FOOTER_STATE)
+    state = db.session.execute(
+        select(
+            Comic.version,
+            Comic.updated_at,
+            Comic.is_completed,
+            footer.with_only_columns(AppState.version).scalar_subquery().label('footer_version'),
+            footer.with_only_columns(AppState.updated_at).scalar_subquery().label('footer_updated_at'),
+        )
+        .where(Comic.id == comic_id)
+    ).first()
+    if state is None:
+        abort(404)
+
+    # 完結して固めてあれば version 付きの URL に回す（そちらは immutable で返す）
+    # このリダイレクトは毎回確かめさせるので、モデレーションで version が上がればすぐ新しい方に行く
+    if state.is_completed and '_flashes' not in session and os.path.exists(snapshot_path(comic_id, state.version)):
+        response = redirect(url_for('comic_snapshot', comic_id=comic_id, version=state.version))
+        response.cache_control.no_cache = True
+        return response
+
+    def render():
+        comic = Comic.query.get_or_404(comic_id)
+
+        komas = live_komas_query(comic.id).all()
+
+        koma_count = len(komas) # コマの数
+
+        # 完結して全部のコマが出そろったら、次からはスナップショットに回す
+        if not os.path.exists(snapshot_path(comic.id, comic.version)):
+            freeze_comic(comic, komas)
+        return render_template(
+            'comic_detail.html', 
+            comic=comic, 
+            komas=komas,
+            koma_count=koma_count
+        )
 
-    komas = comic.komas.filter_by(
-        is_deleted=0
-    ).order_by(Koma.frame_number.asc()).all()
+    return conditional_page(
+        f"comic-{comic_id}-{state.version}-f{state.footer_version or 0}",
+        latest(state.updated_at, state.footer_updated_at),
+        state.footer_version or 0,
+        render,
+        [comic_tag(comic_id)],
+    )
 
-    koma_count = len(komas) # コマの数
+# --- 完結したコミックのスナップショット ---
+# 完結したコミックの詳細ページは一度だけ描いて SNAPSHOT_FOLDER/<id>-v<version>.html に置き、
+# /comic/<id>/v<version> から Cache-Control: immutable で返す（/comic/<id> はそこへのリダイレクト）
+# version はモデレーション（削除・復元・purge）で上がるので、消したコマが古い URL から出続けることはない
+# SNAPSHOT_FOLDER は dyno ごとなので、無い・古い version しか無い dyno はその場で描き直す
+# フッターの公開コメント（更新される）と flash は入れない。flash があるときは普通に描く
+SNAPSHOT_MAX_AGE = int(os.environ.get("SNAPSHOT_MAX_AGE", 7 * 86400))
+
+
+def snapshot_path(comic_id, version):
+    return os.path.join(app.config['SNAPSHOT_FOLDER'], f'{int(comic_id)}-v{int(version)}.html')
+
+
+# このコミックの、この dyno にあるスナップショット（どの version のものも）
+def snapshot_paths(comic_id):
+    return glob.glob(os.path.join(app.config['SNAPSHOT_FOLDER'], f'{int(comic_id)}-v*.html'))
+
+
+@app.route('/comic/<int:comic_id>/v<int:version>')
+def comic_snapshot(comic_id, version):
+    # 今の version でなければ（上がった・消えた）元の URL に戻す。こちらは毎回 DB と照らし合わせる
+    current = db.session.execute(
+        select(Comic.version).where(Comic.id == comic_id, Comic.is_deleted == 0)
+    ).scalar()
+    if current != version:
+        return redirect(url_for('comic_detail', comic_id=comic_id))
+    path = snapshot_path(comic_id, version)
+    if not os.path.exists(path):
+        # ほかの dyno で固めたものはここには無いので描く
+        comic = db.session.get(Comic, comic_id)
+        if comic.version != version or not freeze_comic(comic, live_komas_query(comic_id).all()):
+            return redirect(url_for('comic_detail', comic_id=comic_id))
+    response = send_file(path, mimetype='text/html', max_age=SNAPSHOT_MAX_AGE, conditional=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.cache_control.no_cache = None
+    return response
+
+
+# 完結していて、アップロード待ちのコマが無ければ固める（古い version のものは消す）。固めたら True
+def freeze_comic(comic, komas):
+    if not comic.is_completed or comic.is_deleted or any(koma.status != KOMA_READY for koma in komas):
+        return False
+    # 見ている人のヘッダ（DPR・Save-Data・セッション）に左右されないよう、まっさらなリクエストで描く
+    with app.test_request_context(f'/comic/{comic.id}'):
+        html = render_template('comic_detail.html', comic=comic, komas=komas, koma_count=len(komas), snapshot=True)
+    path = snapshot_path(comic.id, comic.version)
+    tmp = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(html)
+    os.replace(tmp, path)
+    for old in snapshot_paths(comic.id):
+        if old != path:
+            remove_snapshot(old)
+    return True
+
+
+# モデレーションのあとに呼ぶ（コミットしてから）。この dyno にあるものは先に描き直しておく
+# （ほかの dyno は version が合わないので、次に見られたときに描き直す）
+def rebuild_snapshots(comic_ids):
+    comic_ids = [comic_id for comic_id in comic_ids if snapshot_paths(comic_id)]
+    rebuilt = 0
+    for chunk in chunked(comic_ids):
+        comics = {comic.id: comic for comic in Comic.query.filter(Comic.id.in_(chunk))}
+        for comic_id in chunk:
+            comic = comics.get(comic_id)
+            if comic and freeze_comic(comic, live_komas_query(comic_id).all()):
+                rebuilt += 1
+            else:
+                discard_snapshot(comic_id)
+    return rebuilt
+
+
+def discard_snapshot(comic_id):
+    for path in snapshot_paths(comic_id):
+        remove_snapshot(path)
+
+
+def remove_snapshot(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# --- 静的サイトへの書き出し ---
+# トップページと詳細ページを HTML にして静的ホスティング・CDN に置けるようにする（中身は export_static.py）
+# 2回目からは version が変わったコミックだけ描き直すので、cron などで回しておけばよい
+STATIC_EXPORT_FOLDER = os.environ.get("STATIC_EXPORT_FOLDER", os.path.join(basedir, 'export'))
+
+
+@app.cli.command('export-static')
+@click.option('--out', 'out_dir', default=STATIC_EXPORT_FOLDER, show_default=True, help='書き出し先のディレクトリ')
+@click.option('--workers', type=int, help='詳細ページを描くプロセス数（省略時は CPU 数）')
+@click.option('--mirror-images/--no-mirror-images', default=False, show_default=True,
+              help='コマの画像も書き出し先にコピーする（ローカルストレージなら必須）')
+@click.option('--full', is_flag=True, help='前回の書き出しを無視して全部描き直す')
+def export_static_command(out_dir, workers, mirror_images, full):
+    # export_static は app を import するので、ここで読み込む
+    from export_static import export_site
+
+    export_site(out_dir, workers, mirror_images, full)
 
-    return render_template(
-        'comic_detail.html', 
-        comic=comic, 
-        komas=komas,
-        koma_count=koma_count
-    )
 
 if __name__ == '__main__':
   # debug=False, threaded=Falseを維持
@@ -0,0 +1,172 @@
+"""
+cache.py
+
+描いたページとコミックカードの HTML を持っておくキャッシュ。CACHE_BACKEND で切り替える。
+
+  memory : プロセス内の LRU（デフォルト）。CACHE_MAX_ENTRIES 件まで。invalidate はそのプロセスにしか効かない
+  redis  : REDIS_URL の Redis 互換サーバー（gunicorn の worker・dyno をまたいで共有する）
+  none   : 何も持たない（いつも描く）
+
+どのバックエンドも同じ使い方:
+  get(key)                   -> (value, stale) か None。stale は invalidate(keep_stale=True) されたもの
+  set(key, value, tags, ttl) : tags（"comic:12" など）をつけて ttl 秒持つ
+  invalidate(tags, keep_stale=True)
+                             : タグのついたものを消す。keep_stale なら stale_ttl 秒だけ古いものとして残し、
+                               描き直している間はそれを返せるようにする（stale-while-revalidate）
+  lock(key, ttl) / unlock(key)
+                             : 描き直しを1つに絞るためのロック（取れたら True）
+
+value は JSON にできるもの（redis ではそのまま JSON で保存する）。
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class Cache:
+    def get(self, key):
+        return None
+
+    def set(self, key, value, tags=(), ttl=None):
+        pass
+
+    def invalidate(self, tags, keep_stale=True):
+        pass
+
+    def lock(self, key, ttl):
+        return True
+
+    def unlock(self, key):
+        pass
+
+
+class MemoryCache(Cache):
+    def __init__(self, max_entries=1000, stale_ttl=300):
+        self.max_entries = max_entries
+        self.stale_ttl = stale_ttl
+        # key -> [value, 期限(monotonic), stale か]
+        self.entries = OrderedDict()
+        self.tags = {}
+        self.locks = {}
+        self.mutex = threading.Lock()
+
+    def get(self, key):
+        with self.mutex:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] is not None and entry[1] < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[0], entry[2]
+
+    def set(self, key, value, tags=(), ttl=None):
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self.mutex:
+            self.entries[key] = [value, expires_at, False]
+            self.entries.move_to_end(key)
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, tags, keep_stale=True):
+        with self.mutex:
+            for tag in tags:
+                keys = self.tags.pop(tag, set())
+                # stale にしたものもタグに残しておき、あとの keep_stale=False で消せるようにする
+                # （LRU で追い出されたキーはここで落とす）
+                alive = {key for key in keys if key in self.entries}
+                if keep_stale and alive:
+                    self.tags[tag] = alive
+                for key in alive:
+                    if keep_stale:
+                        entry = self.entries[key]
+                        if not entry[2]:
+                            entry[1] = time.monotonic() + self.stale_ttl
+                            entry[2] = True
+                    else:
+                        del self.entries[key]
+
+    def lock(self, key, ttl):
+        now = time.monotonic()
+        with self.mutex:
+            if self.locks.get(key, 0) > now:
+                return False
+            self.locks[key] = now + ttl
+            return True
+
+    def unlock(self, key):
+        with self.mutex:
+            self.locks.pop(key, None)
+
+
+class RedisCache(Cache):
+    # 本体は <prefix><key>、stale にしたものは <prefix><key>:stale、タグは <prefix>tag:<tag>（キーの集合）
+    def __init__(self, url, prefix="manga_relay:", stale_ttl=300):
+        # redis は requirements に入れていないので、使うときだけ読み込む
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.stale_ttl = stale_ttl
+
+    def _key(self, key):
+        return self.prefix + key
+
+    def get(self, key):
+        fresh, stale = self.client.mget(self._key(key), self._key(key) + ":stale")
+        if fresh is not None:
+            return json.loads(fresh), False
+        if stale is not None:
+            return json.loads(stale), True
+        return None
+
+    def set(self, key, value, tags=(), ttl=None):
+        pipe = self.client.pipeline()
+        pipe.set(self._key(key), json.dumps(value), ex=ttl)
+        pipe.delete(self._key(key) + ":stale")
+        for tag in tags:
+            pipe.sadd(self._key("tag:" + tag), key)
+            # stale のものを消せる間はタグも残す（使われなくなったタグはそのうち消える）
+            pipe.expire(self._key("tag:" + tag), max(ttl or 0, self.stale_ttl) + self.stale_ttl)
+        pipe.execute()
+
+    def invalidate(self, tags, keep_stale=True):
+        for tag in tags:
+            tag_key = self._key("tag:" + tag)
+            keys = [key.decode() for key in self.client.smembers(tag_key)]
+            pipe = self.client.pipeline()
+            for key in keys:
+                if keep_stale:
+                    # 本体がすでに無ければ COPY は何もしない。stale の期限は縮めるだけで延ばさない
+                    # （COPY / EXPIRE LT を使うので Redis 7 以降）
+                    pipe.copy(self._key(key), self._key(key) + ":stale", replace=True)
+                    pipe.expire(self._key(key) + ":stale", self.stale_ttl, lt=True)
+                    pipe.delete(self._key(key))
+                else:
+                    pipe.delete(self._key(key), self._key(key) + ":stale")
+            # stale にしたものはタグに残す（あとの keep_stale=False で消せるように）
+            if not keep_stale:
+                pipe.delete(tag_key)
+            pipe.execute()
+
+    def lock(self, key, ttl):
+        return bool(self.client.set(self._key("lock:" + key), 1, nx=True, ex=max(1, int(ttl))))
+
+    def unlock(self, key):
+        self.client.delete(self._key("lock:" + key))
+
+
+def create_cache(config):
+    backend = config.get("CACHE_BACKEND", "memory")
+    stale_ttl = config.get("CACHE_STALE_SECONDS", 300)
+    if backend == "memory":
+        return MemoryCache(config.get("CACHE_MAX_ENTRIES", 1000), stale_ttl)
+    if backend == "redis":
+        return RedisCache(config["REDIS_URL"], stale_ttl=stale_ttl)
+    if backend == "none":
+        return Cache()
+    raise ValueError(f"unknown CACHE_BACKEND: {backend}")
@@ -0,0 +1,188 @@
+"""
+export_static.py
+
+flask export-static の中身。トップページ（ページごと）と各コミックの詳細ページを HTML に書き出して、
+どこの静的ホスティング・CDN からでも配れるディレクトリを作る。
+アプリや DB が落ちていても、書き出した分はそのまま読める。
+
+  <out>/index.html              トップページ（1ページ目）
+  <out>/page/<n>/index.html     トップページの n ページ目
+  <out>/comic/<id>/index.html   コミックの詳細ページ（URL はアプリと同じ /comic/<id>）
+  <out>/media/<sha256>.<ext>    --mirror-images のときの画像のコピー
+  <out>/manifest.json           前回書き出したときの version（差分の判定に使う）
+
+2回目からは Comic.version が変わったコミックだけを描き直す（トップページは feed の version で判定）。
+MANIFEST_FORMAT・リリース（ETAG_RELEASE）・--mirror-images が前回と違えば全部描き直す。
+詳細ページはプロセスプールで並列に描く（子プロセスから import できるよう app.py とは別にしている）。
+
+投稿フォーム・フッターのコメントは出さない（static_export=True で描く）。
+ローカルストレージ（/uploads）の画像は静的ホストには無いので --mirror-images を付けること。
+リンクはアプリと同じ絶対パスなので、ドメインの直下に置く。
+"""
+import json
+import os
+import shutil
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+import requests
+from flask import g, render_template
+from sqlalchemy import select
+
+from app import (
+    app, db, storage, Comic, Koma, live_komas_query, comic_summaries, state_versions,
+    FEED_STATE, KOMA_READY, ETAG_RELEASE,
+)
+
+# 書き出し方を変えたら上げる（前回の書き出しを全部描き直させる）
+MANIFEST_FORMAT = 1
+MEDIA_DIR = 'media'
+
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def load_manifest(out_dir):
+    try:
+        with open(os.path.join(out_dir, 'manifest.json'), encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def media_name(koma):
+    ext = {'jpeg': 'jpg'}.get(koma.format, koma.format or 'img')
+    return f"{koma.content_sha256 or f'koma-{koma.id}'}.{ext}"
+
+
+# コマの画像を <out>/media にコピーして {koma_id: URL} を返す（同じ画像は1回だけ）
+def mirror_images(out_dir, komas, http):
+    urls = {}
+    for koma in komas:
+        name = media_name(koma)
+        path = os.path.join(out_dir, MEDIA_DIR, name)
+        if not os.path.exists(path):
+            try:
+                if koma.storage_key:
+                    data = storage.read(koma.storage_key)
+                else:
+                    response = http.get(koma.image_filename, timeout=(3, 30))
+                    response.raise_for_status()
+                    data = response.content
+                write_file(path, data)
+            except Exception as e:
+                # 取れなかったコマは元の URL のまま出す
+                click.echo(f'[export] koma {koma.id}: {e}', err=True)
+                continue
+        urls[koma.id] = f'/{MEDIA_DIR}/{name}'
+    return urls
+
+
+# 見ている人のヘッダに左右されないよう、まっさらなリクエストで描く
+def render_static(path, template, mirrored, **context):
+    with app.test_request_context(path):
+        g.static_export = True
+        g.mirrored_images = mirrored
+        return render_template(template, static_export=True, **context)
+
+
+def init_worker():
+    # fork で引き継いだ DB の接続は親のものなので使わない
+    # （spawn / forkserver の子にはアプリコンテキストが無いので自分で積む）
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+# 子プロセスで1つのコミックを描く。(comic_id, 描いたときの version)。消えていたら version は None
+def export_comic(out_dir, comic_id, mirror):
+    with app.app_context():
+        comic = db.session.get(Comic, comic_id)
+        if not comic or comic.is_deleted:
+            return comic_id, None
+        version = comic.version
+        # アップロード待ちのコマは出さない（ready になれば version が上がって次回描き直す）
+        komas = live_komas_query(comic_id).filter(Koma.status == KOMA_READY).all()
+        mirrored = mirror_images(out_dir, komas, requests.Session()) if mirror else None
+        html = render_static(
+            f'/comic/{comic_id}', 'comic_detail.html', mirrored,
+            comic=comic, komas=komas, koma_count=comic.koma_count,
+        )
+        write_file(os.path.join(out_dir, 'comic', str(comic_id), 'index.html'), html.encode('utf-8'))
+        return comic_id, version
+
+
+# トップページをカーソルで順にたどって page/<n> に書き出す。書いたページ数を返す
+def export_index(out_dir, mirror):
+    cursor, page = None, 1
+    while True:
+        comics, next_cursor = comic_summaries(cursor)
+        mirrored = None
+        if mirror:
+            # カードの画像は詳細ページを書き出したときにコピー済みのものだけ使う
+            mirrored = {
+                row.latest_koma.id: f'/{MEDIA_DIR}/{media_name(row.latest_koma)}'
+                for row in comics
+                if row.latest_koma and os.path.exists(os.path.join(out_dir, MEDIA_DIR, media_name(row.latest_koma)))
+            }
+        path = '/' if page == 1 else f'/page/{page}/'
+        html = render_static(
+            path, 'index.html', mirrored,
+            comics=comics, next_cursor=next_cursor, next_page_url=f'/page/{page + 1}/' if next_cursor else None,
+        )
+        write_file(os.path.join(out_dir, path.strip('/'), 'index.html'), html.encode('utf-8'))
+        if not next_cursor:
+            return page
+        cursor, page = next_cursor, page + 1
+
+
+def export_site(out_dir, workers=None, mirror=False, full=False):
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = load_manifest(out_dir)
+    settings = {'format': MANIFEST_FORMAT, 'release': ETAG_RELEASE, 'mirror': mirror}
+    if full or not manifest or any(manifest.get(key) != value for key, value in settings.items()):
+        manifest = {'feed': None, 'pages': 0, 'comics': {}}
+
+    exported = {int(comic_id): version for comic_id, version in manifest['comics'].items()}
+    current = dict(db.session.execute(select(Comic.id, Comic.version).where(Comic.is_deleted == 0)).all())
+    feed_version = state_versions(FEED_STATE)[FEED_STATE].version
+    db.session.rollback()
+
+    # 消えたコミックのページを消す
+    for comic_id in set(exported) - set(current):
+        shutil.rmtree(os.path.join(out_dir, 'comic', str(comic_id)), ignore_errors=True)
+        del exported[comic_id]
+
+    changed = sorted(comic_id for comic_id, version in current.items() if exported.get(comic_id) != version)
+    click.echo(f'[export] {len(changed)} of {len(current)} comic(s) to render')
+    if changed:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as pool:
+            futures = [pool.submit(export_comic, out_dir, comic_id, mirror) for comic_id in changed]
+            for done, future in enumerate(futures, 1):
+                comic_id, version = future.result()
+                if version is None:
+                    shutil.rmtree(os.path.join(out_dir, 'comic', str(comic_id)), ignore_errors=True)
+                    exported.pop(comic_id, None)
+                else:
+                    exported[comic_id] = version
+                if done % 100 == 0:
+                    click.echo(f'[export] {done}/{len(changed)}')
+
+    pages = manifest['pages']
+    if changed or manifest['feed'] != feed_version:
+        pages = export_index(out_dir, mirror)
+        # 減ったページを消す
+        for page in range(pages + 1, manifest['pages'] + 1):
+            shutil.rmtree(os.path.join(out_dir, 'page', str(page)), ignore_errors=True)
+        click.echo(f'[export] {pages} index page(s)')
+
+    # ページを書き終えてから manifest を置き換える（途中で落ちたら次回やり直す）
+    manifest = dict(settings, feed=feed_version, pages=pages,
+                    comics={str(comic_id): version for comic_id, version in sorted(exported.items())})
+    write_file(os.path.join(out_dir, 'manifest.json'), json.dumps(manifest, indent=1).encode('utf-8'))
+    click.echo(f'[export] done: {out_dir}')
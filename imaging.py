@@ -0,0 +1,112 @@
+"""
+imaging.py
+
+コマ画像の中身を読むヘルパー（Pillow）。
+
+  probe_image(fp) : ヘッダだけ読んで width / height / format を返す（デコードしない）
+  sniff_format(head) : 先頭のバイト列から png / jpeg を判定する（どちらでもなければ None）
+  validate_image(fp) : 投稿を受け付けてよい画像か調べて probe_image と同じ dict を返す。
+                       だめなら ImageRejected（メッセージはそのまま利用者に見せる）
+  check_image(meta) : 形式と縦横だけを調べる（ストレージが返したメタデータ用）。だめなら ImageRejected
+  make_lqip(fp)   : 16px 幅くらいのぼかし用プレースホルダを data URI で返す
+  image_meta(fp)  : 上の2つとバイト数をまとめた dict
+
+fp はパスかバイナリのファイルオブジェクト。
+"""
+import base64
+import io
+import os
+
+from PIL import Image
+
+# 受け付ける画像の大きさの上限（縦横それぞれと総ピクセル数）
+MAX_IMAGE_SIDE = int(os.environ.get("MAX_IMAGE_SIDE", 8000))
+MAX_IMAGE_PIXELS = int(os.environ.get("MAX_IMAGE_PIXELS", 40_000_000))
+# Pillow 自身の展開爆弾チェックも同じ上限にする（2倍を超えると DecompressionBombError）
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+# 先頭のバイト列（マジックナンバー）と形式
+SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpeg"),
+)
+SNIFF_BYTES = 8
+
+# LQIP の幅と JPEG 画質（だいたい 300〜600 バイトの data URI になる）
+LQIP_WIDTH = 16
+LQIP_QUALITY = 40
+
+
+def probe_image(fp):
+    with Image.open(fp) as im:
+        return {
+            "width": im.width,
+            "height": im.height,
+            "format": (im.format or "").lower() or None,
+        }
+
+
+class ImageRejected(ValueError):
+    pass
+
+
+def sniff_format(head):
+    for signature, fmt in SIGNATURES:
+        if head.startswith(signature):
+            return fmt
+    return None
+
+
+def check_image(meta):
+    if meta.get("format") not in dict(SIGNATURES).values():
+        raise ImageRejected("PNG か JPEG の画像を選んでください")
+    width, height = meta.get("width") or 0, meta.get("height") or 0
+    if width > MAX_IMAGE_SIDE or height > MAX_IMAGE_SIDE or width * height > MAX_IMAGE_PIXELS:
+        raise ImageRejected(f"画像が大きすぎます（縦横 {MAX_IMAGE_SIDE}px まで）")
+
+
+# ヘッダで縦横を見て、大きすぎなければ verify() でファイル全体の整合性も見る（デコードはしない）
+def validate_image(fp):
+    try:
+        with Image.open(fp) as im:
+            meta = {
+                "width": im.width,
+                "height": im.height,
+                "format": (im.format or "").lower() or None,
+            }
+            check_image(meta)
+            im.verify()
+    except ImageRejected:
+        raise
+    except Image.DecompressionBombError:
+        raise ImageRejected(f"画像が大きすぎます（縦横 {MAX_IMAGE_SIDE}px まで）")
+    except Exception:
+        # 壊れたファイルは Pillow の形式ごとにいろいろな例外（SyntaxError など）になる
+        raise ImageRejected("画像として読み込めないファイルです")
+    return meta
+
+
+def make_lqip(fp):
+    with Image.open(fp) as im:
+        # JPEG は縮小しながら読めるので大きなスキャンでも軽い
+        im.draft("RGB", (LQIP_WIDTH * 4, LQIP_WIDTH * 4))
+        im = im.convert("RGB")
+        im.thumbnail((LQIP_WIDTH, LQIP_WIDTH * 4))
+        buf = io.BytesIO()
+        im.save(buf, "JPEG", quality=LQIP_QUALITY, optimize=True)
+    return "data:image/jpeg;base64," + base64.b64encode(buf.getvalue()).decode("ascii")
+
+
+def image_meta(fp):
+    if isinstance(fp, (str, os.PathLike)):
+        size = os.path.getsize(fp)
+    else:
+        fp.seek(0, os.SEEK_END)
+        size = fp.tell()
+        fp.seek(0)
+    meta = probe_image(fp)
+    if not isinstance(fp, (str, os.PathLike)):
+        fp.seek(0)
+    meta["bytes"] = size
+    meta["lqip"] = make_lqip(fp)
+    return meta
@@ -96,6 +96,16 @@ def run_migrations_online():
 
     connectable = get_engine()
 
+    # partial indexes declared with .ddl_if(dialect='postgresql') only exist on
+    # Postgres, so don't let autogenerate on SQLite keep proposing them
+    def include_object(object, name, type_, reflected, compare_to):
+        if type_ == 'index' and connectable.dialect.name != 'postgresql':
+            return object.dialect_options['postgresql'].get('where') is None
+        return True
+
+    if conf_args.get("include_object") is None:
+        conf_args["include_object"] = include_object
+
     with connectable.connect() as connection:
         context.configure(
             connection=connection,
@@ -0,0 +1,37 @@
+"""koma missing meta index
+
+Revision ID: 757d3cc1d2a9
+Revises: c1acd0f11716
+Create Date: 2026-10-17 20:52:38.162633
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '757d3cc1d2a9'
+down_revision = 'c1acd0f11716'
+branch_labels = None
+depends_on = None
+
+
+# worker.claim_missing_meta 用の部分インデックス（モデル側も ddl_if で Postgres 限定）
+MISSING_META_WHERE = (
+    "status = 'ready' AND is_deleted = 0 AND storage_key IS NOT NULL AND (lqip IS NULL OR content_sha256 IS NULL)"
+)
+
+
+def is_postgresql():
+    return op.get_bind().dialect.name == 'postgresql'
+
+
+def upgrade():
+    if is_postgresql():
+        op.create_index('ix_koma_missing_meta', 'koma', ['id'], unique=False,
+                        postgresql_where=sa.text(MISSING_META_WHERE))
+
+
+def downgrade():
+    if is_postgresql():
+        op.drop_index('ix_koma_missing_meta', table_name='koma')
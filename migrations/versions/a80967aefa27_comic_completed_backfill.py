@@ -0,0 +1,27 @@
+"""comic completed backfill
+
+Revision ID: a80967aefa27
+Revises: dd316707844f
+Create Date: 2026-10-17 20:38:00.733492
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a80967aefa27'
+down_revision = 'dd316707844f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # スキーマは変えない。これまで誰も立てていなかった is_completed を、満タンのコミックについて立てる
+    comic = sa.table('comic', sa.column('is_full', sa.Boolean), sa.column('is_completed', sa.Boolean))
+    op.execute(comic.update().values(is_completed=comic.c.is_full))
+
+
+def downgrade():
+    # 以前は使っていなかった列なので戻さない
+    pass
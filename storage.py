@@ -0,0 +1,402 @@
+"""
+storage.py
+
+コマ画像の保存先をまとめるレイヤー。STORAGE_BACKEND で切り替える。
+
+  cloudinary : 本番（デフォルト）
+  local      : Cloudinary を使わない単体サーバー用。STORAGE_LOCAL_ROOT に保存して
+               STORAGE_LOCAL_URL（デフォルト /uploads）以下で配信する
+  memory     : ベンチマーク・負荷試験用。プロセス内の dict に置くだけ
+
+どのバックエンドも「キー」で画像を指す。キーは manga_relay/<comic_id>/<名前> の形で、
+Cloudinary なら public_id、local ならルートからの相対パスになる。
+
+put() は次の dict を返す:
+  {"key": ..., "url": ..., "bytes": ..., "format": ...}
+
+variant_url() は幅・高さを指定した配信用 URL を返す。変換できるのは Cloudinary だけで、
+ほかのバックエンドは元画像の URL をそのまま返す（supports_transforms が False）。
+
+list(prefix) は prefix 以下の画像を1件ずつ返すジェネレータ（ページングは中で行う）:
+  {"key": ..., "bytes": ..., "created_at": datetime(UTC, naive)}
+
+ブラウザからストレージへ直接アップロードさせる（web を画像が通らない）ときは
+direct_upload(folder, ext, ttl) で ttl 秒だけ使える送り先を作り、置かれたら
+confirm_direct_upload(key, result) で確かめる（result はブラウザが転送してきたストレージの応答）:
+  direct_upload         -> {"key": ..., "method": "POST" | "PUT", "url": ..., "fields": {...}}
+                           POST は fields と file をフォームで、PUT は本体に画像をそのまま送る
+  confirm_direct_upload -> {"key", "url", "bytes", "format", "width", "height"}（確かめられなければ None）
+Cloudinary は署名付きのアップロード API（応答の署名で確かめる）、local は署名付きの URL への PUT
+（app.py の PUT /uploads/direct/<token> が accept_direct_upload を呼ぶ）。memory は非対応。
+どちらも置き済みのキーには書かない（確認を済ませた画像を同じ送り先で差し替えられないように）。
+"""
+import os
+import re
+import shutil
+import time
+import uuid
+from datetime import datetime
+
+import cloudinary
+import cloudinary.api
+import cloudinary.uploader
+import cloudinary.utils
+import requests
+from cloudinary.exceptions import NotFound
+from itsdangerous import URLSafeTimedSerializer
+
+from imaging import probe_image
+
+
+# Cloudinary がアップロードの署名を受け付ける時間（timestamp からの秒数。こちらでは変えられない）
+CLOUDINARY_SIGNATURE_TTL = 3600
+# Cloudinary の Admin API で一度に消せる上限
+CLOUDINARY_DELETE_BATCH = 100
+# Cloudinary の Admin API で一度に取れる一覧の上限
+CLOUDINARY_LIST_PAGE = 500
+# これより大きい画像は upload_large で分けて送る（1回で送れる上限を超えないように。1回分は 5MB 以上）
+CLOUDINARY_LARGE_THRESHOLD = int(os.environ.get("CLOUDINARY_LARGE_THRESHOLD", 20 * 1024 * 1024))
+CLOUDINARY_CHUNK_SIZE = int(os.environ.get("CLOUDINARY_CHUNK_SIZE", 6 * 1024 * 1024))
+# 直接アップロードで受け付ける形式（Cloudinary は jpg と呼ぶ）
+DIRECT_UPLOAD_FORMATS = "png,jpg"
+FORMAT_NAMES = {"jpg": "jpeg"}
+
+
+def _int_or_none(value):
+    return value if isinstance(value, int) and not isinstance(value, bool) else None
+
+
+class Storage:
+    supports_transforms = False
+    supports_direct_upload = False
+
+    def put(self, path, folder):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    # まとめて削除する。消えた件数を返す
+    def delete_many(self, keys):
+        count = 0
+        for key in keys:
+            count += 1 if self.delete(key) else 0
+        return count
+
+    def url(self, key):
+        raise NotImplementedError
+
+    # crop は "limit"（縮小のみ）か "fill"（指定サイズに切り抜き）
+    def variant_url(self, key, width, height=None, crop="limit", quality="auto"):
+        return self.url(key)
+
+    def exists(self, key):
+        raise NotImplementedError
+
+    # 元画像のバイト列を返す（メタデータの後埋めなどで使う）
+    def read(self, key):
+        raise NotImplementedError
+
+    # prefix 以下の画像を列挙する（孤立した画像の掃除で使う）
+    def list(self, prefix):
+        raise NotImplementedError
+
+    # ブラウザから直接 folder 以下の新しいキーに置かせるための送り先（ttl 秒まで使える）
+    def direct_upload(self, folder, ext, ttl):
+        raise NotImplementedError
+
+    # 直接アップロードでキーに置かれた画像の情報
+    def confirm_direct_upload(self, key, result):
+        raise NotImplementedError
+
+
+class CloudinaryStorage(Storage):
+    supports_transforms = True
+    supports_direct_upload = True
+
+    # https://res.cloudinary.com/<cloud>/image/upload/v123/manga_relay/1/abc.png
+    URL_RE = re.compile(r"/image/upload/(?:v\d+/)?(?P<key>.+?)(?:\.\w+)?$")
+
+    def __init__(self):
+        # 接続情報は CLOUDINARY_URL 環境変数から読む
+        cloudinary.config(secure=True)
+
+    def put(self, path, folder):
+        if os.path.getsize(path) > CLOUDINARY_LARGE_THRESHOLD:
+            # upload_large は resource_type を指定しないと raw になる
+            result = cloudinary.uploader.upload_large(
+                path, folder=folder, resource_type="image", chunk_size=CLOUDINARY_CHUNK_SIZE)
+        else:
+            result = cloudinary.uploader.upload(path, folder=folder)
+        return {
+            "key": result["public_id"],
+            "url": result["secure_url"],
+            "bytes": result.get("bytes"),
+            "format": result.get("format"),
+        }
+
+    def delete(self, key):
+        result = cloudinary.uploader.destroy(key)
+        return result.get("result") == "ok"
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        count = 0
+        for i in range(0, len(keys), CLOUDINARY_DELETE_BATCH):
+            result = cloudinary.api.delete_resources(keys[i:i + CLOUDINARY_DELETE_BATCH])
+            count += sum(1 for status in result.get("deleted", {}).values() if status == "deleted")
+        return count
+
+    def url(self, key):
+        return cloudinary.utils.cloudinary_url(key, secure=True)[0]
+
+    # f_auto,q_auto で端末に合ったフォーマット・画質にして配信する
+    def variant_url(self, key, width, height=None, crop="limit", quality="auto"):
+        transformation = {
+            "fetch_format": "auto",
+            "quality": quality,
+            "width": width,
+            "crop": crop,
+        }
+        if height:
+            transformation["height"] = height
+        if crop == "fill":
+            transformation["gravity"] = "auto"
+        return cloudinary.utils.cloudinary_url(key, secure=True, transformation=[transformation])[0]
+
+    def exists(self, key):
+        try:
+            cloudinary.api.resource(key)
+            return True
+        except NotFound:
+            return False
+
+    def read(self, key):
+        response = requests.get(self.url(key), timeout=(3, 30))
+        response.raise_for_status()
+        return response.content
+
+    def list(self, prefix):
+        cursor = None
+        while True:
+            params = {"type": "upload", "prefix": prefix, "max_results": CLOUDINARY_LIST_PAGE}
+            if cursor:
+                params["next_cursor"] = cursor
+            result = cloudinary.api.resources(**params)
+            for resource in result.get("resources", []):
+                yield {
+                    "key": resource["public_id"],
+                    "bytes": resource.get("bytes"),
+                    "created_at": datetime.strptime(resource["created_at"], "%Y-%m-%dT%H:%M:%SZ"),
+                }
+            cursor = result.get("next_cursor")
+            if not cursor:
+                break
+
+    # 署名はパラメータごとにかかるので、ブラウザは public_id も overwrite も変えられない
+    # 署名付きのアップロードは既定で上書きなので、overwrite=false で finalize のあとの差し替えを断る
+    # 署名は Cloudinary 側で timestamp から CLOUDINARY_SIGNATURE_TTL 受け付けるので、
+    # timestamp を過去にずらして ttl 秒で切れるようにする
+    def direct_upload(self, folder, ext, ttl):
+        config = cloudinary.config()
+        key = f"{folder}/{uuid.uuid4().hex}"
+        params = {
+            "public_id": key,
+            "timestamp": int(time.time()) - max(0, CLOUDINARY_SIGNATURE_TTL - ttl),
+            "allowed_formats": DIRECT_UPLOAD_FORMATS,
+            "overwrite": "false",
+            "unique_filename": "false",
+        }
+        params["signature"] = cloudinary.utils.api_sign_request(params, config.api_secret)
+        params["api_key"] = config.api_key
+        return {
+            "key": key,
+            "method": "POST",
+            "url": f"https://api.cloudinary.com/v1_1/{config.cloud_name}/image/upload",
+            "fields": params,
+        }
+
+    # アップロード API の応答を、応答の署名（public_id と version にかかる）で確かめる
+    # Admin API は1時間あたりの回数に上限があるので、投稿のたびには呼ばない
+    # 縦横・バイト数は署名の外なので、worker が画像を読んで確かめ直す（形式は allowed_formats で縛ってある）
+    def confirm_direct_upload(self, key, result):
+        public_id, version, signature = (result.get(name) for name in ("public_id", "version", "signature"))
+        if public_id != key or not version or not isinstance(signature, str):
+            return None
+        if not cloudinary.utils.verify_api_response_signature(public_id, version, signature):
+            return None
+        fmt = result.get("format")
+        return {
+            "key": key,
+            "url": self.url(key),
+            "bytes": _int_or_none(result.get("bytes")),
+            "format": FORMAT_NAMES.get(fmt, fmt) if isinstance(fmt, str) else None,
+            "width": _int_or_none(result.get("width")),
+            "height": _int_or_none(result.get("height")),
+        }
+
+    # 以前は secure_url だけを保存していたので、そこから public_id を取り出す
+    @classmethod
+    def key_from_url(cls, url):
+        match = cls.URL_RE.search(url or "")
+        return match.group("key") if match else None
+
+
+class LocalStorage(Storage):
+    def __init__(self, root, base_url="/uploads", secret=None):
+        self.root = root
+        self.base_url = base_url.rstrip("/")
+        os.makedirs(root, exist_ok=True)
+        # 直接アップロードの URL に入れるキーの署名（secret がなければ直接アップロードは使わない）
+        self.signer = URLSafeTimedSerializer(secret, salt="local-direct-upload") if secret else None
+        self.supports_direct_upload = self.signer is not None
+
+    def _path(self, key):
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(os.path.abspath(self.root) + os.sep):
+            raise ValueError(f"invalid storage key: {key}")
+        return path
+
+    def put(self, path, folder):
+        ext = os.path.splitext(path)[1].lower()
+        key = f"{folder}/{uuid.uuid4()}{ext}"
+        dest = self._path(key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.copyfile(path, dest)
+        return {
+            "key": key,
+            "url": self.url(key),
+            "bytes": os.path.getsize(dest),
+            "format": ext.lstrip(".") or None,
+        }
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def url(self, key):
+        return f"{self.base_url}/{key}"
+
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def read(self, key):
+        with open(self._path(key), "rb") as f:
+            return f.read()
+
+    # 期限は受け取るとき（accept_direct_upload の max_age）に見る
+    def direct_upload(self, folder, ext, ttl):
+        key = f"{folder}/{uuid.uuid4()}.{ext}"
+        return {
+            "key": key,
+            "method": "PUT",
+            "url": f"{self.base_url}/direct/{self.signer.dumps(key)}",
+            "fields": {},
+        }
+
+    # direct_upload の URL に PUT された本体を書いて key を返す
+    # 署名が違う・期限切れなら itsdangerous.BadSignature、max_bytes を超えたら ValueError
+    # 置き済みのキーには書かない（同じ URL にもう一度送って、確認済みの画像を差し替えられないように）
+    def accept_direct_upload(self, token, stream, max_age, max_bytes, chunk_size=64 * 1024):
+        key = self.signer.loads(token, max_age=max_age)
+        dest = self._path(key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp = f"{dest}.{uuid.uuid4().hex}.uploading"
+        try:
+            size = 0
+            with open(tmp, "wb") as out:
+                for chunk in iter(lambda: stream.read(chunk_size), b""):
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise ValueError("too large")
+                    out.write(chunk)
+            os.link(tmp, dest)
+        finally:
+            os.remove(tmp)
+        return key
+
+    # 置かれたファイルを直接見る（PUT の応答には何も無いので result は使わない）
+    def confirm_direct_upload(self, key, result=None):
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            meta = probe_image(path)
+        except Exception:
+            meta = {"width": None, "height": None, "format": None}
+        meta.update(key=key, url=self.url(key), bytes=os.path.getsize(path))
+        return meta
+
+    def list(self, prefix):
+        root = os.path.abspath(self.root)
+        # "manga_relay/12/" なら root/manga_relay/12 の下だけを見る
+        start = os.path.join(root, prefix.rsplit("/", 1)[0]) if "/" in prefix else root
+        for dirpath, dirnames, filenames in os.walk(start):
+            dirnames.sort()
+            for name in sorted(filenames):
+                path = os.path.join(dirpath, name)
+                key = os.path.relpath(path, root).replace(os.sep, "/")
+                if not key.startswith(prefix):
+                    continue
+                stat = os.stat(path)
+                yield {
+                    "key": key,
+                    "bytes": stat.st_size,
+                    "created_at": datetime.utcfromtimestamp(stat.st_mtime),
+                }
+
+
+class MemoryStorage(Storage):
+    def __init__(self):
+        self.blobs = {}
+        self.created = {}
+
+    def put(self, path, folder):
+        ext = os.path.splitext(path)[1].lower()
+        key = f"{folder}/{uuid.uuid4()}{ext}"
+        with open(path, "rb") as f:
+            self.blobs[key] = f.read()
+        self.created[key] = datetime.utcnow()
+        return {
+            "key": key,
+            "url": self.url(key),
+            "bytes": len(self.blobs[key]),
+            "format": ext.lstrip(".") or None,
+        }
+
+    def delete(self, key):
+        self.created.pop(key, None)
+        return self.blobs.pop(key, None) is not None
+
+    def url(self, key):
+        return f"memory://{key}"
+
+    def exists(self, key):
+        return key in self.blobs
+
+    def read(self, key):
+        return self.blobs[key]
+
+    def list(self, prefix):
+        for key in sorted(self.blobs):
+            if key.startswith(prefix):
+                yield {
+                    "key": key,
+                    "bytes": len(self.blobs[key]),
+                    "created_at": self.created.get(key, datetime.min),
+                }
+
+
+def create_storage(config):
+    backend = config.get("STORAGE_BACKEND", "cloudinary")
+    if backend == "cloudinary":
+        return CloudinaryStorage()
+    if backend == "local":
+        return LocalStorage(config["STORAGE_LOCAL_ROOT"], config.get("STORAGE_LOCAL_URL", "/uploads"),
+                            config.get("SECRET_KEY"))
+    if backend == "memory":
+        return MemoryStorage()
+    raise ValueError(f"unknown STORAGE_BACKEND: {backend}")
@@ -0,0 +1,76 @@
+"""
+テストの共通の準備。
+
+app.py は import した時点で環境変数を読むので、ここで先に決めてから import する。
+DB は TEST_DATABASE_URL があればそれ（Postgres で流すとき）、無ければ一時ファイルの sqlite。
+画像は memory ストレージ、ページのキャッシュは無し（毎回 DB から描く）。
+
+  python -m pytest -q
+  TEST_DATABASE_URL=postgresql://... python -m pytest -q
+"""
+import base64
+import glob
+import io
+import os
+import sys
+import tempfile
+
+import pytest
+
+TMP_DIR = tempfile.mkdtemp(prefix="manga-relay-test-")
+# sqlite は書き込みが重なると待つので、待ち時間を長めにする
+os.environ["DATABASE_URL"] = os.environ.get("TEST_DATABASE_URL") or (
+    "sqlite:///" + os.path.join(TMP_DIR, "test.db") + "?timeout=60"
+)
+os.environ["STORAGE_BACKEND"] = "memory"
+os.environ["CACHE_BACKEND"] = "none"
+os.environ["SPOOL_FOLDER"] = os.path.join(TMP_DIR, "spool")
+os.environ["SNAPSHOT_FOLDER"] = os.path.join(TMP_DIR, "snapshots")
+os.environ["ADMIN_USER"] = "admin"
+os.environ["ADMIN_PASS"] = "test"
+# LINE は使うテストだけ line_stub で向け先を入れる
+for name in ("LINE_CHANNEL_ACCESS_TOKEN", "LINE_GROUP_ID", "LINE_PUSH_URL"):
+    os.environ.pop(name, None)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image  # noqa: E402
+
+from app import app as flask_app, db, storage, AppState, FOOTER_STATE, FEED_STATE  # noqa: E402
+
+flask_app.config["TESTING"] = True
+
+ADMIN_AUTH = {"Authorization": "Basic " + base64.b64encode(b"admin:test").decode()}
+
+
+@pytest.fixture
+def app():
+    # テストごとにテーブルと memory ストレージの中身、スナップショットを作り直す
+    storage.blobs.clear()
+    storage.created.clear()
+    for path in glob.glob(os.path.join(os.environ["SNAPSHOT_FOLDER"], "*")):
+        os.remove(path)
+    with flask_app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.add_all([AppState(key=FOOTER_STATE, version=0), AppState(key=FEED_STATE, version=0)])
+        db.session.commit()
+        yield flask_app
+        db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+# 色ごとに中身の違う PNG（同じ色だと重複投稿として弾かれる）
+def png(color=(200, 30, 30), size=(64, 48)):
+    buf = io.BytesIO()
+    Image.new("RGB", size, color).save(buf, "PNG")
+    return buf.getvalue()
+
+
+def post_koma(client, comic_id="new", color=(200, 30, 30), **form):
+    data = {"comic_id": str(comic_id), "file": (io.BytesIO(png(color)), "koma.png"), **form}
+    return client.post("/post", data=data, content_type="multipart/form-data")
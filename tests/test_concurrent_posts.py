@@ -0,0 +1,61 @@
+"""
+1つのコミックに投稿が一度に押し寄せても、コマ番号が重ならず max_koma を超えないこと
+（allocate_frame_number の条件付き UPDATE と uq_koma_comic_frame を守る）。
+"""
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import func
+
+from app import db, Comic, Koma
+from conftest import post_koma
+
+POSTS = 200
+THREADS = 32
+MAX_KOMA = 50
+
+
+def test_parallel_posts_fill_comic_exactly(app, client):
+    response = post_koma(client, title="同時投稿", max_koma=str(MAX_KOMA))
+    assert response.status_code == 302
+    comic_id = Comic.query.one().id
+
+    def post(i):
+        # スレッドごとに別のクライアント・別の画像（同じ画像は重複として弾かれる）
+        return post_koma(app.test_client(), comic_id, color=(i % 256, i // 256, 77)).status_code
+
+    with ThreadPoolExecutor(max_workers=THREADS) as pool:
+        statuses = Counter(pool.map(post, range(POSTS)))
+
+    # 入った分は 302、満員になってからの分は 409。それ以外（500 など）は無い
+    assert set(statuses) <= {302, 409}, statuses
+    assert statuses[302] == MAX_KOMA - 1
+    assert statuses[409] == POSTS - (MAX_KOMA - 1)
+
+    db.session.expire_all()
+    comic = db.session.get(Comic, comic_id)
+    frames = [frame for (frame,) in db.session.query(Koma.frame_number).filter_by(comic_id=comic_id)]
+    assert sorted(frames) == list(range(1, MAX_KOMA + 1))
+    assert comic.koma_count == MAX_KOMA == comic.last_frame_number
+    assert comic.is_full and comic.is_completed
+    assert db.session.query(func.count(Koma.id)).filter_by(comic_id=comic_id, is_deleted=0).scalar() == MAX_KOMA
+
+
+def test_parallel_posts_without_limit_get_distinct_frames(app, client):
+    response = post_koma(client, title="上限なし", max_koma="1000")
+    assert response.status_code == 302
+    comic_id = Comic.query.one().id
+
+    def post(i):
+        return post_koma(app.test_client(), comic_id, color=(i % 256, i // 256, 151)).status_code
+
+    with ThreadPoolExecutor(max_workers=THREADS) as pool:
+        statuses = Counter(pool.map(post, range(POSTS)))
+
+    assert statuses == {302: POSTS}
+
+    db.session.expire_all()
+    comic = db.session.get(Comic, comic_id)
+    frames = [frame for (frame,) in db.session.query(Koma.frame_number).filter_by(comic_id=comic_id)]
+    assert sorted(frames) == list(range(1, POSTS + 2))
+    assert comic.koma_count == POSTS + 1 == comic.last_frame_number
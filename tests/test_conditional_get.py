@@ -0,0 +1,67 @@
+"""
+トップページの ETag（app_state の feed）が、投稿・アップロード完了・削除のたびに変わり、
+変わっていなければ 304 になること。feed は投稿のトランザクションの外で上げる。
+"""
+from sqlalchemy import event
+
+import worker
+from app import db, Koma, AppState, FEED_STATE
+from conftest import post_koma, ADMIN_AUTH
+
+
+def index_etag(client):
+    response = client.get("/")
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    assert client.get("/", headers={"If-None-Match": etag}).status_code == 304
+    return etag
+
+
+def test_index_etag_follows_changes(client):
+    assert post_koma(client, title="A").status_code == 302
+    # flash を出し切る
+    client.get("/")
+    etags = [index_etag(client)]
+
+    assert post_koma(client, title="B", color=(1, 1, 1)).status_code == 302
+    client.get("/")
+    etags.append(index_etag(client))
+
+    # worker がアップロードを終えた
+    worker.run_once()
+    etags.append(index_etag(client))
+
+    koma_id = db.session.query(db.func.max(Koma.id)).scalar()
+    assert client.post(f"/admin/delete/koma/{koma_id}", headers=ADMIN_AUTH).status_code == 302
+    client.get("/")
+    etags.append(index_etag(client))
+
+    assert len(set(etags)) == len(etags)
+
+
+def test_post_does_not_touch_feed_row_inside_its_transaction(app, client):
+    assert post_koma(client, title="A").status_code == 302
+    comic_id = db.session.query(db.func.max(Koma.comic_id)).scalar()
+
+    # 投稿のトランザクション（COMMIT まで）に app_state を書く文が無いこと
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    def commit(conn):
+        statements.append("COMMIT")
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(db.engine, "commit", commit)
+    try:
+        assert post_koma(client, comic_id, color=(5, 5, 5)).status_code == 302
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+        event.remove(db.engine, "commit", commit)
+
+    post_transaction = statements[:statements.index("COMMIT")]
+    assert any(statement.startswith("INSERT INTO koma") for statement in post_transaction)
+    assert not any("app_state" in statement for statement in post_transaction)
+    # コミットしたあとで上がっている
+    assert db.session.get(AppState, FEED_STATE).version >= 2
@@ -0,0 +1,41 @@
+"""
+同じ画像の投稿はアップロード済みの画像を使い回す（find_uploaded_copy）。
+"""
+import worker
+from app import db, storage, Koma, KOMA_READY
+from conftest import post_koma, ADMIN_AUTH
+
+
+# 投稿を worker にさばかせて、最新のコミックのコマを返す
+# （リクエストの終わりにセッションが外れるので、使う値は読んでおく）
+def ready_koma():
+    worker.run_once()
+    db.session.expire_all()
+    koma = Koma.query.order_by(Koma.id.desc()).first()
+    return koma.id, koma.status, koma.storage_key
+
+
+def test_same_image_reuses_uploaded_asset(client):
+    assert post_koma(client, title="A", color=(10, 20, 30)).status_code == 302
+    first_id, _, first_key = ready_koma()
+    assert post_koma(client, title="B", color=(10, 20, 30)).status_code == 302
+    second_id, status, second_key = ready_koma()
+
+    assert second_id != first_id
+    assert status == KOMA_READY
+    assert second_key == first_key
+
+
+def test_deleted_koma_is_not_reused(client):
+    assert post_koma(client, title="A", color=(10, 20, 30)).status_code == 302
+    first_id, _, first_key = ready_koma()
+    assert client.post(f"/admin/delete/koma/{first_id}", headers=ADMIN_AUTH).status_code == 302
+
+    # 管理者が消した画像は、同じ画像が投稿されても戻さない（新しくアップロードする）
+    assert post_koma(client, title="B", color=(10, 20, 30)).status_code == 302
+    second_id, status, second_key = ready_koma()
+
+    assert second_id != first_id
+    assert status == KOMA_READY
+    assert second_key != first_key
+    assert storage.exists(second_key)
@@ -0,0 +1,215 @@
+"""
+ストレージへの直接アップロード（/direct-uploads）。
+Cloudinary はネットワークを使わずに署名だけ確かめる。
+作成 → PUT → finalize の流れは local ストレージ（PUT /uploads/direct/<token>）で通す。
+"""
+import time
+
+import cloudinary
+import cloudinary.utils
+import pytest
+
+import worker
+from app import db, storage, Comic, Koma, KOMA_READY, KOMA_FAILED, DIRECT_UPLOAD_FOLDER
+from conftest import png, post_koma
+from storage import CloudinaryStorage, LocalStorage, CLOUDINARY_SIGNATURE_TTL
+
+
+@pytest.fixture
+def cloudinary_storage():
+    config = cloudinary.config()
+    saved = (config.cloud_name, config.api_key, config.api_secret)
+    cloudinary.config(cloud_name="test-cloud", api_key="test-key", api_secret="test-secret")
+    yield CloudinaryStorage()
+    config.cloud_name, config.api_key, config.api_secret = saved
+
+
+@pytest.fixture
+def local_storage(app, monkeypatch, tmp_path):
+    local = LocalStorage(str(tmp_path), "/uploads", app.secret_key)
+    # app と worker はどちらも storage を名前で import しているので両方差し替える
+    monkeypatch.setattr("app.storage", local)
+    monkeypatch.setattr("worker.storage", local)
+    return local
+
+
+def create_upload(client, data, comic_id="new", **form):
+    response = client.post("/direct-uploads", data={
+        "filename": "koma.png", "size": str(len(data)), "comic_id": str(comic_id),
+        "title": "直接", "max_koma": "10", **form,
+    })
+    assert response.status_code == 201
+    return response.get_json()
+
+
+def put_upload(client, upload, data):
+    assert upload["upload"]["method"] == "PUT"
+    return client.put(upload["upload"]["url"], data=data)
+
+
+def finalize(client, upload):
+    return client.post(upload["finalize_url"], data={"token": upload["token"], "upload": ""})
+
+
+# 作って、送って、finalize した結果（レスポンス）を返す
+def direct_post(client, data, comic_id="new"):
+    upload = create_upload(client, data, comic_id)
+    assert put_upload(client, upload, data).status_code == 204
+    return finalize(client, upload)
+
+
+def stored_keys(local):
+    return [item["key"] for item in local.list(DIRECT_UPLOAD_FOLDER + "/")]
+
+
+def signed_response(public_id, version=1700000000, **fields):
+    signature = cloudinary.utils.api_sign_request(
+        {"public_id": public_id, "version": version}, "test-secret", signature_version=1)
+    return {"public_id": public_id, "version": version, "signature": signature, **fields}
+
+
+def test_cloudinary_direct_upload_refuses_overwrite_and_expires_with_ttl(cloudinary_storage):
+    upload = cloudinary_storage.direct_upload("manga_relay/direct", "png", 600)
+    fields = dict(upload["fields"])
+    assert fields.pop("api_key") == "test-key"
+    signature = fields.pop("signature")
+
+    assert fields["public_id"] == upload["key"]
+    assert fields["overwrite"] == "false"
+    assert fields["unique_filename"] == "false"
+    assert signature == cloudinary.utils.api_sign_request(fields, "test-secret")
+    # Cloudinary は timestamp から CLOUDINARY_SIGNATURE_TTL 受け付けるので、600 秒で切れるようにずらしてある
+    expires_in = fields["timestamp"] + CLOUDINARY_SIGNATURE_TTL - time.time()
+    assert 590 <= expires_in <= 601
+
+
+def test_cloudinary_confirm_uses_response_signature(cloudinary_storage):
+    key = "manga_relay/direct/abc"
+    meta = cloudinary_storage.confirm_direct_upload(
+        key, signed_response(key, width=640, height=480, format="jpg", bytes=12345,
+                             secure_url="https://evil.example/x.png"))
+    assert meta == {
+        "key": key,
+        "url": cloudinary_storage.url(key),
+        "bytes": 12345,
+        "format": "jpeg",
+        "width": 640,
+        "height": 480,
+    }
+
+
+def test_cloudinary_confirm_rejects_forged_responses(cloudinary_storage):
+    key = "manga_relay/direct/abc"
+    forged = dict(signed_response(key), signature="0" * 40)
+    assert cloudinary_storage.confirm_direct_upload(key, forged) is None
+    # 別のキーの（正しく署名された）応答は使えない
+    assert cloudinary_storage.confirm_direct_upload(key, signed_response("manga_relay/direct/other")) is None
+    assert cloudinary_storage.confirm_direct_upload(key, {}) is None
+
+
+# finalize はストレージの応答の縦横で確かめるだけなので、worker が画像そのもので確かめ直す
+def test_worker_drops_direct_upload_that_is_not_an_image(app):
+    key = f"{DIRECT_UPLOAD_FOLDER}/forged.png"
+    storage.blobs[key] = b"not an image" * 100
+    comic = Comic(title="直接", max_koma=5, koma_count=1, last_frame_number=1)
+    db.session.add(comic)
+    db.session.flush()
+    koma = Koma(comic_id=comic.id, frame_number=1, status=KOMA_READY, storage_key=key,
+                image_filename=storage.url(key), width=10, height=10, bytes=1200, format="png")
+    db.session.add(koma)
+    db.session.commit()
+    comic_id, koma_id = comic.id, koma.id
+
+    worker.run_once()
+
+    db.session.expire_all()
+    koma = db.session.get(Koma, koma_id)
+    assert (koma.status, koma.is_deleted, koma.storage_key) == (KOMA_FAILED, 1, None)
+    assert key not in storage.blobs
+    assert db.session.get(Comic, comic_id).koma_count == 0
+
+
+def test_local_create_put_finalize(client, local_storage):
+    data = png(size=(120, 90))
+    upload = create_upload(client, data)
+    assert put_upload(client, upload, data).status_code == 204
+
+    first = finalize(client, upload)
+    assert first.status_code == 200
+    # 応答を受け取れずに送り直した finalize も同じコマを返す
+    second = finalize(client, upload)
+    assert second.status_code == 200
+    assert first.get_json() == second.get_json()
+
+    assert Koma.query.count() == 1
+    koma = db.session.get(Koma, first.get_json()["koma_id"])
+    assert (koma.status, koma.width, koma.height, koma.format) == (KOMA_READY, 120, 90, "png")
+    assert local_storage.read(koma.storage_key) == data
+    assert db.session.get(Comic, koma.comic_id).koma_count == 1
+
+
+def test_local_put_twice_is_refused(client, local_storage):
+    data = png()
+    upload = create_upload(client, data)
+    assert put_upload(client, upload, data).status_code == 204
+    # 確かめる前の画像を同じ URL で差し替えられない
+    assert put_upload(client, upload, png((1, 2, 3))).status_code == 409
+    assert finalize(client, upload).status_code == 200
+    assert local_storage.read(stored_keys(local_storage)[0]) == data
+
+
+def test_local_expired_token(client, local_storage, monkeypatch):
+    data = png()
+    upload = create_upload(client, data)
+    monkeypatch.setattr("app.DIRECT_UPLOAD_TTL", -1)
+
+    assert put_upload(client, upload, data).status_code == 403
+    assert finalize(client, upload).status_code == 403
+    assert stored_keys(local_storage) == []
+    assert Koma.query.count() == 0
+
+
+def test_local_non_image_is_rejected_and_deleted(client, local_storage):
+    data = b"this is not an image at all" * 10
+    response = direct_post(client, data)
+
+    assert response.status_code == 400
+    assert Koma.query.count() == 0
+    assert stored_keys(local_storage) == []
+
+
+def test_worker_drops_duplicate_in_same_comic(client, local_storage):
+    assert post_koma(client, title="連投", color=(1, 2, 3)).status_code == 302
+    worker.run_once()
+    comic_id = Comic.query.one().id
+
+    response = direct_post(client, png((1, 2, 3)), comic_id)
+    assert response.status_code == 200
+    koma_id = response.get_json()["koma_id"]
+    worker.run_once()
+
+    db.session.expire_all()
+    koma = db.session.get(Koma, koma_id)
+    assert (koma.is_deleted, koma.last_error) == (1, "duplicate in comic")
+    assert db.session.get(Comic, comic_id).koma_count == 1
+
+
+def test_worker_reuses_existing_upload(client, local_storage):
+    assert post_koma(client, title="元", color=(1, 2, 3)).status_code == 302
+    worker.run_once()
+    original = Koma.query.one()
+    original_key = original.storage_key
+
+    response = direct_post(client, png((1, 2, 3)))
+    assert response.status_code == 200
+    koma_id = response.get_json()["koma_id"]
+    assert len(stored_keys(local_storage)) == 1
+    worker.run_once()
+
+    db.session.expire_all()
+    koma = db.session.get(Koma, koma_id)
+    assert (koma.status, koma.is_deleted, koma.storage_key) == (KOMA_READY, 0, original_key)
+    assert koma.content_sha256 is not None
+    # 使い回すことにしたので、直接アップロードされた方の画像は消える
+    assert stored_keys(local_storage) == []
+    assert local_storage.exists(original_key)
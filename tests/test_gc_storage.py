@@ -0,0 +1,97 @@
+"""
+ストレージの掃除（gc_storage）を memory ストレージで確かめる。
+参照されていない画像は猶予がすぎてから、削除したコマの画像は GC_DELETED_GRACE_DAYS がすぎてから消し、
+使い回している（ほかのコマも指している）画像は残す。
+"""
+from datetime import datetime, timedelta
+
+import worker
+from app import db, storage, gc_storage, Koma, KOMA_READY, KOMA_EXPIRED, GC_DELETED_GRACE_DAYS
+from conftest import post_koma, ADMIN_AUTH
+
+
+def put_blob(key, age):
+    storage.blobs[key] = b"x" * 10
+    storage.created[key] = datetime.utcnow() - age
+
+
+# 投稿して worker にアップロードさせ、(コマID, storage_key) を返す
+def ready_koma(client, title, color):
+    assert post_koma(client, title=title, color=color).status_code == 302
+    worker.run_once()
+    db.session.expire_all()
+    koma = Koma.query.order_by(Koma.id.desc()).first()
+    assert koma.status == KOMA_READY
+    return koma.id, koma.storage_key
+
+
+def delete_koma(client, koma_id, days_ago):
+    assert client.post(f"/admin/delete/koma/{koma_id}", headers=ADMIN_AUTH).status_code == 302
+    Koma.query.filter_by(id=koma_id).update({"deleted_at": datetime.utcnow() - timedelta(days=days_ago)})
+    db.session.commit()
+
+
+def test_orphans_are_deleted_after_grace_period(app, client):
+    _, used_key = ready_koma(client, "A", (1, 2, 3))
+    storage.created[used_key] = datetime.utcnow() - timedelta(days=3)
+    put_blob("manga_relay/1/old-orphan.png", timedelta(hours=25))
+    put_blob("manga_relay/1/new-orphan.png", timedelta(hours=1))
+    put_blob("other/old.png", timedelta(days=10))
+
+    stats = gc_storage(orphan_grace_hours=24)
+
+    assert stats["scanned"] == 3
+    assert stats["orphans"] == 1
+    assert stats["orphan_bytes"] == 10
+    assert sorted(storage.blobs) == sorted([used_key, "manga_relay/1/new-orphan.png", "other/old.png"])
+
+
+def test_dry_run_deletes_nothing(app, client):
+    koma_id, key = ready_koma(client, "A", (1, 2, 3))
+    delete_koma(client, koma_id, GC_DELETED_GRACE_DAYS + 1)
+    put_blob("manga_relay/1/old-orphan.png", timedelta(days=2))
+
+    stats = gc_storage(dry_run=True)
+
+    assert (stats["orphans"], stats["expired"]) == (1, 1)
+    assert key in storage.blobs and "manga_relay/1/old-orphan.png" in storage.blobs
+    assert db.session.get(Koma, koma_id).storage_key == key
+
+
+def test_deleted_koma_expires_after_grace_days(app, client):
+    old_id, old_key = ready_koma(client, "A", (1, 2, 3))
+    recent_id, recent_key = ready_koma(client, "B", (4, 5, 6))
+    delete_koma(client, old_id, GC_DELETED_GRACE_DAYS + 1)
+    delete_koma(client, recent_id, GC_DELETED_GRACE_DAYS - 1)
+
+    stats = gc_storage()
+
+    assert stats["expired"] == 1
+    db.session.expire_all()
+    old, recent = db.session.get(Koma, old_id), db.session.get(Koma, recent_id)
+    assert (old.status, old.storage_key, old.image_filename) == (KOMA_EXPIRED, None, None)
+    assert old_key not in storage.blobs
+    # 猶予中のコマは復元できるよう画像を残す
+    assert recent.storage_key == recent_key
+    assert recent_key in storage.blobs
+
+    # 2回目は何もしない
+    assert gc_storage()["expired"] == 0
+
+
+def test_reused_image_survives_expiry(app, client):
+    first_id, key = ready_koma(client, "A", (1, 2, 3))
+    second_id, second_key = ready_koma(client, "B", (1, 2, 3))
+    assert second_key == key
+    storage.created[key] = datetime.utcnow() - timedelta(days=GC_DELETED_GRACE_DAYS + 2)
+    delete_koma(client, first_id, GC_DELETED_GRACE_DAYS + 1)
+
+    stats = gc_storage()
+
+    assert stats["expired"] == 1
+    assert stats["orphans"] == 0
+    db.session.expire_all()
+    assert db.session.get(Koma, first_id).status == KOMA_EXPIRED
+    # もう1つのコマがまだ指しているので消さない
+    assert db.session.get(Koma, second_id).storage_key == key
+    assert key in storage.blobs
@@ -0,0 +1,50 @@
+"""
+トップページの SQL の数がコミックの数で増えないこと（N+1 に戻っていないか）。
+"""
+import pytest
+from sqlalchemy import event
+
+import worker
+from app import db, Comic, FEED_PAGE_SIZE
+from conftest import post_koma
+
+
+def make_comics(client, count, komas_per_comic=3):
+    start = Comic.query.count()
+    for i in range(start, start + count):
+        assert post_koma(client, title=f"コミック{i}", max_koma="20", color=(i, 0, 0)).status_code == 302
+        comic_id = db.session.query(db.func.max(Comic.id)).scalar()
+        for j in range(1, komas_per_comic):
+            assert post_koma(client, comic_id, color=(i, j, 1)).status_code == 302
+    # アップロード待ちを ready にしておく
+    while worker.run_once():
+        pass
+
+
+def count_index_queries(client):
+    # フッターのコメントなどプロセスごとのキャッシュを先に温めておく（数えるのは毎回の分）
+    assert client.get("/").status_code == 200
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        response = client.get("/")
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+    assert response.status_code == 200
+    return statements
+
+
+# 1ページに収まる数と、次のページができる数
+@pytest.mark.parametrize("count", [FEED_PAGE_SIZE, FEED_PAGE_SIZE * 2])
+def test_index_query_count_is_constant(client, count):
+    make_comics(client, 1)
+    one = count_index_queries(client)
+
+    make_comics(client, count - 1)
+    many = count_index_queries(client)
+
+    assert len(many) == len(one), "\n\n".join(many)
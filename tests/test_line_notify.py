@@ -0,0 +1,91 @@
+"""
+LINE 通知の outbox（worker.drain_notifications）を、LINE_PUSH_URL に立てたローカルの代替サーバーで確かめる。
+"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import app as app_module
+import worker
+from app import db, Comic, Koma, NotificationOutbox, SpoolChunk, NOTIFY_SENT, NOTIFY_DROPPED, KOMA_FAILED
+from conftest import post_koma
+
+
+class LineStub(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.pushes.append({
+            "path": self.path,
+            "authorization": self.headers.get("Authorization"),
+            "json": json.loads(body),
+        })
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, format, *args):
+        pass
+
+
+# 受け取った push の一覧（server.pushes）を持つ代替サーバーに向けて、LINE 通知を有効にする
+@pytest.fixture
+def line_stub(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), LineStub)
+    server.pushes = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(app_module, "LINE_TOKEN", "test-token")
+    monkeypatch.setattr(app_module, "LINE_GROUP_ID", "test-group")
+    monkeypatch.setattr(app_module, "LINE_PUSH_URL", f"http://127.0.0.1:{server.server_port}/v2/bot/message/push")
+    monkeypatch.setattr(app_module, "_line_session", None)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def texts(server):
+    return [message["text"] for push in server.pushes for message in push["json"]["messages"]]
+
+
+def test_burst_is_sent_as_one_digest(client, line_stub):
+    assert post_koma(client, title="通知", max_koma="20").status_code == 302
+    comic_id = Comic.query.one().id
+    for i in range(1, 5):
+        assert post_koma(client, comic_id, color=(i, 2, 3)).status_code == 302
+
+    worker.run_once()
+
+    assert len(line_stub.pushes) == 1
+    push = line_stub.pushes[0]
+    assert push["path"] == "/v2/bot/message/push"
+    assert push["authorization"] == "Bearer test-token"
+    assert push["json"]["to"] == "test-group"
+    assert texts(line_stub) == [f"🖊 新しいコマが5枚投稿されたよ！\nhttp://localhost/comic/{comic_id}"]
+    assert {row.status for row in NotificationOutbox.query} == {NOTIFY_SENT}
+
+    # NOTIFY_WINDOW の間は次の投稿があっても送らない
+    assert post_koma(client, comic_id, color=(9, 9, 9)).status_code == 302
+    worker.run_once()
+    assert len(line_stub.pushes) == 1
+
+
+def test_failed_koma_notification_is_dropped(client, line_stub):
+    assert post_koma(client, title="通知", max_koma="20").status_code == 302
+    comic_id = Comic.query.one().id
+    assert post_koma(client, comic_id, color=(1, 2, 3)).status_code == 302
+    broken = Koma.query.filter_by(comic_id=comic_id, frame_number=2).one()
+    # worker に渡る画像が無くなったコマは failed になる
+    SpoolChunk.query.filter_by(name=broken.spool_path).delete()
+    db.session.commit()
+
+    worker.run_once()
+
+    db.session.expire_all()
+    assert db.session.get(Koma, broken.id).status == KOMA_FAILED
+    assert texts(line_stub) == [f"🖊 新しいコマが投稿されたよ！\nhttp://localhost/comic/{comic_id}"]
+    statuses = {row.koma_id: row.status for row in NotificationOutbox.query}
+    assert statuses.pop(broken.id) == NOTIFY_DROPPED
+    assert set(statuses.values()) == {NOTIFY_SENT}
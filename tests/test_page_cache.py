@@ -0,0 +1,151 @@
+"""
+ページ・カードのキャッシュ（cache.py の MemoryCache と app.cached_page）。
+投稿では古いページを stale として残して描き直しの間に返し、削除では古いものも残さず消す。
+"""
+import pytest
+
+import worker
+from app import db, Koma
+from cache import MemoryCache
+from conftest import post_koma, ADMIN_AUTH
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr("cache.time", clock)
+    return clock
+
+
+def test_keep_stale_then_hard_evict(clock):
+    cache = MemoryCache(stale_ttl=30)
+    cache.set("page:a", "A", ["comic:1"], ttl=3600)
+    cache.set("page:b", "B", ["comic:2"], ttl=3600)
+    assert cache.get("page:a") == ("A", False)
+
+    cache.invalidate(["comic:1"])
+    assert cache.get("page:a") == ("A", True)
+    assert cache.get("page:b") == ("B", False)
+    # もう一度 stale にしても期限は延びない
+    clock.now += 20
+    cache.invalidate(["comic:1"])
+    clock.now += 11
+    assert cache.get("page:a") is None
+
+    # 描き直して入れたものは新しい扱い。削除（keep_stale=False）では stale も残さない
+    cache.set("page:a", "A2", ["comic:1"], ttl=3600)
+    cache.invalidate(["comic:1"])
+    cache.invalidate(["comic:1"], keep_stale=False)
+    assert cache.get("page:a") is None
+    assert "comic:1" not in cache.tags
+
+
+def test_ttl_expires(clock):
+    cache = MemoryCache()
+    cache.set("card:1", "C", ["comic:1"], ttl=60)
+    clock.now += 59
+    assert cache.get("card:1") == ("C", False)
+    clock.now += 2
+    assert cache.get("card:1") is None
+
+
+def test_lru_evicts_least_recently_used_and_prunes_tags(clock):
+    cache = MemoryCache(max_entries=2)
+    cache.set("page:a", "A", ["comic:1", "feed"])
+    cache.set("page:b", "B", ["comic:1"])
+    assert cache.get("page:a") == ("A", False)
+    cache.set("page:c", "C", ["feed"])
+
+    # 最後に読んでいない b が追い出される
+    assert cache.get("page:b") is None
+    assert sorted(cache.entries) == ["page:a", "page:c"]
+    # 追い出されたキーは invalidate のときにタグからも落とす
+    cache.invalidate(["comic:1"])
+    assert cache.tags["comic:1"] == {"page:a"}
+    cache.invalidate(["feed"], keep_stale=False)
+    assert cache.entries == {}
+
+
+def test_lock_is_single_flight(clock):
+    cache = MemoryCache()
+    assert cache.lock("page:a", 10)
+    assert not cache.lock("page:a", 10)
+    assert cache.lock("page:b", 10)
+    cache.unlock("page:a")
+    assert cache.lock("page:a", 10)
+    # 描き直す側が落ちても、期限がすぎれば次のリクエストが取れる
+    clock.now += 11
+    assert cache.lock("page:a", 10)
+
+
+@pytest.fixture
+def page_cache(app, monkeypatch):
+    cache = MemoryCache()
+    monkeypatch.setattr("app.page_cache", cache)
+    # 描き直し中のページを待つのは短くする
+    monkeypatch.setattr("app.CACHE_WAIT_SECONDS", 0.1)
+    return cache
+
+
+def page_keys(cache, path):
+    return [key for key in cache.entries if key.startswith(f"page:{path}?")]
+
+
+# 投稿して worker にアップロードさせ、storage_key を返す
+def ready_key(client, **form):
+    assert post_koma(client, **form).status_code == 302
+    worker.run_once()
+    db.session.expire_all()
+    return Koma.query.order_by(Koma.id.desc()).first().storage_key
+
+
+def test_post_serves_stale_page_while_another_request_renders(app, client, page_cache):
+    first_key = ready_key(client, title="キャッシュ", max_koma="10", color=(1, 2, 3))
+    comic_id = Koma.query.one().comic_id
+    # 投稿した側のクライアントは flash が残っているので、別のクライアントで読む
+    reader = app.test_client()
+    assert first_key in reader.get(f"/comic/{comic_id}").get_data(as_text=True)
+    [key] = page_keys(page_cache, f"/comic/{comic_id}")
+
+    second_key = ready_key(client, comic_id=comic_id, color=(4, 5, 6))
+    assert page_cache.get(key)[1]
+    # ほかのリクエストが描き直している間は古いページを返す
+    assert page_cache.lock(key, 10)
+    body = reader.get(f"/comic/{comic_id}").get_data(as_text=True)
+    assert first_key in body and second_key not in body
+    page_cache.unlock(key)
+
+    body = reader.get(f"/comic/{comic_id}").get_data(as_text=True)
+    assert second_key in body
+    assert not page_cache.get(key)[1]
+
+
+def test_delete_drops_cached_page(app, client, page_cache):
+    kept_key = ready_key(client, title="キャッシュ", max_koma="10", color=(1, 2, 3))
+    deleted_key = ready_key(client, comic_id=Koma.query.one().comic_id, color=(4, 5, 6))
+    koma = Koma.query.filter_by(storage_key=deleted_key).one()
+    comic_id, koma_id = koma.comic_id, koma.id
+    reader = app.test_client()
+    assert deleted_key in reader.get(f"/comic/{comic_id}").get_data(as_text=True)
+    assert deleted_key in reader.get("/").get_data(as_text=True)
+    [key] = page_keys(page_cache, f"/comic/{comic_id}")
+
+    assert client.post(f"/admin/delete/koma/{koma_id}", headers=ADMIN_AUTH).status_code == 302
+
+    # コミックのページもトップページも stale として残さない
+    assert page_keys(page_cache, f"/comic/{comic_id}") == []
+    assert page_keys(page_cache, "/") == []
+    # 描き直しが重なって古いものを返す場面でも、消したコマは出ない
+    assert page_cache.lock(key, 10)
+    body = reader.get(f"/comic/{comic_id}").get_data(as_text=True)
+    assert kept_key in body and deleted_key not in body
+    page_cache.unlock(key)
+    assert deleted_key not in reader.get("/").get_data(as_text=True)
@@ -0,0 +1,96 @@
+"""
+よく走るクエリがシーケンシャルスキャンに戻っていないこと（インデックスを消した・クエリを書き換えたとき）。
+ダミーのコミック・コマを入れて統計を取り直し、EXPLAIN を見る。
+TEST_DATABASE_URL に Postgres を指定すれば Postgres のプランナー（部分インデックスも）で見る。
+"""
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import insert, select
+
+from app import (
+    db, Comic, Koma, comic_counter_values, feed_query, live_komas_query, admin_comics_query, pending_komas_query,
+    KOMA_PENDING, KOMA_READY,
+)
+
+PLAN_TABLES = ('comic', 'koma', 'latest_koma')
+SEED_COMICS = 2000
+SEED_KOMAS = 10
+FAR_CURSOR = (datetime.utcnow(), 2 ** 31)
+
+
+def seed(comics=SEED_COMICS, komas_per_comic=SEED_KOMAS):
+    now = datetime.utcnow()
+    comic_rows = [
+        {'title': f'plan-check {i}', 'started_at': now - timedelta(minutes=i),
+         'is_deleted': 1 if i % 10 == 0 else 0, 'max_koma': komas_per_comic,
+         'koma_count': komas_per_comic, 'last_frame_number': komas_per_comic}
+        for i in range(comics)
+    ]
+    comic_ids = db.session.scalars(insert(Comic).returning(Comic.id), comic_rows).all()
+    koma_rows = [
+        {'comic_id': comic_id, 'frame_number': n, 'posted_at': now,
+         'is_deleted': 1 if n % 7 == 0 else 0,
+         'status': KOMA_PENDING if n == komas_per_comic else KOMA_READY}
+        for comic_id in comic_ids
+        for n in range(1, komas_per_comic + 1)
+    ]
+    db.session.execute(insert(Koma), koma_rows)
+    db.session.commit()
+    # テスト用の DB なので統計はそのまま残してよい（テーブルは次のテストで作り直す）
+    db.session.execute(db.text('ANALYZE comic'))
+    db.session.execute(db.text('ANALYZE koma'))
+    db.session.commit()
+    return sorted(comic_ids)[len(comic_ids) // 2]
+
+
+def explain(query):
+    conn = db.session.connection()
+    compiled = getattr(query, 'statement', query).compile(dialect=conn.dialect)
+    if conn.dialect.name == 'postgresql':
+        rows = conn.exec_driver_sql('EXPLAIN ' + str(compiled), compiled.params)
+        return [row[0] for row in rows]
+    params = tuple(compiled.params[name] for name in compiled.positiontup)
+    rows = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + str(compiled), params)
+    return [row[-1] for row in rows]
+
+
+def is_seq_scan(line):
+    line = line.strip()
+    # Postgres: "Seq Scan on koma"、SQLite: "SCAN koma"（インデックスを使うときは "SCAN koma USING INDEX ..."）
+    for table in PLAN_TABLES:
+        if f'Seq Scan on {table} ' in line + ' ':
+            return True
+        if line in (f'SCAN {table}', f'SCAN TABLE {table}') or line.startswith(f'SCAN {table} AS'):
+            return True
+    return False
+
+
+HOT_QUERIES = {
+    'feed': lambda comic_id: feed_query(),
+    'feed (next page)': lambda comic_id: feed_query(FAR_CURSOR),
+    'comic detail': live_komas_query,
+    'admin list': lambda comic_id: admin_comics_query(),
+    'admin list (next page)': lambda comic_id: admin_comics_query(FAR_CURSOR),
+    'admin komas': lambda comic_id: Koma.query.filter(Koma.comic_id == comic_id).order_by(Koma.frame_number),
+    'koma counters': lambda comic_id: select(
+        comic_counter_values()['koma_count'], comic_counter_values()['last_frame_number']
+    ).where(Comic.id == comic_id),
+    'ingest claim': lambda comic_id: pending_komas_query(datetime.utcnow()).limit(10),
+}
+
+
+@pytest.mark.parametrize('name', HOT_QUERIES)
+def test_hot_query_uses_index(app, name):
+    comic_id = seed()
+    plan = explain(HOT_QUERIES[name](comic_id))
+    assert not any(is_seq_scan(line) for line in plan), '\n'.join(plan)
+
+
+def test_is_seq_scan():
+    assert is_seq_scan('Seq Scan on koma  (cost=0.00..1.01 rows=1 width=4)')
+    assert is_seq_scan('SCAN koma')
+    assert is_seq_scan('SCAN latest_koma AS latest_koma')
+    assert not is_seq_scan('Index Scan using ix_koma_comic_live on koma')
+    assert not is_seq_scan('SCAN koma USING INDEX ix_koma_status')
+    assert not is_seq_scan('SEARCH comic USING INTEGER PRIMARY KEY (rowid=?)')
@@ -0,0 +1,156 @@
+"""
+完結したコミックのスナップショット（SNAPSHOT_FOLDER/<id>-v<version>.html）。
+最後のコマで完結して固め、/comic/<id> は /comic/<id>/v<version>（immutable）へ回す。
+モデレーションで version が上がれば古い URL は元に戻し、コミックが開き直せばスナップショットも捨てる。
+"""
+import os
+
+import pytest
+
+import worker
+from app import db, Comic, Koma, snapshot_path, snapshot_paths, SNAPSHOT_MAX_AGE
+from conftest import post_koma, ADMIN_AUTH
+
+
+# 2コマで完結するコミックを作って worker にアップロードさせ、(コミックID, [storage_key]) を返す
+def completed_comic(client):
+    assert post_koma(client, title="完結", max_koma="2", color=(1, 2, 3)).status_code == 302
+    comic_id = Comic.query.one().id
+    assert post_koma(client, comic_id=comic_id, color=(4, 5, 6)).status_code == 302
+    worker.run_once()
+    db.session.expire_all()
+    keys = [koma.storage_key for koma in Koma.query.order_by(Koma.frame_number)]
+    return comic_id, keys
+
+
+def comic_state(comic_id):
+    db.session.expire_all()
+    comic = db.session.get(Comic, comic_id)
+    return comic.is_completed, comic.version
+
+
+@pytest.fixture
+def reader(app):
+    # 投稿した側のクライアントは flash が残っていて普通に描かれるので、見る側は別にする
+    return app.test_client()
+
+
+def test_last_frame_completes_and_freezes(client, reader):
+    assert post_koma(client, title="完結", max_koma="2", color=(1, 2, 3)).status_code == 302
+    comic_id = Comic.query.one().id
+    assert comic_state(comic_id)[0] is False
+    assert post_koma(client, comic_id=comic_id, color=(4, 5, 6)).status_code == 302
+    completed, version = comic_state(comic_id)
+    assert completed
+
+    # アップロード待ちのコマがあるうちは固めない
+    assert reader.get(f"/comic/{comic_id}").status_code == 200
+    assert snapshot_paths(comic_id) == []
+
+    worker.run_once()
+    completed, version = comic_state(comic_id)
+    assert reader.get(f"/comic/{comic_id}").status_code == 200
+    assert snapshot_paths(comic_id) == [snapshot_path(comic_id, version)]
+
+
+def test_redirects_to_immutable_versioned_url(client, reader):
+    comic_id, keys = completed_comic(client)
+    assert reader.get(f"/comic/{comic_id}").status_code == 200
+    version = comic_state(comic_id)[1]
+
+    response = reader.get(f"/comic/{comic_id}")
+    assert response.status_code == 302
+    assert response.location == f"/comic/{comic_id}/v{version}"
+    # リダイレクトは毎回確かめさせる
+    assert response.cache_control.no_cache
+
+    snapshot = reader.get(response.location)
+    assert snapshot.status_code == 200
+    assert snapshot.cache_control.public
+    assert snapshot.cache_control.immutable
+    assert snapshot.cache_control.max_age == SNAPSHOT_MAX_AGE
+    assert not snapshot.cache_control.no_cache
+    body = snapshot.get_data(as_text=True)
+    assert all(key in body for key in keys)
+
+    assert reader.get(response.location, headers={"If-None-Match": snapshot.headers["ETag"]}).status_code == 304
+    # 今の version でない URL は元の URL に戻す
+    assert reader.get(f"/comic/{comic_id}/v{version + 1}").location == f"/comic/{comic_id}"
+
+
+def test_snapshot_is_rendered_on_another_dyno(client, reader):
+    comic_id, keys = completed_comic(client)
+    assert reader.get(f"/comic/{comic_id}").status_code == 200
+    version = comic_state(comic_id)[1]
+    # ほかの dyno で固められた URL に、スナップショットを持たない dyno で来た
+    os.remove(snapshot_path(comic_id, version))
+
+    snapshot = reader.get(f"/comic/{comic_id}/v{version}")
+    assert snapshot.status_code == 200
+    assert snapshot.cache_control.immutable
+    assert os.path.exists(snapshot_path(comic_id, version))
+
+
+def test_delete_reopens_comic_and_drops_snapshot(client, reader):
+    comic_id, keys = completed_comic(client)
+    assert reader.get(f"/comic/{comic_id}").status_code == 200
+    old_version = comic_state(comic_id)[1]
+    with open(snapshot_path(comic_id, old_version), encoding="utf-8") as f:
+        old_html = f.read()
+    koma_id = Koma.query.filter_by(storage_key=keys[1]).one().id
+
+    assert client.post(f"/admin/delete/koma/{koma_id}", headers=ADMIN_AUTH).status_code == 302
+
+    completed, version = comic_state(comic_id)
+    assert not completed and version > old_version
+    assert snapshot_paths(comic_id) == []
+    # 古い URL（immutable で配ったもの）からは元の URL に戻り、消したコマは出ない
+    # ほかの dyno に古い version のスナップショットが残っていても返さない
+    with open(snapshot_path(comic_id, old_version), "w", encoding="utf-8") as f:
+        f.write(old_html)
+    assert reader.get(f"/comic/{comic_id}/v{old_version}").location == f"/comic/{comic_id}"
+    page = reader.get(f"/comic/{comic_id}")
+    assert page.status_code == 200
+    body = page.get_data(as_text=True)
+    assert keys[0] in body and keys[1] not in body
+    # 開き直したコミックは固めない
+    assert not os.path.exists(snapshot_path(comic_id, version))
+
+    # 空いたコマ枠にまた投稿できる
+    assert post_koma(client, comic_id=comic_id, color=(7, 8, 9)).status_code == 302
+    assert comic_state(comic_id)[0]
+
+
+def test_restore_completes_again_with_new_version(client, reader):
+    comic_id, keys = completed_comic(client)
+    assert reader.get(f"/comic/{comic_id}").status_code == 200
+    koma_id = Koma.query.filter_by(storage_key=keys[1]).one().id
+    assert client.post(f"/admin/delete/koma/{koma_id}", headers=ADMIN_AUTH).status_code == 302
+    deleted_version = comic_state(comic_id)[1]
+
+    response = client.post("/admin/bulk", json={"action": "restore", "koma_ids": [koma_id]}, headers=ADMIN_AUTH)
+    assert response.status_code == 200
+
+    completed, version = comic_state(comic_id)
+    assert completed and version > deleted_version
+    assert reader.get(f"/comic/{comic_id}").status_code == 200
+    assert snapshot_paths(comic_id) == [snapshot_path(comic_id, version)]
+    response = reader.get(f"/comic/{comic_id}")
+    assert response.location == f"/comic/{comic_id}/v{version}"
+    assert keys[1] in reader.get(response.location).get_data(as_text=True)
+
+
+def test_moderation_rebuilds_snapshot_of_completed_comic(client, reader):
+    comic_id, keys = completed_comic(client)
+    assert reader.get(f"/comic/{comic_id}").status_code == 200
+    old_version = comic_state(comic_id)[1]
+    koma_id = Koma.query.filter_by(storage_key=keys[1]).one().id
+
+    # 消していないコマの「復元」でも version は上がる。完結したままなので、この dyno のものはすぐ描き直す
+    response = client.post("/admin/bulk", json={"action": "restore", "koma_ids": [koma_id]}, headers=ADMIN_AUTH)
+    assert response.status_code == 200
+
+    completed, version = comic_state(comic_id)
+    assert completed and version > old_version
+    assert snapshot_paths(comic_id) == [snapshot_path(comic_id, version)]
+    assert reader.get(f"/comic/{comic_id}/v{old_version}").location == f"/comic/{comic_id}"
@@ -0,0 +1,112 @@
+"""
+分割アップロード（/upload-sessions）の再開・再送・finalize のやり直しを確かめる。
+"""
+import worker
+from app import db, storage, Koma, SpoolChunk, UploadSession, KOMA_READY, upload_part_name
+from conftest import png
+
+
+def create_session(client, data, **form):
+    response = client.post("/upload-sessions", data={
+        "filename": "koma.png", "size": str(len(data)), "comic_id": "new", "title": "分割", "max_koma": "10", **form,
+    })
+    assert response.status_code == 201
+    return response.get_json()
+
+
+def put_range(client, session, data, start, end):
+    return client.put(session["url"], data=data[start:end + 1], headers={
+        "Content-Range": f"bytes {start}-{end}/{len(data)}",
+    })
+
+
+def finalize(client, session):
+    return client.post(session["url"] + "/finalize")
+
+
+# worker にアップロードさせて、ストレージに置かれた中身を返す
+def uploaded_bytes(koma_id):
+    worker.run_once()
+    db.session.expire_all()
+    koma = db.session.get(Koma, koma_id)
+    assert koma.status == KOMA_READY
+    return storage.blobs[koma.storage_key]
+
+
+def test_resume_after_partial_put(client):
+    data = png(size=(400, 300))
+    session = create_session(client, data)
+    assert session["offset"] == 0
+
+    assert put_range(client, session, data, 0, 99).get_json() == {"offset": 100}
+    # 中断したあとは GET で受け取った位置を聞いて、そこから送る
+    state = client.get(session["url"])
+    assert state.get_json()["offset"] == 100
+    assert state.headers["Upload-Offset"] == "100"
+    # 全部届く前の finalize は断る
+    early = finalize(client, session)
+    assert early.status_code == 409
+    assert early.get_json()["offset"] == 100
+
+    assert put_range(client, session, data, 100, len(data) - 1).get_json() == {"offset": len(data)}
+    response = finalize(client, session)
+    assert response.status_code == 200
+    assert uploaded_bytes(response.get_json()["koma_id"]) == data
+
+
+def test_overlapping_resend_keeps_only_new_bytes(client):
+    data = png(size=(400, 300))
+    session = create_session(client, data)
+    assert put_range(client, session, data, 0, 199).get_json() == {"offset": 200}
+    # 応答を受け取れずに同じ範囲から送り直した（100-199 は受け取り済み）
+    assert put_range(client, session, data, 100, 299).get_json() == {"offset": 300}
+    # すっかり受け取り済みの範囲は何もしない
+    assert put_range(client, session, data, 0, 99).get_json() == {"offset": 300}
+    assert put_range(client, session, data, 300, len(data) - 1).get_json() == {"offset": len(data)}
+
+    response = finalize(client, session)
+    assert response.status_code == 200
+    assert uploaded_bytes(response.get_json()["koma_id"]) == data
+
+
+def test_gap_is_rejected_with_current_offset(client):
+    data = png(size=(400, 300))
+    session = create_session(client, data)
+    assert put_range(client, session, data, 0, 99).status_code == 200
+
+    response = put_range(client, session, data, 200, 299)
+    assert response.status_code == 409
+    assert response.get_json()["offset"] == 100
+
+    # Content-Range と本体の大きさが合わないものは 400
+    bad = client.put(session["url"], data=data[100:150], headers={"Content-Range": f"bytes 100-199/{len(data)}"})
+    assert bad.status_code == 400
+    assert client.get(session["url"]).get_json()["offset"] == 100
+
+
+def test_finalize_twice_returns_same_koma(client):
+    data = png(size=(120, 90))
+    session = create_session(client, data)
+    assert put_range(client, session, data, 0, len(data) - 1).status_code == 200
+
+    first = finalize(client, session)
+    second = finalize(client, session)
+    assert first.status_code == second.status_code == 200
+    assert first.get_json() == second.get_json()
+    assert Koma.query.count() == 1
+    # 終わったセッションにはもう書けない
+    assert put_range(client, session, data, 0, len(data) - 1).status_code == 409
+
+
+def test_non_image_is_rejected_and_discarded(client):
+    data = b"this is not an image at all" * 10
+    session = create_session(client, data)
+    assert put_range(client, session, data, 0, len(data) - 1).status_code == 200
+
+    response = finalize(client, session)
+    assert response.status_code == 400
+    assert Koma.query.count() == 0
+    # 受け取った分ごと消える
+    assert client.get(session["url"]).status_code == 404
+    assert db.session.get(UploadSession, session["id"]) is None
+    assert SpoolChunk.query.filter_by(name=upload_part_name(session["id"])).count() == 0
@@ -0,0 +1,447 @@
+"""
+worker.py
+
+Procfile の worker プロセス。
+post_frame が spool_chunk（DB）に置いた pending のコマの画像をストレージ（storage.py）に上げて
+ready にする（web と worker は別の dyno なので、画像はファイルではなく DB で受け取る）。失敗したら間隔を倍々にしながら INGEST_MAX_ATTEMPTS 回までリトライし、
+それでもだめなら failed にしてコマ枠を空ける。
+
+分割アップロード（/upload-sessions）の画像も finalize されたら同じように pending のコマになる。
+直接アップロード（/direct-uploads）のコマは ready で届くので、あとから画像を読んで LQIP・content_sha256 を埋め、
+同じコミックに同じ画像があれば消し、ほかで上げた画像があれば使い回す（post_frame の重複チェックと同じこと）。
+縦横・バイト数はブラウザが転送してきたストレージの応答の値なので、画像そのもので確かめ直し、
+受け付けられない画像（大きすぎる・壊れている）ならコマ枠を空けて画像も消す。
+途中で止まったセッションは UPLOAD_SESSION_TTL_HOURS で受け取った分ごと消す。
+どのコマ・セッションからも指されていない spool_chunk も同じ時間で消す。
+
+あわせて notification_outbox に積まれた LINE 通知を送る。
+同じコミックへの通知は NOTIFY_WINDOW 秒に1通のダイジェストにまとめ、
+アップロードが終わったコマの分だけを送る（失敗・削除されたコマの通知は捨てる）。
+
+GC_INTERVAL ごとに使われていない画像を掃除する（app.gc_storage）。
+
+Usage:
+  python worker.py            # ずっと回す
+  python worker.py --once     # pending を1回さばいて終了
+"""
+import argparse
+import hashlib
+import io
+import os
+import time
+from datetime import datetime, timedelta
+
+import requests
+from sqlalchemy import func, or_, select
+from sqlalchemy.orm import aliased
+
+from imaging import image_meta, validate_image, ImageRejected
+
+from app import (
+    app, db, storage, Comic, Koma, NotificationOutbox, PostIdempotency, UploadSession, SpoolChunk, recount_comics,
+    discard_spool, load_spool, SpoolMissing,
+    pending_komas_query, gc_storage, find_uploaded_copy, reuse_upload, upload_part_name, touch_comics,
+    invalidate_comics, duplicate_in_comic, delete_storage_keys,
+    send_line_notify, line_notify_enabled,
+    KOMA_PENDING, KOMA_READY, KOMA_FAILED,
+    INGEST_MAX_ATTEMPTS, INGEST_RETRY_BASE, INGEST_RETRY_MAX,
+    NOTIFY_PENDING, NOTIFY_SENT, NOTIFY_DROPPED, NOTIFY_WINDOW, NOTIFY_MAX_ATTEMPTS,
+    IDEMPOTENCY_KEEP_HOURS, UPLOAD_SESSION_TTL_HOURS, DIRECT_UPLOAD_FOLDER, KOMA_MISSING_META_WHERE,
+    MAX_CHUNKED_UPLOAD_BYTES,
+)
+
+POLL_INTERVAL = float(os.environ.get("WORKER_POLL_INTERVAL", 2))
+BATCH_SIZE = int(os.environ.get("WORKER_BATCH_SIZE", 10))
+# 送信済み・破棄済みの通知を残しておく日数
+NOTIFY_KEEP_DAYS = 7
+HOUSEKEEPING_INTERVAL = 3600
+# ストレージの掃除の間隔（秒）。0 なら worker では回さない（Heroku Scheduler などで flask gc-storage を回す）
+GC_INTERVAL = int(os.environ.get("GC_INTERVAL", 86400))
+
+
+def retry_delay(attempts):
+    return min(INGEST_RETRY_BASE * 2 ** (attempts - 1), INGEST_RETRY_MAX)
+
+
+# 処理待ちのコマを取り出す
+# Postgres では SKIP LOCKED で worker を複数立てても同じコマを取り合わない
+def claim_pending(limit):
+    return (
+        pending_komas_query(datetime.utcnow())
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+
+
+def ingest_koma(koma):
+    # 同じ画像が先にアップロードされていればそれを使い回す（同じ画像の投稿が続いたとき）
+    copy = find_uploaded_copy(koma.content_sha256) if koma.content_sha256 else None
+    if copy:
+        spool_path = koma.spool_path
+        reuse_upload(koma, copy)
+        koma.last_error = None
+        touch_comics([koma.comic_id])
+        db.session.commit()
+        invalidate_comics([koma.comic_id])
+        discard_spool(spool_path)
+        return True
+
+    path = None
+    try:
+        # DB の画像を作業用のファイルに戻す
+        path = load_spool(koma.spool_path)
+        # 縦横・バイト数・LQIP はアップロード前に手元のファイルから作っておく
+        if koma.lqip is None:
+            meta = image_meta(path)
+            for name, value in meta.items():
+                setattr(koma, name, value)
+        result = storage.put(path, folder=f"manga_relay/{koma.comic_id}")
+    except Exception as e:
+        koma.attempts += 1
+        koma.last_error = str(e)[:1000]
+        if koma.attempts >= INGEST_MAX_ATTEMPTS or isinstance(e, SpoolMissing):
+            # あきらめてコマ枠を空ける
+            koma.status = KOMA_FAILED
+            koma.is_deleted = 1
+            koma.deleted_at = datetime.utcnow()
+            db.session.flush()
+            recount_comics(Comic.id == koma.comic_id)
+            app.logger.error(f"[ingest] koma {koma.id} failed: {e}")
+        else:
+            koma.next_attempt_at = datetime.utcnow() + timedelta(seconds=retry_delay(koma.attempts))
+            app.logger.warning(f"[ingest] koma {koma.id} retry {koma.attempts}: {e}")
+        db.session.commit()
+        if koma.status == KOMA_FAILED:
+            invalidate_comics([koma.comic_id], keep_stale=False)
+            if koma.spool_path:
+                discard_spool(koma.spool_path)
+        return False
+    finally:
+        if path:
+            os.remove(path)
+
+    spool_path = koma.spool_path
+    koma.storage_key = result["key"]
+    koma.image_filename = result["url"]
+    koma.status = KOMA_READY
+    koma.spool_path = None
+    koma.last_error = None
+    # プレースホルダだったコマに画像が出るので、ページの version を上げる
+    touch_comics([koma.comic_id])
+    db.session.commit()
+    invalidate_comics([koma.comic_id])
+    discard_spool(spool_path)
+    return True
+
+
+# --- LQIP・ハッシュの無い ready のコマ ---
+# 直接アップロードのコマ（と、それより前からある LQIP・ハッシュの無いコマ）を少しずつ拾う
+# 読めなかったコマはアップロードと同じ間隔でリトライし、INGEST_MAX_ATTEMPTS 回であきらめる
+def claim_missing_meta(limit):
+    now = datetime.utcnow()
+    return (
+        Koma.query
+        .filter(
+            db.text(KOMA_MISSING_META_WHERE),
+            Koma.attempts < INGEST_MAX_ATTEMPTS,
+            or_(Koma.next_attempt_at.is_(None), Koma.next_attempt_at <= now),
+        )
+        .order_by(Koma.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+
+
+# 直接アップロードの縦横・バイト数はブラウザが転送してきた値なので、画像そのもので確かめ直す
+# 受け付けられなければその理由を返す
+def direct_upload_rejected(data):
+    if len(data) > MAX_CHUNKED_UPLOAD_BYTES:
+        return "ファイルが大きすぎます"
+    try:
+        validate_image(io.BytesIO(data))
+    except ImageRejected as e:
+        return str(e)
+    return None
+
+
+def complete_image_meta(koma):
+    direct = koma.storage_key.startswith(DIRECT_UPLOAD_FOLDER + "/")
+    try:
+        data = storage.read(koma.storage_key)
+        rejected = direct_upload_rejected(data) if direct else None
+        meta = None if rejected else image_meta(io.BytesIO(data))
+        content_sha256 = hashlib.sha256(data).hexdigest()
+    except Exception as e:
+        koma.attempts += 1
+        koma.last_error = str(e)[:1000]
+        koma.next_attempt_at = datetime.utcnow() + timedelta(seconds=retry_delay(koma.attempts))
+        db.session.commit()
+        app.logger.warning(f"[meta] koma {koma.id} retry {koma.attempts}: {e}")
+        return False
+
+    comic_id = koma.comic_id
+    if rejected:
+        # finalize で断るはずだった画像。コマ枠を空けて、画像も消す
+        key = koma.storage_key
+        koma.status = KOMA_FAILED
+        koma.is_deleted = 1
+        koma.deleted_at = datetime.utcnow()
+        koma.storage_key = None
+        koma.image_filename = None
+        koma.last_error = rejected
+        db.session.flush()
+        recount_comics(Comic.id == comic_id)
+        db.session.commit()
+        invalidate_comics([comic_id], keep_stale=False)
+        delete_storage_keys([key])
+        app.logger.warning(f"[meta] rejected direct upload koma {koma.id}: {rejected}")
+        return True
+
+    own_key = None
+    # 重複の片付けは直接アップロードのコマだけ（ほかは投稿のときに済んでいる）
+    if direct:
+        if duplicate_in_comic(comic_id, content_sha256):
+            # 同じ画像の連投（post_frame なら 409 で断るもの）。コマ枠を空ける
+            koma.content_sha256 = content_sha256
+            koma.is_deleted = 1
+            koma.deleted_at = datetime.utcnow()
+            koma.last_error = "duplicate in comic"
+            db.session.flush()
+            recount_comics(Comic.id == comic_id)
+            db.session.commit()
+            invalidate_comics([comic_id], keep_stale=False)
+            app.logger.info(f"[dedup] dropped duplicate koma {koma.id} in comic {comic_id}")
+            return True
+        copy = find_uploaded_copy(content_sha256)
+        if copy and copy.storage_key != koma.storage_key:
+            own_key = koma.storage_key
+            reuse_upload(koma, copy)
+            app.logger.info(f"[dedup] reused koma {copy.id} for koma {koma.id}")
+
+    for name, value in meta.items():
+        if direct or getattr(koma, name) is None:
+            setattr(koma, name, value)
+    koma.content_sha256 = content_sha256
+    koma.last_error = None
+    # ぼかし画像が出るようになるので、ページの version を上げる
+    touch_comics([comic_id])
+    db.session.commit()
+    invalidate_comics([comic_id])
+    if own_key:
+        # 使い回すことにした画像は、もうどのコマも指していなければ消す
+        delete_storage_keys([own_key])
+    return True
+
+
+# --- LINE 通知 ---
+def notify_message(count, link):
+    if count == 1:
+        return f"🖊 新しいコマが投稿されたよ！\n{link}"
+    return f"🖊 新しいコマが{count}枚投稿されたよ！\n{link}"
+
+
+def is_permanent_error(e):
+    response = getattr(e, "response", None)
+    return (
+        isinstance(e, requests.HTTPError)
+        and response is not None
+        and 400 <= response.status_code < 500
+        and response.status_code != 429
+    )
+
+
+# 1つのコミックの送信待ちをまとめて1通で送る。送った通知の件数を返す
+def send_digest(comic_id):
+    rows = (
+        db.session.query(NotificationOutbox, Koma.status, Koma.is_deleted)
+        .outerjoin(Koma, Koma.id == NotificationOutbox.koma_id)
+        .filter(
+            NotificationOutbox.comic_id == comic_id,
+            NotificationOutbox.status == NOTIFY_PENDING,
+        )
+        .order_by(NotificationOutbox.id)
+        .with_for_update(skip_locked=True, of=NotificationOutbox)
+        .all()
+    )
+
+    ready = []
+    for outbox, koma_status, koma_deleted in rows:
+        if koma_status == KOMA_PENDING and not koma_deleted:
+            continue  # アップロード待ち。次の回にまわす
+        if koma_status != KOMA_READY or koma_deleted:
+            outbox.status = NOTIFY_DROPPED
+            continue
+        ready.append(outbox)
+
+    if not ready:
+        db.session.commit()
+        return 0
+
+    try:
+        send_line_notify(notify_message(len(ready), ready[-1].link))
+    except Exception as e:
+        for outbox in ready:
+            outbox.attempts += 1
+            outbox.last_error = str(e)[:1000]
+            if is_permanent_error(e) or outbox.attempts >= NOTIFY_MAX_ATTEMPTS:
+                outbox.status = NOTIFY_DROPPED
+            else:
+                outbox.next_attempt_at = datetime.utcnow() + timedelta(seconds=retry_delay(outbox.attempts))
+        db.session.commit()
+        app.logger.warning(f"[notify] comic {comic_id}: {e}")
+        return 0
+
+    now = datetime.utcnow()
+    for outbox in ready:
+        outbox.status = NOTIFY_SENT
+        outbox.sent_at = now
+    db.session.commit()
+    return len(ready)
+
+
+def drain_notifications():
+    if not line_notify_enabled():
+        return 0
+
+    now = datetime.utcnow()
+    window_start = now - timedelta(seconds=NOTIFY_WINDOW)
+    sent_outbox = aliased(NotificationOutbox)
+    # 送れる（または捨てる）行があって、直近のウィンドウ内にまだ送っていないコミックを古い順に取る
+    # アップロード待ちのコマの分しか無いコミック・ウィンドウ内のコミックはここで外す
+    # （LIMIT の枠を取り続けて、ほかのコミックの通知を止めないように）
+    recently_sent = (
+        select(sent_outbox.id)
+        .where(
+            sent_outbox.comic_id == NotificationOutbox.comic_id,
+            sent_outbox.status == NOTIFY_SENT,
+            sent_outbox.sent_at > window_start,
+        )
+        .exists()
+    )
+    comic_ids = [
+        comic_id for (comic_id,) in
+        db.session.query(NotificationOutbox.comic_id)
+        .outerjoin(Koma, Koma.id == NotificationOutbox.koma_id)
+        .filter(
+            NotificationOutbox.status == NOTIFY_PENDING,
+            or_(NotificationOutbox.next_attempt_at.is_(None), NotificationOutbox.next_attempt_at <= now),
+            or_(Koma.id.is_(None), Koma.status != KOMA_PENDING, Koma.is_deleted != 0),
+            ~recently_sent,
+        )
+        .group_by(NotificationOutbox.comic_id)
+        .order_by(func.min(NotificationOutbox.created_at))
+        .limit(BATCH_SIZE)
+    ]
+
+    sent = 0
+    for comic_id in comic_ids:
+        sent += send_digest(comic_id)
+    return sent
+
+
+def purge_notifications():
+    threshold = datetime.utcnow() - timedelta(days=NOTIFY_KEEP_DAYS)
+    NotificationOutbox.query.filter(
+        NotificationOutbox.status != NOTIFY_PENDING,
+        NotificationOutbox.created_at < threshold,
+    ).delete(synchronize_session=False)
+    db.session.commit()
+
+
+# 二重送信対策のキーは、ブラウザが再送してくる間だけあればいい
+def purge_idempotency_keys():
+    threshold = datetime.utcnow() - timedelta(hours=IDEMPOTENCY_KEEP_HOURS)
+    PostIdempotency.query.filter(PostIdempotency.created_at < threshold).delete(synchronize_session=False)
+    db.session.commit()
+
+
+# 途中で止まった分割アップロードは受け取った分ごと消す（済んだセッションは行だけ）
+def purge_upload_sessions():
+    threshold = datetime.utcnow() - timedelta(hours=UPLOAD_SESSION_TTL_HOURS)
+    upload_ids = [
+        upload_id for (upload_id,) in
+        db.session.query(UploadSession.id).filter(UploadSession.updated_at < threshold)
+    ]
+    if not upload_ids:
+        return 0
+    UploadSession.query.filter(UploadSession.id.in_(upload_ids)).delete(synchronize_session=False)
+    db.session.commit()
+    for upload_id in upload_ids:
+        discard_spool(upload_part_name(upload_id))
+    app.logger.info(f"[upload] purged {len(upload_ids)} sessions")
+    return len(upload_ids)
+
+
+# 消し損ねた spool_chunk（アップロード待ちのコマ・受け取り中のセッションのどちらでもないもの）を消す
+def purge_spool():
+    threshold = datetime.utcnow() - timedelta(hours=UPLOAD_SESSION_TTL_HOURS)
+    pending = select(Koma.spool_path).where(Koma.status == KOMA_PENDING, Koma.spool_path.isnot(None))
+    parts = select(UploadSession.id + '.part')
+    count = SpoolChunk.query.filter(
+        SpoolChunk.created_at < threshold,
+        SpoolChunk.name.notin_(pending),
+        SpoolChunk.name.notin_(parts),
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    if count:
+        app.logger.info(f"[spool] purged {count} orphaned chunks")
+    return count
+
+
+def run_once():
+    # 1件ずつコミットするので、取り出しも1件ずつ行ってロックを短くする
+    done = 0
+    for _ in range(BATCH_SIZE):
+        komas = claim_pending(1)
+        if not komas:
+            break
+        ingest_koma(komas[0])
+        done += 1
+    for _ in range(BATCH_SIZE):
+        komas = claim_missing_meta(1)
+        if not komas:
+            break
+        complete_image_meta(komas[0])
+        done += 1
+    done += drain_notifications()
+    return done
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pending のコマをアップロードする worker")
+    parser.add_argument("--once", action="store_true", help="1回だけ処理して終了する")
+    args = parser.parse_args()
+
+    with app.app_context():
+        last_housekeeping = 0
+        last_gc = None
+        while True:
+            try:
+                if time.monotonic() - last_housekeeping >= HOUSEKEEPING_INTERVAL:
+                    purge_notifications()
+                    purge_idempotency_keys()
+                    purge_upload_sessions()
+                    purge_spool()
+                    last_housekeeping = time.monotonic()
+                # 起動直後と GC_INTERVAL ごと（--once では回さない）
+                if GC_INTERVAL and not args.once and (last_gc is None or time.monotonic() - last_gc >= GC_INTERVAL):
+                    last_gc = time.monotonic()
+                    app.logger.info(f"[gc] {gc_storage()}")
+                done = run_once()
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"[worker] {e}")
+                done = 0
+            finally:
+                db.session.remove()
+
+            if args.once:
+                break
+            if not done:
+                time.sleep(POLL_INTERVAL)
+
+
+if __name__ == "__main__":
+    main()